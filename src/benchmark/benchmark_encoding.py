@@ -0,0 +1,87 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: Benchmark GeoTIFF Encoding Profiles (write time, read time, file size)
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.transform import Affine
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+from encoding import ENCODING_PROFILES, rasterio_creation_options
+
+# synthetic layers shaped like the pipeline intermediates
+def create_sample_layers(size, seed=0):
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[0:size, 0:size]
+
+    # proximity: smooth Float32 distance field (meters) to a few random points
+    points = rng.integers(0, size, (8, 2))
+    proximity = np.min([np.hypot(rows - r, cols - c) for r, c in points], axis=0).astype(np.float32) * 30
+
+    # rasterized vector: sparse Byte lines
+    rasterized = np.zeros((size, size), dtype=np.uint8)
+    rasterized[rng.integers(0, size, size // 50), :] = 1
+    rasterized[:, rng.integers(0, size, size // 50)] = 1
+
+    # scored: blocky Float32 scores 0-3
+    scored = np.repeat(np.repeat(rng.integers(0, 4, (size // 16 + 1, size // 16 + 1)), 16, axis=0), 16, axis=1)[:size, :size].astype(np.float32)
+
+    return {'proximity': proximity, 'rasterized': rasterized, 'scored': scored}
+
+def benchmark_profile(layer, profile_name, output_path, repeat):
+    profile = {
+        'driver': 'GTiff', 'height': layer.shape[0], 'width': layer.shape[1], 'count': 1, 'dtype': layer.dtype,
+        'crs': 'EPSG:3857', 'transform': Affine(30, 0, 0, 0, -30, 0),
+    }
+    profile.update(rasterio_creation_options(profile_name, layer.dtype))
+
+    write_times, read_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            dst.write(layer, 1)
+        write_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with rasterio.open(output_path) as src:
+            src.read(1)
+        read_times.append(time.perf_counter() - start)
+
+    return {
+        'write_s': round(min(write_times), 4),
+        'read_s': round(min(read_times), 4),
+        'size_MB': round(os.path.getsize(output_path) / 1e6, 3),
+        'raw_MB': round(layer.nbytes / 1e6, 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the GeoTIFF encoding profiles')
+    parser.add_argument('--size', type=int, default=4096, help='width/height of the sample layers in pixels')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per measurement (the fastest is reported)')
+    parser.add_argument('--output', help='optional CSV file for the results')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for layer_name, layer in create_sample_layers(args.size).items():
+            for profile_name in ENCODING_PROFILES:
+                result = benchmark_profile(layer, profile_name, os.path.join(temp_dir, layer_name + '.tif'), args.repeat)
+                results.append({'layer': layer_name, 'dtype': str(layer.dtype), 'profile': profile_name, **result})
+
+    df_results = pd.DataFrame(results)
+    print(df_results.to_string(index=False))
+
+    if args.output:
+        df_results.to_csv(args.output, index=False)
+
+if __name__ == "__main__":
+    main()
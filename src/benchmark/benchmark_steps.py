@@ -0,0 +1,226 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: Benchmark the MCA Steps on a Synthetic Dataset (wall time, CPU time, peak memory, run-to-run history)
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import multiprocessing
+import importlib
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCHMARK_PATH, '..', 'module'))
+from generate_synthetic_data import generate_dataset
+
+# cases in the order they run: the whole pipeline first (it writes every intermediate), then each step, then each core function on those intermediates
+PIPELINE_CASES = ['pipeline'] + ['step{}'.format(step) for step in range(2, 9)]
+FUNCTION_CASES = ['convert_crs', 'rasterize_vector', 'calculate_proximity', 'clip_extend', 'reclassify_by_range', 'process_result_calculation']
+
+# run-to-run history of the results, a regression is a case that got slower than the previous run by more than the tolerance
+DEFAULT_HISTORY_PATH = os.path.join(BENCHMARK_PATH, 'results', 'step_benchmarks.csv')
+
+def get_template_path(data_root, step):
+    return os.path.join(data_root, 'setting_excel', 'step{}_excel_template.xlsx'.format(step))
+
+# row of a step's Excel template whose file name starts with prefix
+def find_template_row(data_root, step, prefix):
+    df_template = pd.read_excel(get_template_path(data_root, step))
+    rows = df_template[df_template['file_name'].str.startswith(prefix)]
+    if rows.empty:
+        raise ValueError(f"No file starting with '{prefix}' in {get_template_path(data_root, step)}")
+    return rows.iloc[0]
+
+def get_step_path(data_root, step):
+    return os.path.join(data_root, 'step{}'.format(step), '')
+
+# setup of a function case: a function without arguments that runs the measured call on the pipeline intermediates of data_root
+# (the inputs are the same files the pipeline run used, the outputs go to work_path)
+def prepare_function_case(case, data_root, work_path, max_workers):
+    if case == 'convert_crs':
+        step3 = importlib.import_module('step3_convert_CRS')
+        row = find_template_row(data_root, 2, 'DEM')
+        return lambda: step3.convert_crs(get_step_path(data_root, 1) + row['file_name'], os.path.join(work_path, 'DEM_CRS.tif'), row['source_CRS'], row['target_CRS'], True)
+
+    if case == 'rasterize_vector':
+        step4 = importlib.import_module('step4_rasterize_vector_equalize_resolution')
+        row = find_template_row(data_root, 3, 'roads')
+        target_crs = int(row['target_CRS'].split(':')[-1])
+        return lambda: step4.rasterize_vector(get_step_path(data_root, 3) + row['file_name'], os.path.join(work_path, 'roads_rasterized.tif'), row['target_resolution(m)'], target_crs)
+
+    if case == 'calculate_proximity':
+        step5 = importlib.import_module('step5_calculate_proximity')
+        row = find_template_row(data_root, 4, 'roads')
+        return lambda: step5.calculate_proximity(get_step_path(data_root, 4) + row['file_name'], os.path.join(work_path, 'roads_proximity.tif'), row['max_distance(m)'],
+                                                 max_workers=max_workers)
+
+    if case == 'clip_extend':
+        step6 = importlib.import_module('step6_clip_extend')
+        row = find_template_row(data_root, 5, 'DEM')
+        aoi_extent = step6.get_aoi_extent(get_step_path(data_root, 5) + find_template_row(data_root, 5, 'AOI')['file_name'])
+        return lambda: step6.clip_extend(get_step_path(data_root, 5) + row['file_name'], os.path.join(work_path, 'DEM_clip.tif'), aoi_extent)
+
+    if case == 'reclassify_by_range':
+        step7 = importlib.import_module('step7_calculate_range')
+        row = find_template_row(data_root, 6, 'DEM')
+
+        # the layer is read and its ranges parsed inside the measurement, as in step7
+        def reclassify():
+            raster = step7.gdal.Open(get_step_path(data_root, 6) + row['file_name'])
+            raster_data = raster.GetRasterBand(1).ReadAsArray()
+            ranges = step7.parse_range(row['file_name'], row, raster_data)
+            step7.reclassify_by_range(row['file_name'], raster, raster_data, os.path.join(work_path, 'DEM_scored.tif'), ranges, 'N')
+        return reclassify
+
+    step8 = importlib.import_module('step8_calculate_result')
+    return lambda: step8.process_result_calculation(get_step_path(data_root, 7), os.path.join(work_path, ''), get_template_path(data_root, 7), 1024,
+                                                    max_workers=max_workers)
+
+# CPU time (s) and peak memory (MB) of this process and of the worker processes it waited for, peak memory None when unknown
+# resource is Unix-only, on Windows the times and peak working set of this process come from psutil when it is installed
+# (without the worker processes), otherwise only the CPU time of this process is measured
+def read_usage():
+    try:
+        import resource
+    except ImportError:
+        resource = None
+
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        rss_unit = 1024 ** 2 if sys.platform == 'darwin' else 1024
+        return {
+            'cpu_s': usage.ru_utime + usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime,
+            'peak_rss_MB': max(usage.ru_maxrss, children_usage.ru_maxrss) / rss_unit,
+            'self_peak_rss_MB': usage.ru_maxrss / rss_unit,
+        }
+
+    try:
+        import psutil
+    except ImportError:
+        return {'cpu_s': time.process_time(), 'peak_rss_MB': None, 'self_peak_rss_MB': None}
+
+    process = psutil.Process()
+    cpu_times = process.cpu_times()
+    memory_info = process.memory_info()
+    peak_rss_MB = getattr(memory_info, 'peak_wset', memory_info.rss) / 1024 ** 2
+    return {'cpu_s': cpu_times.user + cpu_times.system, 'peak_rss_MB': peak_rss_MB, 'self_peak_rss_MB': peak_rss_MB}
+
+def round_or_none(value, digits):
+    return None if value is None else round(value, digits)
+
+# one measurement, run in a fresh process so its peak memory is its own (the GDAL block cache and imports of earlier cases do not count)
+def run_case(case, data_root, work_path, max_workers):
+    # every output is rebuilt, the build cache would otherwise skip the work
+    os.environ['MCA_CACHE'] = '0'
+
+    if case in PIPELINE_CASES:
+        pipeline = importlib.import_module('pipeline')
+        df_settings = pd.read_excel(os.path.join(data_root, 'setting_excel', 'MCA_settings.xlsx'))
+        steps = range(2, 9) if case == 'pipeline' else [int(case[len('step'):])]
+        measured = lambda: pipeline.run_pipeline(data_root, steps, df_settings=df_settings, write_excel=True, max_workers=max_workers)
+    else:
+        measured = prepare_function_case(case, data_root, work_path, max_workers)
+
+    start_usage = read_usage()
+    start_time = time.perf_counter()
+
+    measured()
+
+    wall_time = time.perf_counter() - start_time
+    usage = read_usage()
+
+    # the fresh process has no worker processes before the case, so the CPU time of the workers is all from the case
+    peak_rss_increase = usage['self_peak_rss_MB'] - start_usage['self_peak_rss_MB'] if usage['self_peak_rss_MB'] is not None else None
+    return {
+        'wall_s': round(wall_time, 3),
+        'cpu_s': round(usage['cpu_s'] - start_usage['cpu_s'], 3),
+        'peak_rss_MB': round_or_none(usage['peak_rss_MB'], 1),
+        'peak_rss_increase_MB': round_or_none(peak_rss_increase, 1),
+    }
+
+# the fastest of repeat runs of a case, each in its own spawned process
+def benchmark_case(case, data_root, work_path, max_workers, repeat):
+    results = []
+    for _ in range(repeat):
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results.append(executor.submit(run_case, case, data_root, work_path, max_workers).result())
+    return min(results, key=lambda result: result['wall_s'])
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_PATH, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+# results of this run next to the previous run of the same size and worker count, 'change' is the ratio of the wall times
+def compare_with_previous(df_results, df_history, tolerance):
+    df_previous = df_history[(df_history['size'] == df_results['size'].iloc[0]) & (df_history['max_workers'] == df_results['max_workers'].iloc[0])]
+    df_comparison = df_results[['case', 'wall_s', 'cpu_s', 'peak_rss_MB']].copy()
+    if df_previous.empty:
+        return df_comparison, []
+
+    previous_run = df_previous['run'].iloc[-1]
+    df_previous = df_previous[df_previous['run'] == previous_run].set_index('case')
+    df_comparison['previous_wall_s'] = df_comparison['case'].map(df_previous['wall_s'])
+    df_comparison['previous_peak_rss_MB'] = df_comparison['case'].map(df_previous['peak_rss_MB'])
+    df_comparison['change'] = (df_comparison['wall_s'] / df_comparison['previous_wall_s']).round(2)
+
+    regressions = df_comparison[df_comparison['change'] > 1 + tolerance]['case'].tolist()
+    print(f"Compared with run {previous_run} (commit {df_previous['commit'].iloc[0]})")
+    return df_comparison, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MCA steps and their core functions on a synthetic dataset')
+    parser.add_argument('--size', type=int, default=1024, help='width/height of the synthetic rasters in pixels')
+    parser.add_argument('--data-root', help='dataset directory, generated when it has no step1 (default: data_synthetic_<size>)')
+    parser.add_argument('--cases', help="comma separated cases to run (default: all), e.g. 'pipeline,step5,calculate_proximity'")
+    parser.add_argument('--workers', type=int, default=1, help='parallel worker processes of the pipeline steps')
+    parser.add_argument('--repeat', type=int, default=1, help='repetitions per case (the fastest is reported)')
+    parser.add_argument('--history', default=DEFAULT_HISTORY_PATH, help='CSV file the results are appended to')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='a case slower than the previous run by more than this fraction is a regression')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 when a case regressed')
+    args = parser.parse_args()
+
+    data_root = args.data_root or 'data_synthetic_{}'.format(args.size)
+    if not os.path.isdir(os.path.join(data_root, 'step1')):
+        generate_dataset(data_root, args.size)
+
+    # the function cases read the intermediates of the pipeline run
+    cases = args.cases.split(',') if args.cases else PIPELINE_CASES + FUNCTION_CASES
+    if any(case in FUNCTION_CASES for case in cases) and not os.path.exists(get_template_path(data_root, 7)) and 'pipeline' not in cases:
+        cases = ['pipeline'] + cases
+
+    work_path = os.path.join(data_root, 'benchmark')
+    os.makedirs(work_path, exist_ok=True)
+
+    run = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    results = []
+    for case in cases:
+        print(f"Benchmarking {case}")
+        results.append({'run': run, 'commit': get_git_commit(), 'size': args.size, 'max_workers': args.workers, 'case': case,
+                        **benchmark_case(case, data_root, work_path, args.workers, args.repeat)})
+    df_results = pd.DataFrame(results)
+
+    df_history = pd.read_csv(args.history) if os.path.exists(args.history) else pd.DataFrame(columns=df_results.columns)
+    df_comparison, regressions = compare_with_previous(df_results, df_history, args.tolerance)
+    print(df_comparison.to_string(index=False))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+    pd.concat([df_history, df_results], ignore_index=True).to_csv(args.history, index=False)
+
+    if regressions:
+        print(f"Slower than the previous run by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        if args.fail_on_regression:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
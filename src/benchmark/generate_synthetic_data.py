@@ -0,0 +1,174 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: Generate a Synthetic MCA Dataset (step1 layers and settings table)
+"""
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import rasterio
+import geopandas as gpd
+import shapely
+from rasterio.windows import Window
+
+# the synthetic area lies around 15°E 45°N in Web Mercator (the CRS of the GEE downloads), 30 m pixels by default
+SOURCE_CRS = 'EPSG:3857'
+ORIGIN_X = 1669792.0
+ORIGIN_Y = 5621521.0
+
+# settings of every step1 file, in the columns of the pipeline settings table (see pipeline.SETTING_COLUMNS)
+# land cover classes follow the ESRI land use / land cover legend (1 water, 2 trees, 4 flooded vegetation, 5 crops, 7 built area, 8 bare ground, 11 rangeland)
+LAYER_SETTINGS = [
+    {'file_name': 'AOI.shp', 'AOI': 1},
+    {'file_name': 'roads.shp', 'proximity': 1, 'max_distance(m)': 10000,
+     'most_suitable': '~1000', 'suitable': '1000~5000', 'least_suitable': '5000~', 'layer_weight': 1},
+    {'file_name': 'electricity_grid.shp', 'proximity': 1, 'max_distance(m)': 20000,
+     'most_suitable': '~2000', 'suitable': '2000~10000', 'least_suitable': '10000~', 'layer_weight': 1},
+    {'file_name': 'protected_area.shp', 'exclusion': 1},
+    {'file_name': 'DEM.tif', 'most_suitable': '~500', 'suitable': '500~1000', 'least_suitable': '1000~2000', 'exclusive_range': '2000~', 'layer_weight': 1},
+    {'file_name': 'GHI.tif', 'most_suitable': '1800~', 'suitable': '1500~1800', 'least_suitable': '~1500', 'layer_weight': 1},
+    {'file_name': 'wind_speed.tif', 'most_suitable': '~4', 'suitable': '4~7', 'least_suitable': '7~', 'layer_weight': 1},
+    {'file_name': 'land_cover.tif', 'most_suitable': '8,11', 'suitable': '5,7', 'least_suitable': '2,4', 'layer_weight': 1},
+    {'file_name': 'GLOBathy.tif'},
+]
+
+# smooth field of the pixel coordinates (rows, cols): a sum of waves with wavelengths between 1/20 and 1/2 of the raster size,
+# the same value for a pixel whatever the block it is computed in
+def smooth_field(rows, cols, size, rng, waves=6):
+    field = np.zeros(rows.shape)
+    for _ in range(waves):
+        wavelength = size * rng.uniform(0.05, 0.5)
+        angle, phase = rng.uniform(0, np.pi), rng.uniform(0, 2 * np.pi)
+        field += np.sin((cols * np.cos(angle) + rows * np.sin(angle)) / wavelength * 2 * np.pi + phase)
+    return field / waves  # mostly between -0.5 and 0.5
+
+# lakes of the GLOBathy-like layer: (row, col, radius) in pixels
+def create_lakes(size, rng):
+    lake_count = max(size * size // 250000, 4)
+    return np.column_stack([rng.uniform(0, size, lake_count), rng.uniform(0, size, lake_count), rng.uniform(5, max(size / 100, 10), lake_count)])
+
+# value of each raster for the block of pixel coordinates (rows, cols), every raster uses its own random stream seeded by seed
+def raster_block(layer_name, rows, cols, size, seed, lakes):
+    rng = np.random.default_rng([seed, sum(map(ord, layer_name))])
+
+    if layer_name == 'DEM':
+        return np.clip(900 + 2000 * smooth_field(rows, cols, size, rng), 0, 3000).astype(np.int16)
+    if layer_name == 'GHI':
+        return (1700 - 300 * rows / size + 400 * smooth_field(rows, cols, size, rng)).astype(np.float32)
+    if layer_name == 'wind_speed':
+        return (5.5 + 5 * smooth_field(rows, cols, size, rng)).astype(np.float32)
+    if layer_name == 'land_cover':
+        classes = np.array([1, 2, 4, 5, 7, 8, 11], dtype=np.uint8)
+        index = np.clip(((smooth_field(rows, cols, size, rng) * 2 + 1) / 2 * len(classes)).astype(int), 0, len(classes) - 1)
+        return classes[index]
+
+    # GLOBathy: depth (m) inside the lakes, 0 elsewhere
+    depth = np.zeros(rows.shape, dtype=np.float32)
+    row_min, row_max, col_min, col_max = rows.min(), rows.max(), cols.min(), cols.max()
+    for lake_row, lake_col, radius in lakes:
+        if lake_row + radius < row_min or lake_row - radius > row_max or lake_col + radius < col_min or lake_col - radius > col_max:
+            continue
+        distance = np.hypot(rows - lake_row, cols - lake_col)
+        depth = np.maximum(depth, np.clip((radius - distance) * 0.5, 0, None).astype(np.float32))
+    return depth
+
+# a size x size raster written block by block, so a 50000 x 50000 raster needs the memory of one block
+def write_raster(output_path, layer_name, size, pixel_size, seed, lakes, block_size=1024):
+    dtype = {'DEM': 'int16', 'land_cover': 'uint8'}.get(layer_name, 'float32')
+    profile = {
+        'driver': 'GTiff', 'height': size, 'width': size, 'count': 1, 'dtype': dtype, 'crs': SOURCE_CRS,
+        'transform': rasterio.Affine(pixel_size, 0, ORIGIN_X, 0, -pixel_size, ORIGIN_Y),
+        'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'DEFLATE', 'BIGTIFF': 'IF_SAFER',
+    }
+    if layer_name == 'GLOBathy':
+        profile['nodata'] = 0
+
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        for row_off in range(0, size, block_size):
+            for col_off in range(0, size, block_size):
+                height, width = min(block_size, size - row_off), min(block_size, size - col_off)
+                rows, cols = np.mgrid[row_off:row_off + height, col_off:col_off + width]
+                dst.write(raster_block(layer_name, rows + 0.5, cols + 0.5, size, seed, lakes), 1, window=Window(col_off, row_off, width, height))
+
+# map coordinates of pixel coordinates (rows, cols)
+def to_map(rows, cols, pixel_size):
+    return ORIGIN_X + np.asarray(cols) * pixel_size, ORIGIN_Y - np.asarray(rows) * pixel_size
+
+# random walk lines across the raster, segment_length in pixels
+def random_lines(line_count, size, pixel_size, rng, vertex_count=30, straightness=0.2):
+    lines = []
+    for _ in range(line_count):
+        heading = rng.uniform(0, 2 * np.pi)
+        steps = heading + np.cumsum(rng.normal(0, straightness, vertex_count))
+        segment_length = size / vertex_count
+        rows = rng.uniform(0, size) + np.concatenate([[0], np.cumsum(np.sin(steps) * segment_length)])
+        cols = rng.uniform(0, size) + np.concatenate([[0], np.cumsum(np.cos(steps) * segment_length)])
+        lines.append(shapely.linestrings(*to_map(np.clip(rows, 0, size), np.clip(cols, 0, size), pixel_size)))
+    return lines
+
+def write_vectors(output_path, size, pixel_size, seed):
+    rng = np.random.default_rng([seed, 1])
+
+    # AOI: octagon inside the central part of the raster
+    angles = np.linspace(0, 2 * np.pi, 9)[:-1] + np.pi / 8
+    radius = size * 0.42
+    aoi = shapely.polygons(np.column_stack(to_map(size / 2 + radius * np.sin(angles), size / 2 + radius * np.cos(angles), pixel_size)))
+
+    # protected areas: irregular discs, both inside and outside the AOI
+    area_count = max(size // 200, 3)
+    centres = rng.uniform(0, size, (area_count, 2))
+    protected = [shapely.Point(*to_map(row, col, pixel_size)).buffer(rng.uniform(10, max(size / 40, 20)) * pixel_size, quad_segs=4)
+                 for row, col in centres]
+
+    layers = {
+        'AOI': [aoi],
+        'roads': random_lines(max(size // 20, 10), size, pixel_size, rng, straightness=0.4),
+        'electricity_grid': random_lines(max(size // 200, 3), size, pixel_size, rng, vertex_count=10, straightness=0.05),
+        'protected_area': protected,
+    }
+    for layer_name, geometries in layers.items():
+        gpd.GeoDataFrame({'id': np.arange(len(geometries))}, geometry=geometries, crs=SOURCE_CRS).to_file(os.path.join(output_path, layer_name + '.shp'))
+
+# settings table of the synthetic layers for 'pipeline.py --settings' (a '*' row sets the target CRS and resolution of every file)
+def create_settings(target_crs, target_resolution):
+    rows = [{'file_name': '*', 'target_CRS': target_crs, 'target_resolution(m)': target_resolution}] + LAYER_SETTINGS
+    columns = ['file_name', 'target_CRS', 'target_resolution(m)', 'AOI', 'exclusion', 'proximity', 'max_distance(m)',
+               'most_suitable', 'suitable', 'least_suitable', 'exclusive_range', 'layer_weight', 'FPV']
+    return pd.DataFrame(rows, columns=columns)
+
+# synthetic step1 layers of size x size pixels in data_root/step1 and their settings table in data_root/setting_excel/MCA_settings.xlsx
+def generate_dataset(data_root, size=1024, pixel_size=30, target_crs='EPSG:32633', seed=0, block_size=1024):
+    step1_path = os.path.join(data_root, 'step1')
+    setting_excel_path = os.path.join(data_root, 'setting_excel')
+    os.makedirs(step1_path, exist_ok=True)
+    os.makedirs(setting_excel_path, exist_ok=True)
+
+    lakes = create_lakes(size, np.random.default_rng([seed, 2]))
+    for layer_name in ['DEM', 'GHI', 'wind_speed', 'land_cover', 'GLOBathy']:
+        print(f"Writing {layer_name}.tif ({size} x {size})")
+        write_raster(os.path.join(step1_path, layer_name + '.tif'), layer_name, size, pixel_size, seed, lakes, block_size)
+
+    print("Writing vector layers")
+    write_vectors(step1_path, size, pixel_size, seed)
+
+    settings_path = os.path.join(setting_excel_path, 'MCA_settings.xlsx')
+    create_settings(target_crs, pixel_size).to_excel(settings_path, index=False)
+    return settings_path
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic MCA dataset in the layout of data/step1')
+    parser.add_argument('--data-root', default='data_synthetic', help='directory to create step1 and setting_excel in')
+    parser.add_argument('--size', type=int, default=1024, help='width/height of the rasters in pixels (1000 to 50000)')
+    parser.add_argument('--pixel-size', type=float, default=30, help='pixel size of the rasters in meters, also the target resolution')
+    parser.add_argument('--target-crs', default='EPSG:32633', help="target CRS of the settings table ('EPSG:XXXX')")
+    parser.add_argument('--seed', type=int, default=0, help='random seed, the same seed and size give the same dataset')
+    args = parser.parse_args()
+
+    settings_path = generate_dataset(args.data_root, args.size, args.pixel_size, args.target_crs, args.seed)
+    print(f"Settings table: {settings_path}")
+
+if __name__ == "__main__":
+    main()
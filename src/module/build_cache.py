@@ -0,0 +1,134 @@
+"""
+Created by Chungkang Choi
+April 2024
+
+Description: Incremental Rebuild Cache
+"""
+
+import os
+import ast
+import json
+import hashlib
+from functools import lru_cache
+from raster_stats import write_raster_stats, statistics_enabled
+
+# files of a shapefile that are hashed together with the '.shp'
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+# local modules (the '.py' files next to a script) the script imports, directly or through other local modules
+def local_modules(code_file_path, found=None):
+    found = found if found is not None else set()
+    found.add(os.path.abspath(code_file_path))
+    with open(code_file_path, 'rb') as f:
+        tree = ast.parse(f.read(), code_file_path)
+
+    module_names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            module_names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            module_names.append(node.module)
+
+    for module_name in module_names:
+        module_path = os.path.abspath(os.path.join(os.path.dirname(code_file_path), module_name.split('.')[0] + '.py'))
+        if os.path.exists(module_path) and module_path not in found:
+            local_modules(module_path, found)
+    return found
+
+# hash of the code that builds an output: the step script and the local modules it uses (grid.py, proximity.py, encoding.py ...),
+# any change to them rebuilds its outputs
+@lru_cache(maxsize=None)
+def code_version(code_file_path):
+    digest = hashlib.sha256()
+    for module_path in sorted(local_modules(code_file_path)):
+        with open(module_path, 'rb') as f:
+            digest.update(os.path.basename(module_path).encode())
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def file_digest(file_path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# every file that makes up a dataset (a shapefile is several files)
+def dataset_files(file_path):
+    base_path, file_ext = os.path.splitext(file_path)
+    if file_ext.lower() == '.shp':
+        return [base_path + ext for ext in SHAPEFILE_EXTENSIONS if os.path.exists(base_path + ext)]
+    return [file_path]
+
+# the cache record of an output is stored in a '.cache' directory next to the output
+def cache_record_path(output_path):
+    output_dir, output_name = os.path.split(output_path)
+    return os.path.join(output_dir, '.cache', output_name + '.json')
+
+def read_cache_record(output_path):
+    try:
+        with open(cache_record_path(output_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# key of an output: contents of its input files, the settings row parameters it depends on and the code version
+def cache_key(input_paths, params, code_file_path, previous_inputs=None):
+    previous_inputs = previous_inputs or {}
+    key = hashlib.sha256()
+    inputs = {}
+
+    for input_path in input_paths:
+        for file_path in dataset_files(input_path):
+            stat = os.stat(file_path)
+            previous = previous_inputs.get(file_path)
+
+            # unchanged size and modification time -> the digest of the previous build is reused instead of rereading the file
+            if previous and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+                digest = previous['digest']
+            else:
+                digest = file_digest(file_path)
+
+            inputs[file_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}
+            key.update(os.path.basename(file_path).encode())
+            key.update(digest.encode())
+
+    key.update(json.dumps(params, sort_keys=True, default=str).encode())
+    key.update(code_version(code_file_path).encode())
+
+    return key.hexdigest(), inputs
+
+# check whether output_path was built from the same inputs, params and code, returns (up_to_date, cache_entry)
+# setting the MCA_CACHE environment variable to 0 rebuilds every output
+def check_cache(output_path, input_paths, params, code_file_path):
+    record = read_cache_record(output_path)
+    key, inputs = cache_key(input_paths, params, code_file_path, record.get('inputs'))
+    cache_entry = {'key': key, 'inputs': inputs}
+
+    if os.environ.get('MCA_CACHE', '1') != '0' and record.get('key') == key and os.path.exists(output_path):
+        print(f"Up to date: {output_path}")
+        return True, cache_entry
+
+    return False, cache_entry
+
+# record the cache entry of a rebuilt output, only outputs that were actually written are recorded
+# with MCA_STATISTICS=1 a raster output gets its statistics and histogram first (see raster_stats.py), so every later read of them is free
+def save_cache(output_path, cache_entry):
+    if os.path.exists(output_path):
+        if output_path.lower().endswith('.tif') and statistics_enabled():
+            write_raster_stats(output_path)
+        record_path = cache_record_path(output_path)
+        os.makedirs(os.path.dirname(record_path), exist_ok=True)
+        with open(record_path, 'w') as f:
+            json.dump(cache_entry, f, indent=1)
+
+# call build_function() unless output_path is up to date, returns True when rebuilt
+def run_cached(build_function, output_path, input_paths, params, code_file_path):
+    up_to_date, cache_entry = check_cache(output_path, input_paths, params, code_file_path)
+    if up_to_date:
+        return False
+
+    build_function()
+    save_cache(output_path, cache_entry)
+
+    return True
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: Metadata-Only Input Catalog
+"""
+
+import os
+import json
+import rasterio
+from osgeo import ogr
+from pyproj import CRS
+from parallel import process_rows
+from build_cache import dataset_files
+from raster_stats import read_raster_stats
+
+# entries written by an older version of the catalog (without the raster value range) are read again
+CATALOG_VERSION = 2
+
+# size and modification time of every file that makes up the dataset, a changed signature rereads the metadata
+def file_signature(file_path):
+    signature = {}
+    for dataset_file in dataset_files(file_path):
+        stat = os.stat(dataset_file)
+        signature[os.path.basename(dataset_file)] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+# value range stored with a raster: the MCA statistics (see raster_stats.py), otherwise GDAL's STATISTICS_* items (e.g. from an '.aux.xml')
+# None when the raster has no stored statistics, the pixels are never scanned for it
+def read_stored_stats(file_path, dataset):
+    stats = read_raster_stats(file_path)
+    if stats is not None:
+        return stats
+
+    tags = dataset.tags(1)
+    if 'STATISTICS_MINIMUM' not in tags or 'STATISTICS_MAXIMUM' not in tags:
+        return {'min': None, 'max': None, 'valid_count': None}
+    return {'min': float(tags['STATISTICS_MINIMUM']), 'max': float(tags['STATISTICS_MAXIMUM']), 'valid_count': None}
+
+# header metadata of a raster, no pixel is read
+def read_raster_metadata(file_path):
+    with rasterio.open(file_path) as dataset:
+        stats = read_stored_stats(file_path, dataset)
+        return {
+            'type': 'raster',
+            'crs': dataset.crs.to_string() if dataset.crs else None,
+            'resolution': list(dataset.res),
+            'bounds': list(dataset.bounds),
+            'width': dataset.width,
+            'height': dataset.height,
+            'band_count': dataset.count,
+            'dtype': dataset.dtypes[0],
+            'nodata': dataset.nodata,
+            'value_min': stats['min'],
+            'value_max': stats['max'],
+            'valid_count': stats['valid_count'],
+        }
+
+# header metadata of a vector layer, the geometries are not parsed when the driver stores the extent and feature count
+def read_vector_metadata(file_path):
+    vector_ds = ogr.Open(file_path)
+    if vector_ds is None:
+        raise RuntimeError(f"Failed to open vector file: {file_path}")
+
+    layer = vector_ds.GetLayer()
+    spatial_ref = layer.GetSpatialRef()
+    x_min, x_max, y_min, y_max = layer.GetExtent()
+    metadata = {
+        'type': 'vector',
+        # same string as GeoDataFrame.crs.to_string()
+        'crs': CRS.from_wkt(spatial_ref.ExportToWkt()).to_string() if spatial_ref else None,
+        'bounds': [x_min, y_min, x_max, y_max],
+        'feature_count': layer.GetFeatureCount(),
+        'geometry_type': ogr.GeometryTypeToName(layer.GetGeomType()),
+    }
+    vector_ds = None
+    return metadata
+
+def read_metadata(file_path):
+    if file_path.lower().endswith('.tif'):
+        return read_raster_metadata(file_path)
+    return read_vector_metadata(file_path)
+
+# catalog entry of one file (a row of process_rows)
+def catalog_row(row, directory):
+    file_path = directory + row['file_name']
+    return [{'file_name': row['file_name'], 'signature': row['signature'], 'version': CATALOG_VERSION, 'metadata': read_metadata(file_path)}]
+
+def load_catalog(catalog_path):
+    try:
+        with open(catalog_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_catalog(catalog_path, catalog):
+    os.makedirs(os.path.dirname(os.path.abspath(catalog_path)), exist_ok=True)
+    with open(catalog_path, 'w') as f:
+        json.dump(catalog, f, indent=1)
+
+# metadata of the files in directory with one of file_extensions, in os.listdir order: {file_name: metadata}
+# catalog_path: JSON file keeping the metadata by path, size and mtime between runs, only new or changed files are opened
+# the files to open are read in max_workers processes
+def scan_directory(directory, file_extensions, catalog_path=None, max_workers=1):
+    catalog = load_catalog(catalog_path) if catalog_path else {}
+    file_names = [file_name for file_name in os.listdir(directory) if file_name.endswith(tuple(file_extensions))]
+
+    entries = {}
+    changed_rows = []
+    for file_name in file_names:
+        file_path = os.path.abspath(directory + file_name)
+        signature = file_signature(directory + file_name)
+        entry = catalog.get(file_path)
+        if entry is not None and entry['signature'] == signature and entry.get('version') == CATALOG_VERSION:
+            entries[file_name] = entry
+        else:
+            changed_rows.append({'file_name': file_name, 'signature': signature})
+
+    for entry in process_rows(catalog_row, changed_rows, (directory,), max_workers):
+        entries[entry['file_name']] = entry
+        catalog[os.path.abspath(directory + entry['file_name'])] = entry
+
+    if catalog_path and changed_rows:
+        save_catalog(catalog_path, catalog)
+
+    return {file_name: entries[file_name]['metadata'] for file_name in file_names if file_name in entries}
@@ -0,0 +1,100 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: GeoTIFF Encoding Profiles and Vector Output Formats
+"""
+
+import os
+import numpy as np
+
+# GeoTIFF creation options of each encoding profile, 'PREDICTOR' is chosen per data type (see get_predictor)
+ENCODING_PROFILES = {
+    # no compression, fastest to write and to read back
+    'uncompressed': {'TILED': 'YES', 'COMPRESS': 'NONE'},
+    # light compression for intermediate files that are re-read right away
+    'intermediate': {'TILED': 'YES', 'COMPRESS': 'DEFLATE', 'ZLEVEL': '1', 'PREDICTOR': 'AUTO'},
+    # compact files for deliverables and archives
+    'archival': {'TILED': 'YES', 'COMPRESS': 'DEFLATE', 'ZLEVEL': '9', 'PREDICTOR': 'AUTO'},
+    # the options previously hardcoded in steps 4-6
+    'legacy': {'TILED': 'YES', 'COMPRESS': 'DEFLATE', 'ZLEVEL': '9', 'PREDICTOR': '1'},
+}
+
+# profile used by each step, overridden with the MCA_ENCODING_<STEP> environment variable (e.g. MCA_ENCODING_STEP5=archival)
+STAGE_PROFILES = {
+    'step4': 'intermediate',
+    'step5': 'intermediate',
+    'step6': 'intermediate',
+    'step7': 'intermediate',
+    'step8': 'archival',
+}
+
+def get_stage_profile(stage):
+    profile_name = os.environ.get('MCA_ENCODING_' + stage.upper(), STAGE_PROFILES.get(stage, 'intermediate'))
+    if profile_name not in ENCODING_PROFILES:
+        raise ValueError(f"Unknown encoding profile '{profile_name}' for {stage}, expected one of {list(ENCODING_PROFILES)}")
+    return profile_name
+
+# floating point predictor (3) for float data, horizontal differencing (2) for integer data
+def get_predictor(dtype):
+    return '3' if np.issubdtype(np.dtype(dtype), np.floating) else '2'
+
+# nbits: bits per sample of a bit-packed uint8 raster (1 for the 0/1 masks), libtiff has no predictor for packed samples
+def get_creation_options(profile_name, dtype, nbits=None):
+    creation_options = dict(ENCODING_PROFILES[profile_name])
+    if creation_options.get('PREDICTOR') == 'AUTO':
+        creation_options['PREDICTOR'] = get_predictor(dtype)
+    if nbits:
+        creation_options['NBITS'] = str(nbits)
+        creation_options.pop('PREDICTOR', None)
+    return creation_options
+
+# creation options as a list for GDAL ('KEY=VALUE')
+def gdal_creation_options(profile_name, dtype, nbits=None):
+    return ['{}={}'.format(key, value) for key, value in get_creation_options(profile_name, dtype, nbits).items()]
+
+# creation options as keyword arguments for rasterio.open
+def rasterio_creation_options(profile_name, dtype, nbits=None):
+    return {key.lower(): value for key, value in get_creation_options(profile_name, dtype, nbits).items()}
+
+# predictor values of the COG driver
+COG_PREDICTORS = {'1': 'NO', '2': 'STANDARD', '3': 'FLOATING_POINT'}
+
+# Cloud-Optimized GeoTIFF creation options of a step, None unless the step is listed in the MCA_COG environment variable (e.g. MCA_COG=step7,step8)
+# the compression of the step's encoding profile is kept, the tiles are MCA_COG_BLOCKSIZE pixels wide (512 by default)
+# and overviews are built down to one tile with the resampling method
+def get_cog_options(stage, dtype, resampling='AVERAGE'):
+    if stage not in [cog_stage.strip() for cog_stage in os.environ.get('MCA_COG', '').split(',')]:
+        return None
+
+    creation_options = get_creation_options(get_stage_profile(stage), dtype)
+    cog_options = {
+        'BLOCKSIZE': os.environ.get('MCA_COG_BLOCKSIZE', '512'),
+        'COMPRESS': creation_options['COMPRESS'],
+        'OVERVIEWS': 'AUTO',
+        'RESAMPLING': resampling,
+        'BIGTIFF': 'IF_SAFER',
+    }
+    if 'ZLEVEL' in creation_options:
+        cog_options['LEVEL'] = creation_options['ZLEVEL']
+    if 'PREDICTOR' in creation_options:
+        cog_options['PREDICTOR'] = COG_PREDICTORS[creation_options['PREDICTOR']]
+    return cog_options
+
+# OGR driver of each vector output format and the extension of its files
+# GeoPackage and FlatGeobuf have no 2 GB / field name limits and are written with a spatial index
+VECTOR_FORMATS = {
+    'GPKG': '.gpkg',
+    'FlatGeobuf': '.fgb',
+    'ESRI Shapefile': '.shp',
+}
+
+# extensions of the vector files written by step3
+VECTOR_EXTENSIONS = list(VECTOR_FORMATS.values())
+
+# vector format written by step3, overridden with the MCA_VECTOR_FORMAT environment variable (e.g. MCA_VECTOR_FORMAT=FlatGeobuf)
+def get_vector_format():
+    vector_format = os.environ.get('MCA_VECTOR_FORMAT', 'GPKG')
+    if vector_format not in VECTOR_FORMATS:
+        raise ValueError(f"Unknown vector format '{vector_format}', expected one of {list(VECTOR_FORMATS)}")
+    return vector_format
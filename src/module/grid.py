@@ -0,0 +1,236 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: AOI Grid Definition and Warping onto the AOI Grid
+"""
+
+import math
+from osgeo import gdal, ogr, osr
+from tracing import traced
+from tuning import gdal_warp_options
+
+# a grid is a dictionary: 'crs' (WKT), 'x_min', 'y_max' (upper left corner), 'pixel_size', 'width', 'height'
+
+def get_spatial_reference(crs):
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(str(crs))
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+# extent of a vector layer (x_min, x_max, y_min, y_max), in target_crs when given
+def get_vector_extent(vector_path, target_crs=None):
+    vector_ds = ogr.Open(vector_path)
+    vector_layer = vector_ds.GetLayer()
+    source_srs = vector_layer.GetSpatialRef()
+
+    if target_crs is None or source_srs is None:
+        return vector_layer.GetExtent()
+
+    source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    target_srs = get_spatial_reference(target_crs)
+    if source_srs.IsSame(target_srs):
+        return vector_layer.GetExtent()
+
+    # reproject the geometries (the AOI is small) and take the extent of the result
+    transformation = osr.CoordinateTransformation(source_srs, target_srs)
+    envelope = None
+    for feature in vector_layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        geometry.Transform(transformation)
+        x_min, x_max, y_min, y_max = geometry.GetEnvelope()
+        if envelope is None:
+            envelope = [x_min, x_max, y_min, y_max]
+        else:
+            envelope = [min(envelope[0], x_min), max(envelope[1], x_max), min(envelope[2], y_min), max(envelope[3], y_max)]
+
+    vector_ds = None
+    return tuple(envelope)
+
+# extent of several vector layers together (x_min, x_max, y_min, y_max), e.g. every AOI of a multi-AOI run
+def get_union_extent(vector_paths, target_crs=None):
+    extents = [get_vector_extent(vector_path, target_crs) for vector_path in vector_paths]
+    return (min(extent[0] for extent in extents), max(extent[1] for extent in extents),
+            min(extent[2] for extent in extents), max(extent[3] for extent in extents))
+
+# grid of a vector layer in the same way as rasterize_vector sizes its output (upper left corner of the extent, truncated pixel count)
+# vector_path: one layer, or a list of layers that share the grid of their union extent
+# margin (in CRS units) extends the grid on every side by a whole number of pixels
+def get_vector_grid(vector_path, pixel_size, target_crs, margin=0):
+    vector_paths = [vector_path] if isinstance(vector_path, str) else vector_path
+    x_min, x_max, y_min, y_max = get_union_extent(vector_paths, target_crs)
+    margin_pixels = int(-(-margin // pixel_size))  # rounded up
+
+    return {
+        'crs': get_spatial_reference(target_crs).ExportToWkt(),
+        'x_min': x_min - margin_pixels * pixel_size,
+        'y_max': y_max + margin_pixels * pixel_size,
+        'pixel_size': pixel_size,
+        'width': int((x_max - x_min) / pixel_size) + 2 * margin_pixels,
+        'height': int((y_max - y_min) / pixel_size) + 2 * margin_pixels,
+    }
+
+# grid of an existing (north-up) raster
+def get_raster_grid(raster_path):
+    raster_ds = gdal.Open(raster_path)
+    if not raster_ds:
+        raise RuntimeError(f"Failed to open raster file: {raster_path}")
+
+    geo_transform = raster_ds.GetGeoTransform()
+    grid = {
+        'crs': raster_ds.GetProjection(),
+        'x_min': geo_transform[0],
+        'y_max': geo_transform[3],
+        'pixel_size': geo_transform[1],
+        'width': raster_ds.RasterXSize,
+        'height': raster_ds.RasterYSize,
+    }
+    raster_ds = None
+    return grid
+
+# grid covering several grids of the same pixel size, aligned with the grid whose upper left corner is the union's
+def get_union_grid(grids):
+    pixel_size = grids[0]['pixel_size']
+    x_min = min(grid['x_min'] for grid in grids)
+    y_max = max(grid['y_max'] for grid in grids)
+    x_max = max(grid['x_min'] + grid['width'] * pixel_size for grid in grids)
+    y_min = min(grid['y_max'] - grid['height'] * pixel_size for grid in grids)
+    return dict(grids[0], x_min=x_min, y_max=y_max, width=int(round((x_max - x_min) / pixel_size)), height=int(round((y_max - y_min) / pixel_size)))
+
+# the cells of a grid that cover an extent (x_min, x_max, y_min, y_max), pixel-aligned with the grid and within it
+def get_subgrid(grid, extent):
+    x_min, x_max, y_min, y_max = extent
+    pixel_size = grid['pixel_size']
+    col_start = max(int(math.floor((x_min - grid['x_min']) / pixel_size)), 0)
+    col_end = min(int(math.ceil((x_max - grid['x_min']) / pixel_size)), grid['width'])
+    row_start = max(int(math.floor((grid['y_max'] - y_max) / pixel_size)), 0)
+    row_end = min(int(math.ceil((grid['y_max'] - y_min) / pixel_size)), grid['height'])
+    return dict(grid, x_min=grid['x_min'] + col_start * pixel_size, y_max=grid['y_max'] - row_start * pixel_size,
+                width=max(col_end - col_start, 1), height=max(row_end - row_start, 1))
+
+def get_grid_geo_transform(grid):
+    return (grid['x_min'], grid['pixel_size'], 0, grid['y_max'], 0, -grid['pixel_size'])
+
+def get_grid_bounds(grid):
+    return (grid['x_min'], grid['y_max'] - grid['height'] * grid['pixel_size'], grid['x_min'] + grid['width'] * grid['pixel_size'], grid['y_max'])
+
+# pixel windows (x_off, y_off, x_size, y_size) covering a width x height raster in tile_size x tile_size tiles, row by row
+def iter_tiles(width, height, tile_size):
+    for y_off in range(0, height, tile_size):
+        for x_off in range(0, width, tile_size):
+            yield (x_off, y_off, min(tile_size, width - x_off), min(tile_size, height - y_off))
+
+# GDAL data types a raster keeps when it is put on the grid (with their numpy names), the values of other types (32-bit integers, 64-bit) are written as Float32
+COMPACT_DATA_TYPES = {gdal.GDT_Byte: 'uint8', gdal.GDT_UInt16: 'uint16', gdal.GDT_Int16: 'int16', gdal.GDT_Float32: 'float32'}
+
+# data type (GDAL) of a raster on the grid and its NBITS (1 for bit-packed masks, None when the samples are whole bytes)
+def get_grid_data_type(raster_path):
+    raster_ds = gdal.Open(raster_path)
+    if not raster_ds:
+        raise RuntimeError(f"Failed to open raster file: {raster_path}")
+
+    band = raster_ds.GetRasterBand(1)
+    data_type = band.DataType if band.DataType in COMPACT_DATA_TYPES else gdal.GDT_Float32
+    nbits = band.GetMetadataItem('NBITS', 'IMAGE_STRUCTURE')
+    raster_ds = None
+
+    return data_type, (int(nbits) if nbits and data_type == gdal.GDT_Byte else None)
+
+# True when the raster has the grid's size and geotransform (no warp is needed to put it on the grid)
+# tolerance is a fraction of the pixel size
+def is_on_grid(raster_path, grid, data_type=None, tolerance=1e-3):
+    raster_ds = gdal.Open(raster_path)
+    if not raster_ds:
+        return False
+
+    same_size = raster_ds.RasterXSize == grid['width'] and raster_ds.RasterYSize == grid['height']
+    geo_transform = raster_ds.GetGeoTransform()
+    same_transform = all(abs(a - b) <= tolerance * grid['pixel_size'] for a, b in zip(geo_transform, get_grid_geo_transform(grid)))
+    same_type = data_type is None or raster_ds.GetRasterBand(1).DataType == data_type
+    raster_ds = None
+
+    return same_size and same_transform and same_type
+
+# pixel window (x_off, y_off, x_size, y_size) of a north-up raster that covers bounds (min_x, min_y, max_x, max_y),
+# snapped outwards to whole pixels and clipped to the raster, None when the bounds do not overlap the raster
+def get_raster_window(raster_path, bounds, tolerance=1e-3):
+    raster_ds = gdal.Open(raster_path)
+    if not raster_ds:
+        return None
+
+    x_origin, pixel_width, _, y_origin, _, pixel_height = raster_ds.GetGeoTransform()
+    x_size, y_size = raster_ds.RasterXSize, raster_ds.RasterYSize
+    raster_ds = None
+
+    min_x, min_y, max_x, max_y = bounds
+    x_start = max(int(math.floor((min_x - x_origin) / pixel_width + tolerance)), 0)
+    x_end = min(int(math.ceil((max_x - x_origin) / pixel_width - tolerance)), x_size)
+    y_start = max(int(math.floor((y_origin - max_y) / -pixel_height + tolerance)), 0)
+    y_end = min(int(math.ceil((y_origin - min_y) / -pixel_height - tolerance)), y_size)
+
+    if x_end <= x_start or y_end <= y_start:
+        return None
+    return (x_start, y_start, x_end - x_start, y_end - y_start)
+
+# pixel offset (x_off, y_off) of the grid inside a raster that has the grid's CRS and pixel size, whose pixels line up with the grid
+# and which covers the whole grid (the grid can then be cut out without resampling), otherwise None
+def get_grid_offset(raster_path, grid, tolerance=1e-3):
+    raster_ds = gdal.Open(raster_path)
+    if not raster_ds:
+        return None
+
+    x_origin, x_pixel_size, x_rotation, y_origin, y_rotation, y_pixel_size = raster_ds.GetGeoTransform()
+    raster_srs = osr.SpatialReference(wkt=raster_ds.GetProjection())
+    x_size, y_size = raster_ds.RasterXSize, raster_ds.RasterYSize
+    raster_ds = None
+
+    pixel_size = grid['pixel_size']
+    if x_rotation != 0 or y_rotation != 0 or abs(x_pixel_size - pixel_size) > tolerance * pixel_size or abs(y_pixel_size + pixel_size) > tolerance * pixel_size:
+        return None
+    if not raster_srs.IsSame(osr.SpatialReference(wkt=grid['crs'])):
+        return None
+
+    x_off = (grid['x_min'] - x_origin) / pixel_size
+    y_off = (y_origin - grid['y_max']) / pixel_size
+    if abs(x_off - round(x_off)) > tolerance or abs(y_off - round(y_off)) > tolerance:
+        return None
+
+    x_off, y_off = int(round(x_off)), int(round(y_off))
+    if x_off < 0 or y_off < 0 or x_off + grid['width'] > x_size or y_off + grid['height'] > y_size:
+        return None
+
+    return x_off, y_off
+
+# cut the grid out of a raster that lines up with it (see get_grid_offset), without warping
+@traced('crop_to_grid')
+def crop_to_grid(input_raster_path, output_raster_path, grid, grid_offset, creation_options, output_type=gdal.GDT_Float32, no_data_value=0):
+    translate_options = gdal.TranslateOptions(
+        format='GTiff',
+        outputType=output_type,
+        srcWin=[grid_offset[0], grid_offset[1], grid['width'], grid['height']],
+        noData=no_data_value,
+        creationOptions=creation_options
+    )
+    gdal.Translate(output_raster_path, input_raster_path, options=translate_options)
+
+# reproject, resample and clip a raster onto the grid in a single warp
+# only the part of the source that covers the grid is read, whatever the size of the source raster
+# stage: the step whose tuning profile (warp threads and memory) the warp takes
+@traced('warp_to_grid')
+def warp_to_grid(input_raster_path, output_raster_path, grid, creation_options, output_type=gdal.GDT_Float32, resampling='near', no_data_value=0, stage='step3'):
+    warp_options = gdal.WarpOptions(
+        format='GTiff',
+        outputType=output_type,
+        dstSRS=grid['crs'],
+        outputBounds=list(get_grid_bounds(grid)),
+        width=grid['width'],
+        height=grid['height'],
+        resampleAlg=resampling,
+        dstNodata=no_data_value,
+        creationOptions=creation_options,
+        **gdal_warp_options(stage)
+    )
+    gdal.Warp(output_raster_path, input_raster_path, options=warp_options)
\ No newline at end of file
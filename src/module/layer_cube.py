@@ -0,0 +1,135 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: Memory-Mapped Layer Cube
+"""
+
+import os
+import json
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+# a layer cube stores the step7 layers of one AOI grid in two files:
+# <cube>.npy  - every layer, tile by tile: (tile rows, tile columns, layers, tile_size, tile_size), read with numpy memory mapping
+# <cube>.json - header: layer names and their step7 fields (AOI, exclusion, layer_weight), nodata, grid (width, height, GDAL geotransform, CRS)
+# a window of all layers is one contiguous block of the file when it is one tile, so the tile size is the step8 block size
+
+def get_cube_paths(cube_path):
+    return cube_path + '.npy', cube_path + '.json'
+
+# write the layers (file paths on the same grid) into a cube, layer_fields: the step7 fields of each layer (JSON serializable)
+def write_layer_cube(cube_path, layer_paths, layer_fields, tile_size=1024):
+    data_path, header_path = get_cube_paths(cube_path)
+    datasets = [rasterio.open(layer_path) for layer_path in layer_paths]
+
+    try:
+        reference = datasets[0]
+        for layer_path, dataset in zip(layer_paths, datasets):
+            if (dataset.width, dataset.height) != (reference.width, reference.height) or dataset.transform != reference.transform:
+                raise ValueError(f"{layer_path} is not on the grid of {layer_paths[0]}")
+
+        # one data type that holds every layer exactly (uint8 when every step7 layer is a score or a mask)
+        dtype = np.result_type(*[dataset.dtypes[0] for dataset in datasets])
+        tiles_y = -(-reference.height // tile_size)
+        tiles_x = -(-reference.width // tile_size)
+
+        cube = np.lib.format.open_memmap(data_path, mode='w+', dtype=dtype, shape=(tiles_y, tiles_x, len(datasets), tile_size, tile_size))
+        for tile_y in range(tiles_y):
+            for tile_x in range(tiles_x):
+                window = Window(tile_x * tile_size, tile_y * tile_size,
+                                min(tile_size, reference.width - tile_x * tile_size), min(tile_size, reference.height - tile_y * tile_size))
+                for i, dataset in enumerate(datasets):
+                    # cells beyond the grid edge stay 0
+                    cube[tile_y, tile_x, i, :window.height, :window.width] = dataset.read(1, window=window)
+        cube.flush()
+        del cube
+
+        header = {
+            'layers': [dict(fields, file_name=os.path.basename(layer_path), nodata=dataset.nodata)
+                       for layer_path, fields, dataset in zip(layer_paths, layer_fields, datasets)],
+            'width': reference.width,
+            'height': reference.height,
+            'geo_transform': list(reference.get_transform()),
+            'crs': reference.crs.to_wkt() if reference.crs else None,
+            'tile_size': tile_size,
+            'dtype': np.dtype(dtype).name,
+        }
+    finally:
+        for dataset in datasets:
+            dataset.close()
+
+    with open(header_path, 'w') as f:
+        json.dump(header, f, indent=1, default=str)
+
+# one layer of an open cube, read like a rasterio dataset band (read(1, window=...), name, nodata, dtypes, profile, width, height)
+class CubeLayer:
+    def __init__(self, cube, index):
+        self.cube = cube
+        self.index = index
+        self.name = cube.layer_names[index]  # file name of the layer
+        self.nodata = cube.header['layers'][index]['nodata']
+        self.dtypes = [cube.header['dtype']]
+        self.width = cube.header['width']
+        self.height = cube.header['height']
+        self.profile = {
+            'driver': 'GTiff',
+            'dtype': cube.header['dtype'],
+            'nodata': self.nodata,
+            'width': self.width,
+            'height': self.height,
+            'count': 1,
+            'crs': cube.header['crs'],
+            'transform': rasterio.Affine.from_gdal(*cube.header['geo_transform']),
+        }
+
+    # a window inside one tile is a read-only view of the mapped file (callers must not modify it), a window across tiles is assembled
+    def read(self, band=1, window=None):
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        return self.cube.read_window(window, self.index)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# a cube mapped read-only: a window inside one tile is a view of the file, nothing is decoded or copied
+class LayerCube:
+    def __init__(self, cube_path):
+        data_path, header_path = get_cube_paths(cube_path)
+        with open(header_path) as f:
+            self.header = json.load(f)
+        self.data = np.load(data_path, mmap_mode='r')
+        self.tile_size = self.header['tile_size']
+        self.layer_names = [layer['file_name'] for layer in self.header['layers']]
+
+    def layer(self, file_name):
+        return CubeLayer(self, self.layer_names.index(file_name))
+
+    # a window of every layer (layers, height, width), or of one layer (height, width) when layer is a layer index
+    def read_window(self, window, layer=None):
+        tile_size = self.tile_size
+        layers = slice(None) if layer is None else layer
+        col_off, row_off, width, height = int(window.col_off), int(window.row_off), int(window.width), int(window.height)
+
+        # inside one tile: a view of the mapped file
+        tile_y, tile_x = row_off // tile_size, col_off // tile_size
+        if (row_off + height - 1) // tile_size == tile_y and (col_off + width - 1) // tile_size == tile_x:
+            y, x = row_off - tile_y * tile_size, col_off - tile_x * tile_size
+            return self.data[tile_y, tile_x, layers, y:y + height, x:x + width]
+
+        # across tiles: the tiles are assembled
+        window_data = np.empty(((self.data.shape[2],) if layer is None else ()) + (height, width), dtype=self.data.dtype)
+        for tile_y in range(row_off // tile_size, (row_off + height - 1) // tile_size + 1):
+            for tile_x in range(col_off // tile_size, (col_off + width - 1) // tile_size + 1):
+                y_start, y_end = max(row_off, tile_y * tile_size), min(row_off + height, (tile_y + 1) * tile_size)
+                x_start, x_end = max(col_off, tile_x * tile_size), min(col_off + width, (tile_x + 1) * tile_size)
+                window_data[..., y_start - row_off:y_end - row_off, x_start - col_off:x_end - col_off] = \
+                    self.data[tile_y, tile_x, layers, y_start - tile_y * tile_size:y_end - tile_y * tile_size, x_start - tile_x * tile_size:x_end - tile_x * tile_size]
+        return window_data
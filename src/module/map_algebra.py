@@ -0,0 +1,256 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: Map Algebra Expressions for the Step8 Aggregation
+"""
+
+import os
+import ast
+import functools
+import numpy as np
+
+# an expression is a Python expression over these names and functions, compiled once and evaluated window by window:
+# weighted_sum()       sum of the scored layers times their layer_weight_rate
+# weighted_product()   product of the scored layers, each raised to its layer_weight_rate
+# geometric_mean()     weighted geometric mean of the scored layers (rates divided by their sum)
+# min(), max()         smallest / largest score of each cell, min(a, b, ...) and max(a, b, ...) of the arguments
+# owa(w1, ..., wn)     ordered weighted average, w1 weighs the smallest score of the cell and wn the largest (one weight per scored layer)
+# where(mask, a, b)    a where mask is true, otherwise b
+# layer('roads')       the layer whose file name starts with 'roads'
+# aoi                  true inside every AOI layer (AOI and FPV/PV masks)
+# exclusion            true inside any exclusion layer
+# nodata               the NoData value of the result
+# operators: + - * / ** (numbers), < <= > >= == != (comparisons), & | ~ (masks)
+
+# the step8 formula: weighted sum inside the AOI and outside the exclusions, values below 1 are NoData
+# (for 0/1 AOI and exclusion layers, as written in steps 4 and 7, the same values as multiplying by the AOI and by 1 - exclusion)
+DEFAULT_EXPRESSION = 'where(aoi & ~exclusion & (weighted_sum() >= 1), weighted_sum(), nodata)'
+
+ARITHMETIC_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+}
+
+MASK_OPERATORS = {
+    ast.BitAnd: np.logical_and,
+    ast.BitOr: np.logical_or,
+}
+
+COMPARE_OPERATORS = {
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+}
+
+# type a layer is multiplied with its weight rate in: float32 for the uint8/int16/uint16/float32 layers (the product of the float32 score layers of earlier runs),
+# the weighted sum stays float64, so the same cells fall below the threshold of 1
+def get_product_dtype(dtype):
+    return np.promote_types(dtype, np.float32)
+
+# integer and mask arrays take part in arithmetic as float32 (exact for 8/16-bit values), so unsigned values cannot wrap around
+def as_number(value):
+    if isinstance(value, np.ndarray) and value.dtype.kind in 'biu':
+        return value.astype(get_product_dtype(value.dtype))
+    return value
+
+# the layers of one window, each layer is read the first time the expression uses it
+# a window with its NoData cells set to 0, copied only when it has any: the window that was read is not modified
+# (a layer cube window is a read-only view of the mapped file, see layer_cube.py)
+def zero_nodata(value, nodata):
+    if nodata is None or nodata == 0:
+        return value
+    nodata_cells = value == nodata
+    if not nodata_cells.any():
+        return value
+    value = value.copy()
+    value[nodata_cells] = 0
+    return value
+
+class WindowLayers:
+    # scored_layers: (file name, dataset) of the layers with a layer_weight_rate, aoi_layers / exclusion_layers: (file name, dataset)
+    def __init__(self, window, scored_layers, aoi_layers, exclusion_layers, no_data_value=0):
+        self.window = window
+        self.scored_layers = scored_layers
+        self.aoi_layers = aoi_layers
+        self.exclusion_layers = exclusion_layers
+        self.no_data_value = no_data_value
+        self.arrays = {}
+
+    # a layer's window with its NoData cells set to 0 (a scored layer then adds nothing, an exclusion layer excludes nothing)
+    def read(self, dataset):
+        if id(dataset) not in self.arrays:
+            self.arrays[id(dataset)] = zero_nodata(dataset.read(1, window=self.window), dataset.nodata)
+        return self.arrays[id(dataset)]
+
+    def scores(self):
+        if not self.scored_layers:
+            raise ValueError("The expression uses the scored layers, but there is no layer with a layer_weight")
+        return [self.read(dataset) for file_name, dataset in self.scored_layers]
+
+    def aoi(self):
+        mask = None
+        for file_name, dataset in self.aoi_layers:
+            mask = self.read(dataset) != 0 if mask is None else mask & (self.read(dataset) != 0)
+        return mask if mask is not None else True
+
+    def exclusion(self):
+        mask = None
+        for file_name, dataset in self.exclusion_layers:
+            mask = self.read(dataset) != 0 if mask is None else mask | (self.read(dataset) != 0)
+        return mask if mask is not None else False
+
+    # the layer whose file name is name or starts with it
+    def layer(self, name):
+        layers = self.scored_layers + self.aoi_layers + self.exclusion_layers
+        matches = {file_name: dataset for file_name, dataset in layers if file_name == name or file_name.startswith(name)}
+        if len(matches) != 1:
+            raise ValueError(f"layer('{name}') matches {len(matches)} layers {list(matches)}, expected exactly one")
+        return self.read(next(iter(matches.values())))
+
+# aggregation functions over the scored layers, rates: layer_weight_rate of each scored layer
+def weighted_sum(layers, rates):
+    result = np.zeros(layers.scores()[0].shape)
+    for value, rate in zip(layers.scores(), rates):
+        result += np.multiply(value, rate, dtype=get_product_dtype(value.dtype))
+    return result
+
+def weighted_product(layers, rates):
+    result = np.ones(layers.scores()[0].shape)
+    for value, rate in zip(layers.scores(), rates):
+        result *= np.power(value, rate, dtype=np.float64)
+    return result
+
+def geometric_mean(layers, rates):
+    rate_sum = float(np.sum(rates))
+    return weighted_product(layers, [rate / rate_sum for rate in rates])
+
+def owa(layers, rates, *order_weights):
+    scores = layers.scores()
+    if len(order_weights) != len(scores):
+        raise ValueError(f"owa() takes one weight per scored layer ({len(scores)}), got {len(order_weights)}")
+    ordered = np.sort(np.stack(scores), axis=0)  # smallest score first
+    result = np.zeros(scores[0].shape)
+    for value, order_weight in zip(ordered, order_weights):
+        result += value * order_weight
+    return result
+
+def layer_min(layers, rates, *arguments):
+    return functools.reduce(np.minimum, arguments if arguments else layers.scores())
+
+def layer_max(layers, rates, *arguments):
+    return functools.reduce(np.maximum, arguments if arguments else layers.scores())
+
+def where(layers, rates, mask, a, b):
+    return np.where(mask, a, b)
+
+# functions of the expression language: name -> function(layers, rates, *arguments)
+FUNCTIONS = {
+    'weighted_sum': weighted_sum,
+    'weighted_product': weighted_product,
+    'geometric_mean': geometric_mean,
+    'owa': owa,
+    'min': layer_min,
+    'max': layer_max,
+    'where': where,
+}
+
+NAMES = {
+    'aoi': lambda layers, rates: layers.aoi(),
+    'exclusion': lambda layers, rates: layers.exclusion(),
+    'nodata': lambda layers, rates: layers.no_data_value,
+}
+
+# compiled node: function (layers, rates, cache) -> array or number, repeated subexpressions are evaluated once per window (cache)
+def compile_node(node):
+    key = ast.dump(node)
+
+    def cached(evaluate):
+        def evaluate_cached(layers, rates, cache):
+            if key not in cache:
+                cache[key] = evaluate(layers, rates, cache)
+            return cache[key]
+        return evaluate_cached
+
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return lambda layers, rates, cache: node.value
+
+    if isinstance(node, ast.Name):
+        if node.id not in NAMES:
+            raise ValueError(f"Unknown name '{node.id}' in the expression, expected one of {list(NAMES)}")
+        name_function = NAMES[node.id]
+        return cached(lambda layers, rates, cache: name_function(layers, rates))
+
+    if isinstance(node, ast.BinOp) and type(node.op) in ARITHMETIC_OPERATORS:
+        operator = ARITHMETIC_OPERATORS[type(node.op)]
+        left, right = compile_node(node.left), compile_node(node.right)
+        return cached(lambda layers, rates, cache: operator(as_number(left(layers, rates, cache)), as_number(right(layers, rates, cache))))
+
+    if isinstance(node, ast.BinOp) and type(node.op) in MASK_OPERATORS:
+        operator = MASK_OPERATORS[type(node.op)]
+        left, right = compile_node(node.left), compile_node(node.right)
+        return cached(lambda layers, rates, cache: operator(left(layers, rates, cache), right(layers, rates, cache)))
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        operand = compile_node(node.operand)
+        return cached(lambda layers, rates, cache: np.negative(as_number(operand(layers, rates, cache))))
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+        operand = compile_node(node.operand)
+        return cached(lambda layers, rates, cache: np.logical_not(operand(layers, rates, cache)))
+
+    # a < b <= c is (a < b) & (b <= c)
+    if isinstance(node, ast.Compare) and all(type(op) in COMPARE_OPERATORS for op in node.ops):
+        operands = [compile_node(operand) for operand in [node.left] + node.comparators]
+        operators = [COMPARE_OPERATORS[type(op)] for op in node.ops]
+
+        def compare(layers, rates, cache):
+            values = [operand(layers, rates, cache) for operand in operands]
+            result = True
+            for operator, left, right in zip(operators, values[:-1], values[1:]):
+                result = np.logical_and(result, operator(left, right))
+            return result
+        return cached(compare)
+
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+        if node.func.id == 'layer':
+            if len(node.args) != 1 or not isinstance(node.args[0], ast.Constant) or not isinstance(node.args[0].value, str):
+                raise ValueError("layer() takes one file name in quotes, e.g. layer('roads')")
+            name = node.args[0].value
+            return cached(lambda layers, rates, cache: layers.layer(name))
+
+        if node.func.id not in FUNCTIONS:
+            raise ValueError(f"Unknown function '{node.func.id}' in the expression, expected one of {list(FUNCTIONS) + ['layer']}")
+        function = FUNCTIONS[node.func.id]
+        arguments = [compile_node(argument) for argument in node.args]
+        return cached(lambda layers, rates, cache: function(layers, rates, *[argument(layers, rates, cache) for argument in arguments]))
+
+    raise ValueError(f"'{ast.unparse(node)}' is not allowed in an expression")
+
+# compile an expression into a window kernel: kernel(layers, rates) -> result array of the window
+# only the names, functions and operators listed above are accepted, nothing else of Python is evaluated
+def compile_expression(expression):
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"Invalid expression '{expression}': {e.msg}")
+    root = compile_node(tree.body)
+
+    def kernel(layers, rates):
+        result = np.asarray(root(layers, rates, {}))
+        # mask results are numbers (1/0), constants fill the window
+        if result.dtype == bool:
+            result = result.astype(np.float64)
+        return np.broadcast_to(result, (int(layers.window.height), int(layers.window.width)))
+
+    return kernel
+
+# expression of the step8 aggregation, overridden with the MCA_EXPRESSION environment variable
+def get_expression():
+    return os.environ.get('MCA_EXPRESSION', DEFAULT_EXPRESSION)
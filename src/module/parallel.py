@@ -0,0 +1,51 @@
+"""
+Created by Chungkang Choi
+April 2024
+
+Description: Run Per-File Jobs in Parallel
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# number of worker processes used by the steps, overridden with the MCA_MAX_WORKERS environment variable (0 uses every core)
+def get_max_workers(default=1):
+    max_workers = int(os.environ.get('MCA_MAX_WORKERS', default))
+    return max_workers if max_workers > 0 else os.cpu_count()
+
+# run row_function(row, *args) for each row and return the processed file rows in the order of the input rows
+# a failed row is reported and skipped, the rest of the batch keeps running
+def process_rows(row_function, rows, args=(), max_workers=1):
+    processed_files = []
+
+    # sequential execution in this process
+    if max_workers == 1 or len(rows) <= 1:
+        for row in rows:
+            try:
+                processed_files.extend(row_function(row, *args))
+            except Exception as e:
+                print(f"Failed to process {row['file_name']}: {e}")
+        return processed_files
+
+    # jobs are submitted in row order and collected in the same order, so the output does not depend on scheduling
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(row_function, row, *args) for row in rows]
+        for row, future in zip(rows, futures):
+            try:
+                processed_files.extend(future.result())
+            except Exception as e:
+                print(f"Failed to process {row['file_name']}: {e}")
+
+    return processed_files
+
+# results of function(*args) for each args tuple of args_list, in the order of args_list, computed on the executor
+# at most max_pending jobs run ahead of the result being collected, so a caller writing tiles as they come holds only a few of them in memory
+def map_ordered(executor, function, args_list, max_pending):
+    pending = deque()
+    for args in args_list:
+        pending.append(executor.submit(function, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
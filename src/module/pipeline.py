@@ -0,0 +1,267 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: Run Steps 2-8 as One Pipeline
+"""
+
+import os
+import argparse
+import importlib
+import pandas as pd
+from parallel import get_max_workers
+from tracing import trace_stage, enable_tracing, tracing_enabled, write_run_report
+
+# module of each step, a step module (and the GIS libraries it uses) is only imported when the step runs
+STEP_MODULES = {
+    2: 'step2_create_excel_template',
+    3: 'step3_convert_CRS',
+    4: 'step4_rasterize_vector_equalize_resolution',
+    5: 'step5_calculate_proximity',
+    6: 'step6_clip_extend',
+    7: 'step7_calculate_range',
+    8: 'step8_calculate_result',
+}
+
+# input directory of each step
+STEP_INPUTS = {2: 'step1', 3: 'step1', 4: 'step3', 5: 'step4', 6: 'step5', 7: 'step6', 8: 'step7'}
+
+# fields that are filled in by hand in the Excel template created by a step: settings column -> template column
+# 'FPV' is the 'AOI' field of the GLOBathy layer in step6_excel_template.xlsx
+SETTING_COLUMNS = {
+    2: {'target_CRS': 'target_CRS', 'target_resolution(m)': 'target_resolution(m)', 'AOI': 'AOI'},
+    4: {'AOI': 'AOI', 'exclusion': 'exclusion', 'proximity': 'proximity', 'max_distance(m)': 'max_distance(m)'},
+    6: {'FPV': 'AOI', 'most_suitable': 'most_suitable', 'suitable': 'suitable', 'least_suitable': 'least_suitable',
+        'exclusive_range': 'exclusive_range', 'layer_weight': 'layer_weight'},
+}
+
+# flag columns compared with 1 by the steps, read back from Excel as numbers
+FLAG_COLUMNS = ['AOI', 'exclusion', 'proximity', 'layer_weight']
+
+def get_data_path(data_root, directory):
+    return os.path.join(data_root, directory, '')
+
+def get_excel_template_path(data_root, step):
+    return os.path.join(data_root, 'setting_excel', 'step{}_excel_template.xlsx'.format(step))
+
+# fill the hand-entered fields of a step's file list from the settings table
+# each file takes the settings row of the step1 file it was derived from (longest matching file name),
+# a settings row with file_name '*' applies to every file, and cells that already have a value are kept
+def apply_settings(df_files, df_settings, step):
+    df_files = df_files.copy()
+    setting_stems = [os.path.splitext(str(file_name))[0] for file_name in df_settings['file_name']]
+
+    for settings_column, template_column in SETTING_COLUMNS[step].items():
+        if settings_column not in df_settings.columns:
+            continue
+        if template_column not in df_files.columns:
+            df_files[template_column] = None
+        df_files[template_column] = df_files[template_column].astype(object)
+
+        for idx, row in df_files.iterrows():
+            # exclusion copies of a layer take no suitability criteria
+            if step == 6 and row.get('exclusion') == 1:
+                continue
+
+            # the value of the matching file, otherwise the value of the '*' row
+            file_stem = os.path.splitext(row['file_name'])[0]
+            matches = sorted([i for i, stem in enumerate(setting_stems) if file_stem == stem or file_stem.startswith(stem + '_')], key=lambda i: -len(setting_stems[i]))
+            matches = matches[:1] + [i for i, stem in enumerate(setting_stems) if stem == '*']
+            values = [df_settings.iloc[i][settings_column] for i in matches if pd.notnull(df_settings.iloc[i][settings_column])]
+
+            if values and pd.isnull(row[template_column]):
+                df_files.at[idx, template_column] = values[0]
+
+    return df_files
+
+# without a settings table, the hand-entered fields are kept from the existing Excel template of the step (matched by file_name)
+def apply_excel_template(df_files, excel_template_path, step):
+    if not os.path.exists(excel_template_path):
+        return df_files
+
+    with trace_stage('read_excel', excel_template_path):
+        df_template = pd.read_excel(excel_template_path).drop_duplicates('file_name').set_index('file_name')
+    df_files = df_files.copy()
+
+    for template_column in SETTING_COLUMNS[step].values():
+        if template_column not in df_template.columns:
+            continue
+        if template_column not in df_files.columns:
+            df_files[template_column] = None
+        template_values = df_files['file_name'].map(df_template[template_column])
+        df_files[template_column] = df_files[template_column].astype(object).where(df_files[template_column].notnull(), template_values)
+
+    return df_files
+
+# the hand-entered fields of a step's file list, from the settings table or else from the step's Excel template in data_root
+def fill_settings(df_files, step, df_settings, data_root):
+    if step in SETTING_COLUMNS:
+        if df_settings is not None:
+            df_files = apply_settings(df_files, df_settings, step)
+        else:
+            df_files = apply_excel_template(df_files, get_excel_template_path(data_root, step), step)
+
+    # same flag values as after saving and reading the Excel template ('1' -> 1)
+    for column in FLAG_COLUMNS:
+        if column in df_files.columns:
+            df_files[column] = pd.to_numeric(df_files[column], errors='coerce')
+
+    return df_files
+
+def run_step(step, df_files, data_root, max_workers=1, block_size=1024, fused_raster_warp=False, aoi_grid_margin=None, proximity_engine='gdal',
+             vector_format='GPKG', aoi_filter_margin=None, df_scenarios=None, scenario_output='bands', layer_cube=False, proximity_dtype='float32',
+             expression=None):
+    module = importlib.import_module(STEP_MODULES[step])
+    input_path = get_data_path(data_root, STEP_INPUTS[step])
+    output_path = get_data_path(data_root, 'step{}'.format(step))
+
+    os.makedirs(output_path, exist_ok=True)
+
+    if step == 2:
+        return pd.DataFrame(module.get_file_list(input_path, ['.tif', '.shp', '.geojson'], os.path.join(output_path, 'step1_catalog.json'), max_workers))
+
+    if step == 3:
+        return pd.DataFrame(module.process_files(df_files, input_path, output_path, max_workers, fused_raster_warp, vector_format, aoi_filter_margin))
+    if step == 4:
+        return pd.DataFrame(module.process_files(df_files, input_path, output_path, max_workers, aoi_grid_margin))
+    if step == 5:
+        return pd.DataFrame(module.process_files(df_files, input_path, output_path, max_workers, proximity_engine, get_data_path(data_root, 'step3'), proximity_dtype,
+                                                 vector_format))
+    if step == 6:
+        return pd.DataFrame(module.process_files(df_files, input_path, output_path, max_workers))
+    if step == 7:
+        return pd.DataFrame(module.process_files(df_files, input_path, output_path, layer_cube, max_workers, cube_tile_size=block_size or 1024))
+
+    layer_cube_path = os.path.join(input_path, 'layer_cube') if layer_cube else None
+    expression = expression or module.DEFAULT_EXPRESSION
+    module.calculate_result(df_files, input_path, output_path, block_size, layer_cube_path, expression, max_workers)
+    if df_scenarios is not None:
+        module.calculate_scenarios(df_files, df_scenarios, input_path, output_path, block_size, scenario_output, layer_cube_path, expression, max_workers)
+    return None
+
+# run the steps in one process, the file list of each step is passed to the next one in memory
+# df_settings: hand-entered fields (see SETTING_COLUMNS) keyed by step1 file name, None keeps the fields already filled in the Excel templates
+# write_excel: also save every step's file list as data/setting_excel/stepN_excel_template.xlsx
+# fused_raster_warp: rasters are warped onto the AOI grid once in step3 instead of in steps 3, 4 and 6
+# aoi_grid_margin: vectors are rasterized in step4 onto the AOI grid extended by this margin (CRS units), None keeps each layer's own extent
+# proximity_engine: 'gdal', 'edt' (tiled exact distance transform) or 'vector' (distance to the step3 vectors) for step5
+# vector_format: OGR driver of the step3 vectors, aoi_filter_margin: step3 keeps only the vector features within this distance of the AOI
+# df_scenarios: weight sets evaluated in one pass in step8 (see step8 calculate_scenarios), written as bands or files (scenario_output)
+# layer_cube: step7 also writes its layers as one memory-mapped layer cube, which step8 reads instead of the GeoTIFFs
+# proximity_dtype: 'float32' or 'uint16' (distances rounded to whole metres) for the step5 proximity rasters
+# expression: map algebra expression of the step8 aggregation (see map_algebra.py), None keeps the weighted sum
+# trace_path: directory for the per-stage trace records, run_report.json and trace.json (see tracing.py), None keeps MCA_TRACE
+def run_pipeline(data_root='data', steps=range(2, 9), df_settings=None, write_excel=True, max_workers=1, block_size=1024, fused_raster_warp=False,
+                 aoi_grid_margin=None, proximity_engine='gdal', vector_format='GPKG', aoi_filter_margin=None, df_scenarios=None, scenario_output='bands',
+                 layer_cube=False, proximity_dtype='float32', expression=None, trace_path=None):
+    steps = list(steps)
+    if trace_path:
+        enable_tracing(trace_path)
+
+    # a pipeline that starts after step 2 continues from the Excel template of the previous step
+    df_files = None
+    if steps[0] > 2:
+        with trace_stage('read_excel', get_excel_template_path(data_root, steps[0] - 1)):
+            df_files = pd.read_excel(get_excel_template_path(data_root, steps[0] - 1))
+
+    for step in steps:
+        print(f"Step {step}: {STEP_MODULES[step]}")
+        with trace_stage('step{}'.format(step)):
+            df_files = run_step(step, df_files, data_root, max_workers=max_workers, block_size=block_size, fused_raster_warp=fused_raster_warp,
+                                aoi_grid_margin=aoi_grid_margin, proximity_engine=proximity_engine, vector_format=vector_format,
+                                aoi_filter_margin=aoi_filter_margin, df_scenarios=df_scenarios, scenario_output=scenario_output,
+                                layer_cube=layer_cube, proximity_dtype=proximity_dtype, expression=expression)
+
+        if df_files is None:
+            continue
+
+        df_files = fill_settings(df_files, step, df_settings, data_root)
+
+        if write_excel:
+            os.makedirs(os.path.join(data_root, 'setting_excel'), exist_ok=True)
+            with trace_stage('write_excel', get_excel_template_path(data_root, step)):
+                df_files.to_excel(get_excel_template_path(data_root, step), index=False)
+
+    if tracing_enabled():
+        write_run_report()
+
+    return df_files
+
+# batch mode: steps 2-5 prepare every layer once over the union of the AOIs, then steps 6-8 run for each site
+# (every feature of the AOI layers) on max_workers processes, in data/sites/<site>, see sites.py
+# site_field: attribute of the AOI layers naming the sites, None names them <AOI layer>_<feature id>
+def run_batch(data_root='data', df_settings=None, write_excel=True, max_workers=1, block_size=1024, site_field=None, fused_raster_warp=False,
+              aoi_grid_margin=None, proximity_engine='gdal', vector_format='GPKG', aoi_filter_margin=None, layer_cube=False, proximity_dtype='float32',
+              expression=None, trace_path=None):
+    # without an AOI grid margin (and the fused warp for rasters) the step5 layers are not pixel-aligned with the AOI grid,
+    # and every site resamples its window out of them in step6 (see step6 clip_row)
+    if aoi_grid_margin is None or not fused_raster_warp:
+        print("Batch mode without --aoi-grid-margin and --fused-warp: the sites are clipped from the shared layers with resampling")
+
+    df_files = run_pipeline(data_root, range(2, 6), df_settings=df_settings, write_excel=write_excel, max_workers=max_workers, block_size=block_size,
+                            fused_raster_warp=fused_raster_warp, aoi_grid_margin=aoi_grid_margin, proximity_engine=proximity_engine,
+                            vector_format=vector_format, aoi_filter_margin=aoi_filter_margin, proximity_dtype=proximity_dtype, trace_path=trace_path)
+
+    # imported here, sites.py uses the settings functions of this module
+    sites = importlib.import_module('sites')
+    df_summary = sites.process_sites(df_files, data_root, df_settings=df_settings, write_excel=write_excel, max_workers=max_workers,
+                                     block_size=block_size, site_field=site_field, layer_cube=layer_cube, expression=expression,
+                                     vector_format=vector_format)
+
+    if tracing_enabled():
+        write_run_report()
+
+    return df_summary
+
+def parse_steps(steps_str):
+    if '-' in steps_str:
+        first, last = steps_str.split('-')
+        return range(int(first), int(last) + 1)
+    return [int(step) for step in steps_str.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the MCA steps 2-8 in a single process')
+    parser.add_argument('--data-root', default='data', help='directory containing step1 ... step8 and setting_excel')
+    parser.add_argument('--steps', default='2-8', help="steps to run, e.g. '2-8' or '7,8'")
+    parser.add_argument('--settings', help='Excel/CSV file with the hand-entered fields per step1 file_name')
+    parser.add_argument('--no-excel', action='store_true', help='do not write the stepN_excel_template.xlsx files')
+    parser.add_argument('--workers', type=int, default=get_max_workers(), help='parallel worker processes for steps 3-8 (0 uses every core)')
+    parser.add_argument('--block-size', type=int, default=1024, help='window size of the step8 calculation')
+    parser.add_argument('--fused-warp', action='store_true', help='warp rasters onto the AOI grid once in step3')
+    parser.add_argument('--aoi-grid-margin', type=float, help='rasterize vectors in step4 onto the AOI grid extended by this margin (CRS units)')
+    parser.add_argument('--proximity-engine', choices=['gdal', 'edt', 'vector'], default='gdal', help='step5 proximity engine')
+    parser.add_argument('--proximity-dtype', choices=['float32', 'uint16'], default='float32', help='data type of the step5 proximity rasters (uint16: whole metres)')
+    parser.add_argument('--vector-format', choices=['GPKG', 'FlatGeobuf', 'ESRI Shapefile'], default='GPKG', help='format of the step3 vectors')
+    parser.add_argument('--aoi-filter-margin', type=float, help='keep only the vector features within this distance of the AOI in step3 (CRS units)')
+    parser.add_argument('--scenarios', help="Excel/CSV file with a 'scenario' column and one weight column per scored layer, evaluated in step8")
+    parser.add_argument('--scenario-output', choices=['bands', 'files'], default='bands', help='one multi-band MCA_scenarios.tif or one MCA_result_<scenario>.tif per scenario')
+    parser.add_argument('--expression', help="step8 aggregation as a map algebra expression, e.g. 'where(aoi & ~exclusion, geometric_mean(), nodata)'")
+    parser.add_argument('--layer-cube', action='store_true', help='pass the step7 layers to step8 as one memory-mapped layer cube')
+    parser.add_argument('--batch', action='store_true', help='run steps 2-5 over the union of the AOIs, then steps 6-8 for each AOI feature (site)')
+    parser.add_argument('--site-field', help='attribute of the AOI layers naming the sites in batch mode')
+    parser.add_argument('--trace', help='directory for the per-stage trace records, run_report.json and trace.json')
+    args = parser.parse_args()
+
+    df_settings = None
+    if args.settings:
+        df_settings = pd.read_csv(args.settings) if args.settings.lower().endswith('.csv') else pd.read_excel(args.settings)
+
+    df_scenarios = None
+    if args.scenarios:
+        df_scenarios = pd.read_csv(args.scenarios) if args.scenarios.lower().endswith('.csv') else pd.read_excel(args.scenarios)
+
+    if args.batch:
+        run_batch(args.data_root, df_settings=df_settings, write_excel=not args.no_excel, max_workers=args.workers or os.cpu_count(),
+                  block_size=args.block_size, site_field=args.site_field, fused_raster_warp=args.fused_warp, aoi_grid_margin=args.aoi_grid_margin,
+                  proximity_engine=args.proximity_engine, vector_format=args.vector_format, aoi_filter_margin=args.aoi_filter_margin,
+                  layer_cube=args.layer_cube, proximity_dtype=args.proximity_dtype, expression=args.expression, trace_path=args.trace)
+        return
+
+    run_pipeline(args.data_root, parse_steps(args.steps), df_settings=df_settings, write_excel=not args.no_excel, max_workers=args.workers or os.cpu_count(),
+                 block_size=args.block_size, fused_raster_warp=args.fused_warp, aoi_grid_margin=args.aoi_grid_margin,
+                 proximity_engine=args.proximity_engine, vector_format=args.vector_format, aoi_filter_margin=args.aoi_filter_margin,
+                 df_scenarios=df_scenarios, scenario_output=args.scenario_output, layer_cube=args.layer_cube,
+                 proximity_dtype=args.proximity_dtype, expression=args.expression, trace_path=args.trace)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,154 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: Tiled Euclidean Distance Transform Proximity and Vector-Native Proximity
+"""
+
+import math
+import numpy as np
+import shapely
+import geopandas as gpd
+from osgeo import gdal
+from scipy.ndimage import distance_transform_edt
+from concurrent.futures import ProcessPoolExecutor
+from grid import iter_tiles
+from parallel import map_ordered
+
+# value written beyond the max distance, the same value gdal.ComputeProximity writes when the output band has no nodata
+PROXIMITY_NO_DATA = 65535
+
+# number of pixels within max_distance of a pixel, plus one
+def get_halo_pixels(max_distance, pixel_width, pixel_height):
+    return int(math.ceil(max_distance / min(pixel_width, pixel_height))) + 1
+
+# exact distance (in CRS units, between pixel centres) from every pixel of the tile to the nearest target pixel
+# the tile is read with a halo of max_distance on every side, any target within max_distance of a tile pixel lies inside the halo,
+# so the result equals a distance transform of the whole raster wherever the distance is <= max_distance
+def proximity_tile(input_raster_path, tile, max_distance, target_value=1):
+    x_off, y_off, x_size, y_size = tile
+
+    src_ds = gdal.Open(input_raster_path, gdal.GA_ReadOnly)
+    geo_transform = src_ds.GetGeoTransform()
+    pixel_width, pixel_height = abs(geo_transform[1]), abs(geo_transform[5])
+
+    # halo in pixels, clipped to the raster
+    halo = get_halo_pixels(max_distance, pixel_width, pixel_height)
+    read_x_off, read_y_off = max(x_off - halo, 0), max(y_off - halo, 0)
+    read_x_end = min(x_off + x_size + halo, src_ds.RasterXSize)
+    read_y_end = min(y_off + y_size + halo, src_ds.RasterYSize)
+    data = src_ds.GetRasterBand(1).ReadAsArray(read_x_off, read_y_off, read_x_end - read_x_off, read_y_end - read_y_off)
+    src_ds = None
+
+    targets = data == target_value
+    if not targets.any():
+        return np.full((y_size, x_size), PROXIMITY_NO_DATA, dtype=np.float32)
+
+    # distance_transform_edt measures the distance to the nearest zero, the targets are the zeros
+    distance = distance_transform_edt(~targets, sampling=(pixel_height, pixel_width))
+    distance = distance[y_off - read_y_off:y_off - read_y_off + y_size, x_off - read_x_off:x_off - read_x_off + x_size]
+    distance[distance > max_distance] = PROXIMITY_NO_DATA
+
+    return distance.astype(np.float32)
+
+# drop-in alternative to gdal.ComputeProximity(..., ['MAXDIST=max_distance', 'VALUES=1', 'DISTUNITS=GEO']) on an output band
+# window (x_off, y_off, x_size, y_size): only this part of the raster is computed and written to out_band (of the window's size)
+# the tiles are computed in max_workers processes and written by this process in tile order, at most 2 * max_workers tiles are pending
+def compute_proximity_edt(input_raster_path, out_band, max_distance, tile_size=1024, max_workers=1, window=None):
+    if window is None:
+        src_ds = gdal.Open(input_raster_path, gdal.GA_ReadOnly)
+        window = (0, 0, src_ds.RasterXSize, src_ds.RasterYSize)
+        src_ds = None
+
+    x_off, y_off, x_size, y_size = window
+    tiles = [(x_off + tile[0], y_off + tile[1], tile[2], tile[3]) for tile in iter_tiles(x_size, y_size, tile_size)]
+
+    args = ([input_raster_path] * len(tiles), tiles, [max_distance] * len(tiles))
+
+    if max_workers == 1 or len(tiles) <= 1:
+        results = map(proximity_tile, *args)
+        for tile, distance in zip(tiles, results):
+            out_band.WriteArray(distance, tile[0] - x_off, tile[1] - y_off)
+        return
+
+    # at most 2 tiles per worker are pending, so only a few tiles with their halo are held in memory at a time
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for tile, distance in zip(tiles, map_ordered(executor, proximity_tile, zip(*args), 2 * max_workers)):
+            out_band.WriteArray(distance, tile[0] - x_off, tile[1] - y_off)
+
+# gdal.ComputeProximity over a window of the raster, read with a halo of max_distance around the window
+# targets outside the halo are farther than max_distance from every pixel of the window, so the window gets the same values as from the whole raster
+def compute_proximity_gdal_window(input_raster_path, out_band, max_distance, window):
+    src_ds = gdal.Open(input_raster_path, gdal.GA_ReadOnly)
+    geo_transform = src_ds.GetGeoTransform()
+    halo = get_halo_pixels(max_distance, abs(geo_transform[1]), abs(geo_transform[5]))
+
+    x_off, y_off, x_size, y_size = window
+    read_x_off, read_y_off = max(x_off - halo, 0), max(y_off - halo, 0)
+    read_x_size = min(x_off + x_size + halo, src_ds.RasterXSize) - read_x_off
+    read_y_size = min(y_off + y_size + halo, src_ds.RasterYSize) - read_y_off
+
+    # the window with its halo as a virtual raster (nothing is copied) and an in-memory proximity band of the same size
+    halo_ds = gdal.Translate('', src_ds, options=gdal.TranslateOptions(format='VRT', srcWin=[read_x_off, read_y_off, read_x_size, read_y_size]))
+    proximity_ds = gdal.GetDriverByName('MEM').Create('', read_x_size, read_y_size, 1, gdal.GDT_Float32)
+    proximity_ds.SetGeoTransform(halo_ds.GetGeoTransform())
+    proximity_ds.SetProjection(halo_ds.GetProjectionRef())
+
+    options = ['MAXDIST={}'.format(max_distance), 'VALUES=1', 'DISTUNITS=GEO']
+    gdal.ComputeProximity(halo_ds.GetRasterBand(1), proximity_ds.GetRasterBand(1), options)
+
+    out_band.WriteArray(proximity_ds.GetRasterBand(1).ReadAsArray(x_off - read_x_off, y_off - read_y_off, x_size, y_size))
+
+    src_ds = halo_ds = proximity_ds = None
+
+# spatial index of the vector features, built once per worker process by init_vector_worker
+_vector_tree = None
+
+# features of the vector layer within bounds (min_x, min_y, max_x, max_y) in an STRtree
+def load_vector_tree(vector_path, bounds):
+    geometries = gpd.read_file(vector_path, bbox=bounds).geometry
+    geometries = geometries[geometries.notnull() & ~geometries.is_empty]
+    return shapely.STRtree(np.asarray(geometries.values))
+
+def init_vector_worker(vector_path, bounds):
+    global _vector_tree
+    _vector_tree = load_vector_tree(vector_path, bounds)
+
+# distance from the centre of every cell of the block to the nearest feature (0 inside polygons), PROXIMITY_NO_DATA beyond max_distance
+def vector_proximity_block(grid, block, max_distance):
+    x_off, y_off, x_size, y_size = block
+    pixel_size = grid['pixel_size']
+
+    x_centres = grid['x_min'] + (x_off + np.arange(x_size) + 0.5) * pixel_size
+    y_centres = grid['y_max'] - (y_off + np.arange(y_size) + 0.5) * pixel_size
+    x_centres, y_centres = np.meshgrid(x_centres, y_centres)
+    points = shapely.points(x_centres.ravel(), y_centres.ravel())
+
+    distance = np.full(points.size, PROXIMITY_NO_DATA, dtype=np.float32)
+    # one batched nearest query per block, cells without a feature within max_distance are not returned
+    (point_indices, feature_indices), distances = _vector_tree.query_nearest(points, max_distance=max_distance, return_distance=True, all_matches=False)
+    distance[point_indices] = distances
+
+    return distance.reshape(y_size, x_size)
+
+# proximity of the cells of grid (see grid.py) to the features of a vector layer in the grid's CRS, written to out_band
+# features farther than max_distance from the grid cannot change any cell and are not read
+# the blocks are computed in max_workers processes (each loads the features once) and written by this process in block order,
+# at most 2 * max_workers blocks are pending
+def compute_proximity_vector(vector_path, out_band, grid, max_distance, block_size=1024, max_workers=1):
+    pixel_size = grid['pixel_size']
+    bounds = (grid['x_min'] - max_distance, grid['y_max'] - grid['height'] * pixel_size - max_distance,
+              grid['x_min'] + grid['width'] * pixel_size + max_distance, grid['y_max'] + max_distance)
+    blocks = list(iter_tiles(grid['width'], grid['height'], block_size))
+    args = ([grid] * len(blocks), blocks, [max_distance] * len(blocks))
+
+    if max_workers == 1 or len(blocks) <= 1:
+        init_vector_worker(vector_path, bounds)
+        for block, distance in zip(blocks, map(vector_proximity_block, *args)):
+            out_band.WriteArray(distance, block[0], block[1])
+        return
+
+    # at most 2 blocks per worker are pending, so only a few blocks of distances are held in memory at a time
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_vector_worker, initargs=(vector_path, bounds)) as executor:
+        for block, distance in zip(blocks, map_ordered(executor, vector_proximity_block, zip(*args), 2 * max_workers)):
+            out_band.WriteArray(distance, block[0], block[1])
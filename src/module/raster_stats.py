@@ -0,0 +1,135 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: Persisted Raster Statistics and Histograms
+"""
+
+import os
+import json
+from osgeo import gdal
+
+# statistics are stored in the band metadata of the GeoTIFF (GDAL_METADATA tag), read back without decoding any pixel:
+# MCA_STATISTICS                          JSON {'min', 'max', 'mean', 'std', 'valid_count', 'nodata_count'}, over the valid (not NoData) cells,
+#                                         the exact values (GDAL's STATISTICS_* items, also written for QGIS and gdalinfo, are rounded)
+# MCA_HISTOGRAM                           JSON {'min', 'max', 'counts'}: equal-width buckets between min and max,
+#                                         one bucket per value for integer layers with up to 256 distinct values (land cover classes, scores, masks)
+# Cloud-Optimized GeoTIFFs are not rewritten, their statistics go to a '.aux.xml' file next to them
+# storing them costs two passes over every output and is opt-in: MCA_STATISTICS=1 (see build_cache.save_cache)
+HISTOGRAM_BUCKETS = 64
+INTEGER_DATA_TYPES = [gdal.GDT_Byte, gdal.GDT_UInt16, gdal.GDT_Int16, gdal.GDT_UInt32, gdal.GDT_Int32]
+
+# statistics of the first band, two passes over the pixels in GDAL (statistics, then histogram)
+def compute_raster_stats(dataset):
+    band = dataset.GetRasterBand(1)
+    stats = {'nodata': band.GetNoDataValue(), 'min': None, 'max': None, 'mean': None, 'std': None, 'valid_count': 0,
+             'nodata_count': dataset.RasterXSize * dataset.RasterYSize, 'histogram': None}
+
+    # every cell is NoData: GDAL fails to compute statistics, through the return value (None) or,
+    # with gdal.UseExceptions(), a RuntimeError; the error message is not printed
+    gdal.PushErrorHandler('CPLQuietErrorHandler')
+    try:
+        result = band.ComputeStatistics(False)
+    except RuntimeError:
+        result = None
+    finally:
+        gdal.PopErrorHandler()
+    if not result or any(value is None for value in result):
+        return stats
+    raster_min, raster_max, mean, std = result
+
+    if band.DataType in INTEGER_DATA_TYPES and raster_max - raster_min < 256:
+        bucket_count = int(raster_max - raster_min) + 1
+        histogram_min, histogram_max = raster_min - 0.5, raster_max + 0.5
+    else:
+        bucket_count = HISTOGRAM_BUCKETS
+        histogram_min, histogram_max = raster_min, raster_max
+
+    # values on the upper edge are counted in the last bucket (include_out_of_range), so the counts add up to the valid cells
+    counts = band.GetHistogram(histogram_min, histogram_max, bucket_count, 1, 0)
+    valid_count = int(sum(counts))
+    if valid_count == 0:
+        return stats
+
+    stats.update({
+        'min': float(raster_min), 'max': float(raster_max), 'mean': float(mean), 'std': float(std),
+        'valid_count': valid_count,
+        'nodata_count': dataset.RasterXSize * dataset.RasterYSize - valid_count,
+        'histogram': {'min': histogram_min, 'max': histogram_max, 'counts': [int(count) for count in counts]},
+    })
+    return stats
+
+STATISTICS_KEYS = ['min', 'max', 'mean', 'std', 'valid_count', 'nodata_count']
+
+def write_stats_metadata(band, stats):
+    if stats['min'] is not None:
+        band.SetStatistics(stats['min'], stats['max'], stats['mean'], stats['std'])
+    band.SetMetadataItem('MCA_STATISTICS', json.dumps({key: stats[key] for key in STATISTICS_KEYS}))
+    band.SetMetadataItem('MCA_HISTOGRAM', json.dumps(stats['histogram']))
+
+# statistics stored with a raster, None when the raster has none (written before statistics were stored, or a step1 input)
+def read_raster_stats(raster_path):
+    dataset = gdal.Open(raster_path)
+    if dataset is None:
+        raise RuntimeError(f"Failed to open raster file: {raster_path}")
+    band = dataset.GetRasterBand(1)
+    metadata = band.GetMetadata()
+    if 'MCA_STATISTICS' not in metadata or 'MCA_HISTOGRAM' not in metadata:
+        return None
+
+    return dict(json.loads(metadata['MCA_STATISTICS']), nodata=band.GetNoDataValue(), histogram=json.loads(metadata['MCA_HISTOGRAM']))
+
+# compute the statistics of a raster and store them with it, called for every raster output of steps 3-8 (see build_cache.save_cache)
+def write_raster_stats(raster_path):
+    dataset = gdal.Open(raster_path)
+    is_cog = dataset.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE') == 'COG'
+    if not is_cog:
+        dataset = None
+        dataset = gdal.Open(raster_path, gdal.GA_Update)
+
+    stats = compute_raster_stats(dataset)
+    write_stats_metadata(dataset.GetRasterBand(1), stats)
+    dataset = None
+    return stats
+
+# statistics are stored with every raster output only when MCA_STATISTICS=1
+def statistics_enabled():
+    return os.environ.get('MCA_STATISTICS') == '1'
+
+# range (min, max) of the valid cells of a raster: from the stored statistics, otherwise one pass of GDAL over the pixels
+# (nothing is written), (None, None) when every cell is NoData
+def get_valid_range(raster_path):
+    stats = read_raster_stats(raster_path)
+    if stats is not None:
+        return stats['min'], stats['max']
+
+    dataset = gdal.Open(raster_path)
+    gdal.PushErrorHandler('CPLQuietErrorHandler')
+    try:
+        value_range = dataset.GetRasterBand(1).ComputeRasterMinMax(False)
+    except RuntimeError:
+        value_range = None
+    finally:
+        gdal.PopErrorHandler()
+    dataset = None
+    if not value_range or any(value is None for value in value_range):
+        return None, None
+    return float(value_range[0]), float(value_range[1])
+
+# statistics of a raster: the stored ones, otherwise computed (and stored when persist is True)
+def get_raster_stats(raster_path, persist=True):
+    stats = read_raster_stats(raster_path)
+    if stats is not None:
+        return stats
+    if persist:
+        return write_raster_stats(raster_path)
+    return compute_raster_stats(gdal.Open(raster_path))
+
+# smallest and largest value of every cell, NoData cells included (the values np.min/np.max of the whole layer give)
+def get_value_range(stats):
+    values = [value for value in [stats['min'], stats['max']] if value is not None]
+    if stats['nodata_count'] and stats['nodata'] is not None:
+        values.append(stats['nodata'])
+    if not values:
+        return None, None
+    return min(values), max(values)
@@ -0,0 +1,177 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: Multi-AOI Batch Mode, Steps 6-8 for Each Site on the Shared Step5 Layers
+"""
+
+import os
+import re
+import pandas as pd
+from osgeo import ogr
+from build_cache import run_cached
+from encoding import get_stage_profile
+from grid import get_raster_grid, get_union_grid, get_subgrid, get_grid_bounds
+from parallel import process_rows
+from pipeline import get_data_path, get_excel_template_path, fill_settings
+from raster_stats import get_raster_stats
+from tracing import trace_stage
+from tuning import apply_tuning
+from step4_rasterize_vector_equalize_resolution import rasterize_vector
+from step5_calculate_proximity import get_source_vector_path
+import step6_clip_extend
+import step7_calculate_range
+import step8_calculate_result
+
+# a site is one feature of an AOI layer: steps 3-5 prepare every layer once over the union of the AOIs,
+# then steps 6-8 cut each site's window out of the shared step5 layers and score it in data/sites/<site>/step6 ... step8
+# sites are named by the value of site_field, or <AOI layer>_<feature id> without one
+def get_site_name(feature, aoi_stem, site_field=None):
+    name = feature.GetField(site_field) if site_field else None
+    if name is None or str(name).strip() == '':
+        name = '{}_{}'.format(aoi_stem, feature.GetFID())
+    return re.sub(r'[^\w.-]+', '_', str(name).strip())
+
+# AOI rows of the step5 file list with the step3 vector each was rasterized from (in vector_format, see encoding.VECTOR_FORMATS)
+def get_aoi_rows(df_step5, vector_input_path, vector_format='GPKG'):
+    aoi_rows = []
+    for row in df_step5.to_dict('records'):
+        if row.get('AOI') != 1 or row.get('exclusion') == 1:
+            continue
+        vector_path = get_source_vector_path(row['file_name'], vector_input_path, vector_format)
+        if vector_path is None:
+            print(f"Skipping AOI {row['file_name']}: batch mode takes its sites from vector AOI layers")
+            continue
+        aoi_rows.append(dict(row, vector_path=vector_path))
+    return aoi_rows
+
+# one site row per feature of the AOI vectors: name, AOI step5 file and step3 vector, feature id and envelope (x_min, x_max, y_min, y_max)
+def get_sites(df_step5, vector_input_path, site_field=None, vector_format='GPKG'):
+    sites = []
+    for aoi_row in get_aoi_rows(df_step5, vector_input_path, vector_format):
+        aoi_stem = os.path.splitext(os.path.basename(aoi_row['vector_path']))[0]
+        vector_ds = ogr.Open(aoi_row['vector_path'])
+        for feature in vector_ds.GetLayer():
+            geometry = feature.GetGeometryRef()
+            if geometry is None or geometry.IsEmpty():
+                continue
+            sites.append({
+                'file_name': get_site_name(feature, aoi_stem, site_field),
+                'aoi_file_name': aoi_row['file_name'],
+                'vector_path': aoi_row['vector_path'],
+                'fid': feature.GetFID(),
+                'envelope': geometry.GetEnvelope(),
+            })
+        vector_ds = None
+
+    names = [site['file_name'] for site in sites]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError(f"Site names are not unique: {duplicates}, choose another site field")
+    return sites
+
+# the site feature on its own, rasterized onto the site window of the shared grid
+def write_site_aoi(site, site_grid, aoi_output_path, pixel_size, target_crs):
+    site_vector_path = os.path.splitext(aoi_output_path)[0] + '.gpkg'
+    vector_ds = ogr.Open(site['vector_path'])
+    layer = vector_ds.GetLayer()
+    feature = layer.GetFeature(site['fid'])
+
+    if os.path.exists(site_vector_path):
+        ogr.GetDriverByName('GPKG').DeleteDataSource(site_vector_path)
+    site_ds = ogr.GetDriverByName('GPKG').CreateDataSource(site_vector_path)
+    site_layer = site_ds.CreateLayer(site['file_name'], layer.GetSpatialRef(), layer.GetGeomType())
+    site_feature = ogr.Feature(site_layer.GetLayerDefn())
+    site_feature.SetGeometry(feature.GetGeometryRef().Clone())
+    site_layer.CreateFeature(site_feature)
+    site_feature = None
+    site_ds = None
+    vector_ds = None
+
+    rasterize_vector(site_vector_path, aoi_output_path, pixel_size, target_crs, grid=site_grid)
+
+# steps 6-8 of one site, the layers are read in the site window of the shared step5 rasters: cut out without resampling when they are
+# pixel-aligned with the AOI grid (--aoi-grid-margin, and --fused-warp for rasters), otherwise clipped with resampling (see step6 clip_row)
+# shared_grid: grid of the step5 AOI rasters (the union of every AOI), step5_rows: the step5 file list
+# df_settings: hand-entered fields by step1 file name, None takes them from data/setting_excel/step6_excel_template.xlsx
+def run_site(site, data_root, step5_rows, shared_grid, df_settings=None, write_excel=True, block_size=1024, layer_cube=False, expression=None):
+    site_root = os.path.join(data_root, 'sites', site['file_name'])
+    site_paths = {step: get_data_path(site_root, 'step{}'.format(step)) for step in [5, 6, 7, 8]}
+    for path in site_paths.values():
+        os.makedirs(path, exist_ok=True)
+
+    with trace_stage('site', site['file_name']):
+        # GDAL threads, warp memory and block cache of this site's share of the machine (MCA_TUNING_JOBS, see process_sites)
+        apply_tuning('step6', 1)
+
+        site_grid = get_subgrid(shared_grid, site['envelope'])
+        site_extent = get_grid_bounds(site_grid)
+
+        # the AOI raster of the site keeps the file name of the AOI it belongs to, so the step6 settings still match
+        aoi_row = next(row for row in step5_rows if row['file_name'] == site['aoi_file_name'])
+        aoi_output_path = site_paths[5] + site['aoi_file_name']
+        target_crs = int(str(aoi_row['target_CRS']).split(':')[-1])
+        run_cached(lambda: write_site_aoi(site, site_grid, aoi_output_path, shared_grid['pixel_size'], target_crs),
+                   aoi_output_path, [site['vector_path']], {'fid': site['fid'], 'site_grid': site_grid, 'encoding': get_stage_profile('step4')}, __file__)
+
+        # step6: the site AOI, and the window of every shared layer (the AOI layers of the other sites are left out)
+        step5_path = get_data_path(data_root, 'step5')
+        processed_files = step6_clip_extend.clip_row(aoi_row, site_paths[5], site_paths[6], site_extent, site_grid)
+        for row in step5_rows:
+            if row['file_name'].lower().endswith('.tif') and row.get('AOI') != 1:
+                processed_files.extend(step6_clip_extend.clip_row(row, step5_path, site_paths[6], site_extent, site_grid))
+
+        df_step6 = fill_settings(pd.DataFrame(processed_files), 6, df_settings, data_root)
+        if write_excel:
+            os.makedirs(os.path.join(site_root, 'setting_excel'), exist_ok=True)
+            df_step6.to_excel(get_excel_template_path(site_root, 6), index=False)
+
+        # steps 7 and 8 in this process, the sites are the parallel jobs
+        df_step7 = pd.DataFrame(step7_calculate_range.process_files(df_step6, site_paths[6], site_paths[7], layer_cube, 1,
+                                                                           cube_tile_size=block_size or 1024))
+        if write_excel:
+            df_step7.to_excel(get_excel_template_path(site_root, 7), index=False)
+
+        layer_cube_path = os.path.join(site_paths[7], 'layer_cube') if layer_cube else None
+        step8_calculate_result.calculate_result(df_step7, site_paths[7], site_paths[8], block_size, layer_cube_path,
+                                                expression or step8_calculate_result.DEFAULT_EXPRESSION, 1)
+
+    result_path = site_paths[8] + 'MCA_result.tif'
+    stats = get_raster_stats(result_path)
+    return [{
+        'site': site['file_name'],
+        'aoi_file_name': site['aoi_file_name'],
+        'width': site_grid['width'],
+        'height': site_grid['height'],
+        'scored_cells': stats['valid_count'],
+        'score_mean': stats['mean'],
+        'score_max': stats['max'],
+        'result_path': result_path,
+    }]
+
+# steps 6-8 of every site on max_workers processes, one row per site in data/sites/site_summary.xlsx
+def process_sites(df_step5, data_root, df_settings=None, write_excel=True, max_workers=1, block_size=1024, site_field=None, layer_cube=False,
+                  expression=None, vector_format='GPKG'):
+    if df_settings is None and not os.path.exists(get_excel_template_path(data_root, 6)):
+        raise ValueError("Batch mode needs a settings table or a filled step6_excel_template.xlsx for the step6 fields of the sites")
+
+    step5_path = get_data_path(data_root, 'step5')
+    sites = get_sites(df_step5, get_data_path(data_root, 'step3'), site_field, vector_format)
+    step5_rows = df_step5.to_dict('records')
+
+    # the union of the AOI rasters, the grid the step5 layers were computed on
+    aoi_file_names = sorted(set(site['aoi_file_name'] for site in sites))
+    shared_grid = get_union_grid([get_raster_grid(step5_path + file_name) for file_name in aoi_file_names])
+
+    print(f"Batch mode: {len(sites)} sites")
+    # the sites running side by side share the cores and memory, steps 6-8 of each site tune GDAL for its share (see tuning.py)
+    os.environ['MCA_TUNING_JOBS'] = str(max(min(max_workers, len(sites)), 1))
+    try:
+        site_summary = process_rows(run_site, sites, (data_root, step5_rows, shared_grid, df_settings, write_excel, block_size, layer_cube, expression), max_workers)
+    finally:
+        del os.environ['MCA_TUNING_JOBS']
+
+    df_summary = pd.DataFrame(site_summary)
+    os.makedirs(os.path.join(data_root, 'sites'), exist_ok=True)
+    df_summary.to_excel(os.path.join(data_root, 'sites', 'site_summary.xlsx'), index=False)
+    return df_summary
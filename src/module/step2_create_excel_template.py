@@ -7,43 +7,51 @@ Description: Create Excel Template
 
 import os
 import pandas as pd
-import rasterio
-import geopandas as gpd
+from parallel import get_max_workers
+from catalog import scan_directory
+from tracing import traced
 
-def get_file_list(directory, file_extensions):
+# catalog_path: JSON file with the header metadata of the files from the previous runs (see catalog.py), None reads every file
+@traced('get_file_list', 0, None)
+def get_file_list(directory, file_extensions, catalog_path=None, max_workers=1):
     file_list = []
 
-    for filename in os.listdir(directory):
-        file_path = directory + filename
-        if filename.endswith(tuple(file_extensions)):
-            file_info = {'file_name': filename, 'source_CRS': None, 'target_CRS': None, 'source_resolution(m)': None, 'target_resolution(m)': None, 'AOI': None}
-            
-            if filename.endswith('.tif'):
-                with rasterio.open(file_path) as dataset:
-                    file_info.update({
-                        'source_resolution(m)': dataset.res[0],
-                        'source_CRS': dataset.crs.to_string(),
-                    })
-            else:  # For .shp and .geojson files
-                gdf = gpd.read_file(file_path)
-                extent = gdf.geometry.total_bounds
-                file_info.update({
-                    'source_CRS': gdf.crs.to_string(),
-                    'AOI': '1' if filename.lower().startswith('aoi') else None
-                })
-
-            file_list.append(file_info)
+    for filename, metadata in scan_directory(directory, file_extensions, catalog_path, max_workers).items():
+        file_info = {'file_name': filename, 'source_CRS': None, 'target_CRS': None, 'source_resolution(m)': None, 'target_resolution(m)': None, 'AOI': None,
+                     'value_min': None, 'value_max': None}
+
+        if metadata['type'] == 'raster':
+            file_info.update({
+                'source_resolution(m)': metadata['resolution'][0],
+                'source_CRS': metadata['crs'],
+                # range of the valid (not NoData) values, for writing the suitability ranges
+                'value_min': metadata['value_min'],
+                'value_max': metadata['value_max'],
+            })
+        else:  # For .shp and .geojson files
+            file_info.update({
+                'source_CRS': metadata['crs'],
+                'AOI': '1' if filename.lower().startswith('aoi') else None
+            })
+
+        file_list.append(file_info)
 
     return file_list
 
 def main():
-    input_path = r'data\\step1\\'
-    output_path = r'data\\step2\\'
-    setting_excel_path = r'data\\setting_excel\\'
-    output_excel_path = setting_excel_path + r'step2_excel_template.xlsx'
+    input_path = os.path.join('data', 'step1', '')
+    output_path = os.path.join('data', 'step2', '')
+    setting_excel_path = os.path.join('data', 'setting_excel', '')
+    output_excel_path = os.path.join(setting_excel_path, 'step2_excel_template.xlsx')
     extensions = ['.tif', '.shp', '.geojson']
 
-    file_data = get_file_list(input_path, extensions)
+    # header metadata of the step1 files, kept between runs for the files that did not change
+    catalog_path = os.path.join(output_path, 'step1_catalog.json')
+
+    # number of parallel worker processes (MCA_MAX_WORKERS, 1 reads the files one after another)
+    max_workers = get_max_workers()
+
+    file_data = get_file_list(input_path, extensions, catalog_path, max_workers)
     df = pd.DataFrame(file_data)
 
     # Save to Excel
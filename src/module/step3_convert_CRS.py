@@ -7,11 +7,103 @@ Description: Convert CRS
 
 import os
 import pandas as pd
-import geopandas as gpd
+from osgeo import ogr, osr
 import rasterio
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 import shutil
+from parallel import process_rows, get_max_workers
+from build_cache import run_cached
+from encoding import get_stage_profile, gdal_creation_options, get_vector_format, VECTOR_FORMATS
+from grid import get_spatial_reference, get_union_extent, get_vector_grid, warp_to_grid, get_grid_data_type, COMPACT_DATA_TYPES
+from tracing import traced
+from tuning import apply_tuning, rasterio_warp_options
 
+# geometry types kept from a vector file
+def get_geometry_types(input_file_path):
+    # AOI/protected area
+    if 'AOI' in input_file_path or 'protected' in input_file_path:
+        return [ogr.wkbPolygon, ogr.wkbMultiPolygon]
+
+    # roads, electrical grids..
+    return [ogr.wkbLineString, ogr.wkbMultiLineString]
+
+# reproject the features of a vector file one by one, only memory for one chunk of features is used whatever the size of the file
+# filter_bounds: (min_x, min_y, max_x, max_y) in the target CRS, features outside of it are skipped by the reader
+# chunk_size: features written per transaction
+@traced('convert_vector')
+def convert_vector(input_file_path, output_file_path, target_crs, vector_format='GPKG', filter_bounds=None, chunk_size=10000):
+    src_ds = ogr.Open(input_file_path)
+    if src_ds is None:
+        print(f"Unable to open {input_file_path} for reading")
+        return
+    src_layer = src_ds.GetLayer()
+
+    source_srs = src_layer.GetSpatialRef()
+    target_srs = get_spatial_reference(target_crs)
+    transformation = None
+    if source_srs is not None:
+        source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        if not source_srs.IsSame(target_srs):
+            transformation = osr.CoordinateTransformation(source_srs, target_srs)
+
+    # the AOI box is pushed down to the reader in the source CRS
+    if filter_bounds is not None:
+        if transformation is not None:
+            filter_bounds = osr.CoordinateTransformation(target_srs, source_srs).TransformBounds(*filter_bounds, 21)
+        src_layer.SetSpatialFilterRect(*filter_bounds)
+
+    geometry_types = get_geometry_types(input_file_path)
+    is_polygon = ogr.wkbPolygon in geometry_types
+
+    # Create the output layer with the fields of the input layer
+    driver = ogr.GetDriverByName(vector_format)
+    if os.path.exists(output_file_path):
+        driver.DeleteDataSource(output_file_path)
+    out_ds = driver.CreateDataSource(output_file_path)
+    out_layer = out_ds.CreateLayer(os.path.splitext(os.path.basename(output_file_path))[0], target_srs,
+                                   ogr.wkbMultiPolygon if is_polygon else ogr.wkbMultiLineString)
+    src_layer_defn = src_layer.GetLayerDefn()
+    for i in range(src_layer_defn.GetFieldCount()):
+        out_layer.CreateField(src_layer_defn.GetFieldDefn(i))
+    out_layer_defn = out_layer.GetLayerDefn()
+
+    use_transactions = out_ds.TestCapability(ogr.ODsCTransactions)
+    feature_count = 0
+    if use_transactions:
+        out_ds.StartTransaction()
+
+    for src_feature in src_layer:
+        geometry = src_feature.GetGeometryRef()
+        if geometry is None or ogr.GT_Flatten(geometry.GetGeometryType()) not in geometry_types:
+            continue
+
+        geometry = geometry.Clone()
+        if transformation is not None:
+            geometry.Transform(transformation)
+        geometry.FlattenTo2D()
+        geometry = ogr.ForceToMultiPolygon(geometry) if is_polygon else ogr.ForceToMultiLineString(geometry)
+
+        out_feature = ogr.Feature(out_layer_defn)
+        out_feature.SetFrom(src_feature)
+        out_feature.SetGeometry(geometry)
+        out_layer.CreateFeature(out_feature)
+        feature_count += 1
+
+        # commit every chunk_size features
+        if use_transactions and feature_count % chunk_size == 0:
+            out_ds.CommitTransaction()
+            out_ds.StartTransaction()
+
+    if use_transactions:
+        out_ds.CommitTransaction()
+    out_ds = None
+    src_ds = None
+
+    if feature_count == 0:
+        driver.DeleteDataSource(output_file_path)
+        print(f"No matching geometries found in the file: {input_file_path}")
+
+@traced('convert_crs')
 def convert_crs(input_file_path, output_file_path, source_crs, target_crs, is_raster):
     if is_raster:
         with rasterio.open(input_file_path) as src:
@@ -28,60 +120,101 @@ def convert_crs(input_file_path, output_file_path, source_crs, target_crs, is_ra
                             src_crs=src.crs,
                             dst_transform=transform,
                             dst_crs=target_crs,
-                            resampling=Resampling.nearest)
+                            resampling=Resampling.nearest,
+                            **rasterio_warp_options('step3'))
             else:
                 shutil.copy(input_file_path, output_file_path)
+
+# aoi_grid: fused warp of rasters onto the AOI grid
+# filter_bounds: (min_x, min_y, max_x, max_y) in the target CRS, vector features outside of it are skipped (None keeps every feature)
+def convert_row(row, input_data_path, output_path, aoi_grid=None, vector_format='GPKG', filter_bounds=None):
+    input_file_path = input_data_path + row['file_name']
+    file_ext = VECTOR_FORMATS[vector_format] if os.path.splitext(row['file_name'])[1].lower() in ['.geojson', '.shp'] else os.path.splitext(row['file_name'])[1]
+    output_file_name = os.path.splitext(row['file_name'])[0] + '_CRS' + file_ext
+    output_file_path = output_path + output_file_name
+
+    is_raster = file_ext == '.tif'
+    source_resolution = row['source_resolution(m)'] if is_raster else None
+
+    # fused warp: the raster is reprojected, resampled and clipped onto the AOI grid at once,
+    # it already has the target resolution (copied by step4) and the AOI grid (copied by step6)
+    if is_raster and aoi_grid is not None:
+        # the raster keeps its compact data type (uint8 classes such as land cover stay uint8 for steps 6 and 7), see grid.get_grid_data_type
+        data_type, nbits = get_grid_data_type(input_file_path)
+        creation_options = gdal_creation_options(get_stage_profile('step6'), COMPACT_DATA_TYPES[data_type], nbits)
+        run_cached(lambda: warp_to_grid(input_file_path, output_file_path, aoi_grid, creation_options, data_type),
+                   output_file_path, [input_file_path], {'aoi_grid': aoi_grid, 'encoding': get_stage_profile('step6'), 'data_type': COMPACT_DATA_TYPES[data_type]}, __file__)
+        source_resolution = row['target_resolution(m)']
+
+    # streamed vector reprojection, skipped when the input file and settings are unchanged since the last run
+    elif not is_raster:
+        # the AOI itself is never filtered
+        filter_bounds = None if pd.to_numeric(row['AOI'], errors='coerce') == 1 else filter_bounds
+        run_cached(lambda: convert_vector(input_file_path, output_file_path, row['target_CRS'], vector_format, filter_bounds),
+                   output_file_path, [input_file_path], {'target_CRS': row['target_CRS'], 'vector_format': vector_format, 'filter_bounds': filter_bounds}, __file__)
+
     else:
-        gdf = gpd.read_file(input_file_path)
-        if source_crs != target_crs:
-            gdf = gdf.to_crs(target_crs)
-
-        # AOI/protected area
-        if 'AOI' in input_file_path or 'protected' in input_file_path:
-            gdf_filtered = gdf[gdf['geometry'].type.isin(['Polygon', 'MultiPolygon'])]
-        
-        # roads, electrical grids..
-        else:
-            gdf_filtered = gdf[gdf['geometry'].type.isin(['LineString', 'MultiLineString'])]
-
-        if not gdf_filtered.empty:
-            gdf_filtered.to_file(output_file_path, driver='ESRI Shapefile')
-        else:
-            print(f"No matching geometries found in the file: {input_file_path}")
-
-def process_files(df_input_excel, input_data_path, output_path):
-    processed_files = []
-
-    for idx, row in df_input_excel.iterrows():
-        input_file_path = input_data_path + row['file_name']
-        file_ext = '.shp' if os.path.splitext(row['file_name'])[1].lower() in ['.geojson', '.shp'] else os.path.splitext(row['file_name'])[1]
-        output_file_name = os.path.splitext(row['file_name'])[0] + '_CRS' + file_ext
-        output_file_path = output_path + output_file_name
-
-        is_raster = file_ext == '.tif'
-        convert_crs(input_file_path, output_file_path, row['source_CRS'], row['target_CRS'], is_raster)
-
-        processed_files.append({
-            'file_name': output_file_name,
-            'source_CRS': row['source_CRS'],
-            'target_CRS': row['target_CRS'],
-            'source_resolution(m)': row['source_resolution(m)'] if is_raster else None,
-            'target_resolution(m)': row['target_resolution(m)'],
-            'AOI': row['AOI']
-        })
-
-    return processed_files
+        # skipped when the input file and CRS settings are unchanged since the last run
+        run_cached(lambda: convert_crs(input_file_path, output_file_path, row['source_CRS'], row['target_CRS'], is_raster),
+                   output_file_path, [input_file_path], {'source_CRS': row['source_CRS'], 'target_CRS': row['target_CRS']}, __file__)
+
+    return [{
+        'file_name': output_file_name,
+        'source_CRS': row['source_CRS'],
+        'target_CRS': row['target_CRS'],
+        'source_resolution(m)': source_resolution,
+        'target_resolution(m)': row['target_resolution(m)'],
+        'AOI': row['AOI']
+    }]
+
+# fused_raster_warp: rasters go straight to the AOI grid (target CRS, target resolution, AOI extent) instead of being warped in steps 3, 4 and 6
+# vector_format: OGR driver of the vector outputs (see encoding.VECTOR_FORMATS)
+# aoi_filter_margin: only vector features within this distance (target CRS units) of the AOI bounding box are kept, None keeps every feature
+def process_files(df_input_excel, input_data_path, output_path, max_workers=1, fused_raster_warp=False, vector_format='GPKG', aoi_filter_margin=None):
+    # GDAL threads, warp memory and block cache of each of the max_workers processes (see tuning.py)
+    apply_tuning('step3', max_workers)
+
+    aoi_grid = None
+    filter_bounds = None
+    if fused_raster_warp or aoi_filter_margin is not None:
+        # every AOI (their union when several are flagged), the target CRS and resolution of the first one
+        aoi_df = df_input_excel[pd.to_numeric(df_input_excel['AOI'], errors='coerce') == 1]
+        aoi_row = aoi_df.iloc[0]
+        aoi_file_paths = [input_data_path + file_name for file_name in aoi_df['file_name']]
+
+        if fused_raster_warp:
+            aoi_grid = get_vector_grid(aoi_file_paths, aoi_row['target_resolution(m)'], aoi_row['target_CRS'])
+
+        if aoi_filter_margin is not None:
+            x_min, x_max, y_min, y_max = get_union_extent(aoi_file_paths, aoi_row['target_CRS'])
+            filter_bounds = (x_min - aoi_filter_margin, y_min - aoi_filter_margin, x_max + aoi_filter_margin, y_max + aoi_filter_margin)
+
+    # every file is converted independently, in parallel when max_workers > 1
+    rows = df_input_excel.to_dict('records')
+    return process_rows(convert_row, rows, (input_data_path, output_path, aoi_grid, vector_format, filter_bounds), max_workers)
 
 def main():
-    input_path = r'data\\step1\\'
-    output_path = r'data\\step3\\'
-    setting_excel_path = r'data\\setting_excel\\'
-    input_excel_path = setting_excel_path + r'step2_excel_template.xlsx'
-    output_excel_path = setting_excel_path + r'step3_excel_template.xlsx'
+    input_path = os.path.join('data', 'step1', '')
+    output_path = os.path.join('data', 'step3', '')
+    setting_excel_path = os.path.join('data', 'setting_excel', '')
+    input_excel_path = os.path.join(setting_excel_path, 'step2_excel_template.xlsx')
+    output_excel_path = os.path.join(setting_excel_path, 'step3_excel_template.xlsx')
 
     df_input_excel = pd.read_excel(input_excel_path)
 
-    processed_files = process_files(df_input_excel, input_path, output_path)
+    # number of parallel worker processes (MCA_MAX_WORKERS, 1 runs the files one after another)
+    max_workers = get_max_workers()
+
+    # reproject + resample + clip rasters in one warp (MCA_FUSED_WARP=1)
+    fused_raster_warp = os.environ.get('MCA_FUSED_WARP') == '1'
+
+    # vector output format (MCA_VECTOR_FORMAT): 'GPKG', 'FlatGeobuf' or 'ESRI Shapefile'
+    vector_format = get_vector_format()
+
+    # keep only the vector features within this distance in meters of the AOI (MCA_AOI_FILTER_MARGIN, e.g. the 50000 m proximity distance)
+    aoi_filter_margin = float(os.environ['MCA_AOI_FILTER_MARGIN']) if os.environ.get('MCA_AOI_FILTER_MARGIN') else None
+
+    processed_files = process_files(df_input_excel, input_path, output_path, max_workers, fused_raster_warp, vector_format, aoi_filter_margin)
     df_processed = pd.DataFrame(processed_files)
     df_processed.to_excel(output_excel_path, index=False)
 
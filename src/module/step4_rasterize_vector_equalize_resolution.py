@@ -11,8 +11,16 @@ import rasterio
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 from osgeo import gdal, ogr, osr
 import shutil  # library for copying files
-
-def rasterize_vector(input_vector_path, output_raster_path, pixel_size, target_crs, no_data_value=0, burn_value=1):
+from parallel import process_rows, get_max_workers
+from build_cache import run_cached
+from encoding import get_stage_profile, gdal_creation_options, rasterio_creation_options, VECTOR_EXTENSIONS
+from grid import get_vector_grid, get_grid_bounds, get_spatial_reference
+from tracing import traced
+from tuning import apply_tuning, rasterio_warp_options
+
+# grid: optional shared grid (see grid.py) to rasterize onto instead of the extent of the vector itself
+@traced('rasterize_vector')
+def rasterize_vector(input_vector_path, output_raster_path, pixel_size, target_crs, no_data_value=0, burn_value=1, grid=None):
     # Read vector data
     vector_ds = ogr.Open(input_vector_path)
     vector_layer = vector_ds.GetLayer()
@@ -24,21 +32,27 @@ def rasterize_vector(input_vector_path, output_raster_path, pixel_size, target_c
     target_srs = osr.SpatialReference()
     target_srs.ImportFromEPSG(target_crs)
 
-    # Get the extent of the input vector
-    x_min, x_max, y_min, y_max = vector_layer.GetExtent()
+    if grid is not None:
+        # rasterize onto the shared grid, features outside of it are not read
+        # the grid's CRS and pixel size win over the row's, so the raster lines up with the grid
+        target_srs = get_spatial_reference(grid['crs'])
+        pixel_size = grid['pixel_size']
+        x_min, y_max = grid['x_min'], grid['y_max']
+        x_res, y_res = grid['width'], grid['height']
+        vector_layer.SetSpatialFilterRect(*get_grid_bounds(grid))
+
+    else:
+        # Get the extent of the input vector
+        x_min, x_max, y_min, y_max = vector_layer.GetExtent()
 
-    # Calculate the number of pixels
-    x_res = int((x_max - x_min) / pixel_size)
-    y_res = int((y_max - y_min) / pixel_size)
+        # Calculate the number of pixels
+        x_res = int((x_max - x_min) / pixel_size)
+        y_res = int((y_max - y_min) / pixel_size)
 
     # Create a raster dataset with one band
-    # Define GDAL creation options for high compression
-    creation_options = [
-        'TILED=YES',
-        'COMPRESS=DEFLATE',  # Use DEFLATE compression
-        'PREDICTOR=1',       # Use predictor 1 (suitable for integer data)
-        'ZLEVEL=9'           # Set the compression level (1=fastest, 9=best compression)
-    ]
+    # GDAL creation options of the step4 encoding profile, a 0/1 mask is bit-packed (NBITS=1)
+    nbits = 1 if burn_value in (0, 1) and no_data_value in (0, 1) else None
+    creation_options = gdal_creation_options(get_stage_profile('step4'), 'uint8', nbits)
 
     target_ds = gdal.GetDriverByName('GTiff').Create(output_raster_path, x_res, y_res, 1, gdal.GDT_Byte, options=creation_options)
     target_ds.SetGeoTransform((x_min, pixel_size, 0, y_max, 0, -pixel_size))
@@ -54,89 +68,130 @@ def rasterize_vector(input_vector_path, output_raster_path, pixel_size, target_c
     target_ds = None
     vector_ds = None
 
-def main():
-    input_path = r'data\\step3\\'
-    output_path = r'data\\step4\\'
-    setting_excel_path = r'data\\setting_excel\\'
-    input_excel_path = setting_excel_path + r'step3_excel_template.xlsx'
-    output_excel_path = setting_excel_path + r'step4_excel_template.xlsx'
-
-    # Read the input Excel file
-    df_input_excel = pd.read_excel(input_excel_path)
-
-    # Initialize a list to keep track of processed files for the Excel output
-    processed_files = []
+@traced('equalize_resolution')
+def equalize_resolution(input_file_path, output_file_path, target_resolution):
+    with rasterio.open(input_file_path) as src:
+        transform, width, height = calculate_default_transform(
+            src.crs, src.crs, src.width, src.height, *src.bounds,
+            dst_width=int(src.width * (src.res[0] / target_resolution)),
+            dst_height=int(src.height * (src.res[1] / target_resolution))
+        )
+
+        kwargs = src.meta.copy()
+        kwargs.update({'crs': src.crs, 'transform': transform, 'width': width, 'height': height})
+        # compression options of the step4 encoding profile
+        kwargs.update(rasterio_creation_options(get_stage_profile('step4'), src.dtypes[0]))
+
+        with rasterio.open(output_file_path, 'w', **kwargs) as dst:
+            for i in range(1, src.count + 1):
+                reproject(source=rasterio.band(src, i), destination=rasterio.band(dst, i), src_transform=src.transform, src_crs=src.crs, dst_transform=transform, dst_crs=src.crs, resampling=Resampling.nearest,
+                          **rasterio_warp_options('step4'))
+
+def rasterize_row(row, input_path, output_path, aoi_grid=None, layer_grid=None):
+    input_vector_path = input_path + row['file_name']
+    output_raster_path = output_path + os.path.splitext(row['file_name'])[0] + '_rasterized.tif'
+    pixel_size = row['target_resolution(m)']
+    target_crs = int(row['target_CRS'].split(':')[-1])  # Assuming the CRS is given in 'EPSG:xxxx' format
+
+    # on the AOI grid, the AOI itself keeps the exact AOI grid and the other layers take the grid with margin
+    grid = aoi_grid if pd.to_numeric(row['AOI'], errors='coerce') == 1 else layer_grid
+    if grid is not None and pixel_size != grid['pixel_size']:
+        # the shared grid has the AOI's resolution, the layer is rasterized at that resolution
+        print(f"{row['file_name']}: target_resolution(m) {pixel_size} differs from the AOI grid, rasterized at {grid['pixel_size']}")
+        pixel_size = grid['pixel_size']
+
+    # skipped when the vector and rasterization settings are unchanged since the last run
+    run_cached(lambda: rasterize_vector(input_vector_path, output_raster_path, pixel_size, target_crs, grid=grid),
+               output_raster_path, [input_vector_path], {'pixel_size': pixel_size, 'target_crs': target_crs, 'grid': grid, 'encoding': get_stage_profile('step4')}, __file__)
+
+    # file details for the Excel output
+    return [{
+        'file_name': os.path.basename(output_raster_path),
+        'source_resolution(m)': None,  # Shapefiles do not have a resolution
+        'target_resolution(m)': pixel_size,
+        'source_CRS': row['source_CRS'],
+        'target_CRS': row['target_CRS'],
+        'AOI': row['AOI'],
+        'exclusion': None,
+        'proximity': None,
+        'max_distance(m)': None
+    }]
+
+def equalize_row(row, input_path, output_path):
+    input_file_path = input_path + row['file_name']
+
+    # when resolutions of input and output are different, reprocessing and saving
+    if row['source_resolution(m)'] is not None and row['source_resolution(m)'] != row['target_resolution(m)']:    
+        output_file_name = os.path.splitext(row['file_name'])[0] + '_equalized.tif'
+        output_file_path = output_path + output_file_name
+
+        # skipped when the raster and target resolution are unchanged since the last run
+        run_cached(lambda: equalize_resolution(input_file_path, output_file_path, row['target_resolution(m)']),
+                   output_file_path, [input_file_path], {'target_resolution(m)': row['target_resolution(m)'], 'encoding': get_stage_profile('step4')}, __file__)
+    
+    # copy input file as output file
+    else:
+        output_file_name = row['file_name']
+        output_file_path = output_path + output_file_name
+        run_cached(lambda: shutil.copy(input_file_path, output_file_path), output_file_path, [input_file_path], {}, __file__)
+
+    # add file info to excel
+    return [{
+        'file_name': output_file_name,
+        'source_resolution(m)': row['source_resolution(m)'],
+        'target_resolution(m)': row['target_resolution(m)'],
+        'source_CRS': row['source_CRS'],
+        'target_CRS': row['target_CRS'],
+        'AOI': row['AOI'],
+        'exclusion': None,
+        'proximity': None,
+        'max_distance(m)': None
+    }]
+
+# aoi_grid_margin: None rasterizes every vector over its own extent,
+# a distance (m) rasterizes every vector onto the AOI grid extended by that margin (pixel-aligned with the AOI raster)
+def process_files(df_input_excel, input_path, output_path, max_workers=1, aoi_grid_margin=None):
+    # GDAL threads, warp memory and block cache of each of the max_workers processes (see tuning.py)
+    apply_tuning('step4', max_workers)
+
+    # Process vector files ('.gpkg', '.fgb', '.shp') for rasterization
+    shp_df = df_input_excel[df_input_excel['file_name'].str.lower().str.endswith(tuple(VECTOR_EXTENSIONS))]
+
+    aoi_grid = layer_grid = None
+    if aoi_grid_margin is not None:
+        # the grid of every AOI together (their union when several are flagged), so every AOI raster lines up with the layers
+        aoi_df = shp_df[pd.to_numeric(shp_df['AOI'], errors='coerce') == 1]
+        aoi_row = aoi_df.iloc[0]
+        aoi_file_paths = [input_path + file_name for file_name in aoi_df['file_name']]
+        aoi_grid = get_vector_grid(aoi_file_paths, aoi_row['target_resolution(m)'], aoi_row['target_CRS'])
+        layer_grid = get_vector_grid(aoi_file_paths, aoi_row['target_resolution(m)'], aoi_row['target_CRS'], aoi_grid_margin)
+
+    processed_files = process_rows(rasterize_row, shp_df.to_dict('records'), (input_path, output_path, aoi_grid, layer_grid), max_workers)
 
-    # Process '.shp' files for rasterization
-    shp_df = df_input_excel[df_input_excel['file_name'].str.lower().str.endswith('.shp')]
+    # Process '.tif' files for resolution equalization
+    tif_df = df_input_excel[df_input_excel['file_name'].str.lower().str.endswith('.tif')]
+    processed_files += process_rows(equalize_row, tif_df.to_dict('records'), (input_path, output_path), max_workers)
 
-    # Find the row where AOI is 1
-    aoi_row = df_input_excel[df_input_excel['AOI'] == 1]
+    return processed_files
 
-    for idx, row in shp_df.iterrows():
-        input_vector_path = input_path + row['file_name']
-        output_raster_path = output_path + os.path.splitext(row['file_name'])[0] + '_rasterized.tif'
-        pixel_size = row['target_resolution(m)']
-        target_crs = int(row['target_CRS'].split(':')[-1])  # Assuming the CRS is given in 'EPSG:xxxx' format
+def main():
+    input_path = os.path.join('data', 'step3', '')
+    output_path = os.path.join('data', 'step4', '')
+    setting_excel_path = os.path.join('data', 'setting_excel', '')
+    input_excel_path = os.path.join(setting_excel_path, 'step3_excel_template.xlsx')
+    output_excel_path = os.path.join(setting_excel_path, 'step4_excel_template.xlsx')
 
-        rasterize_vector(input_vector_path, output_raster_path, pixel_size, target_crs)
+    # Read the input Excel file
+    df_input_excel = pd.read_excel(input_excel_path)
 
-        # Add file details to the processed_files list
-        processed_files.append({
-            'file_name': os.path.basename(output_raster_path),
-            'source_resolution(m)': None,  # Shapefiles do not have a resolution
-            'target_resolution(m)': pixel_size,
-            'source_CRS': row['source_CRS'],
-            'target_CRS': row['target_CRS'],
-            'AOI': row['AOI'],
-            'exclusion': None,
-            'proximity': None
-        })
+    # number of parallel worker processes (MCA_MAX_WORKERS, 1 runs the files one after another)
+    max_workers = get_max_workers()
 
-    # Process '.tif' files for resolution equalization
-    tif_df = df_input_excel[df_input_excel['file_name'].str.lower().str.endswith('.tif')]
+    # rasterize vectors onto the AOI grid extended by this margin in meters (MCA_AOI_GRID_MARGIN, e.g. the 50000 m proximity distance)
+    aoi_grid_margin = float(os.environ['MCA_AOI_GRID_MARGIN']) if os.environ.get('MCA_AOI_GRID_MARGIN') else None
 
-    for idx, row in tif_df.iterrows():
-        input_file_path = input_path + row['file_name']
-
-        # when resolutions of input and output are different, reprocessing and saving
-        if row['source_resolution(m)'] is not None and row['source_resolution(m)'] != row['target_resolution(m)']:    
-            output_file_name = os.path.splitext(row['file_name'])[0] + '_equalized.tif'
-            output_file_path = output_path + output_file_name
-        
-            with rasterio.open(input_file_path) as src:
-                transform, width, height = calculate_default_transform(
-                    src.crs, src.crs, src.width, src.height, *src.bounds,
-                    dst_width=int(src.width * (src.res[0] / row['target_resolution(m)'])),
-                    dst_height=int(src.height * (src.res[1] / row['target_resolution(m)']))
-                )
-
-                kwargs = src.meta.copy()
-                kwargs.update({'crs': src.crs, 'transform': transform, 'width': width, 'height': height})
-                # Define compression options
-                kwargs.update({'tiled': True, 'compress': 'DEFLATE', 'predictor': 1, 'zlevel': 9})
-
-                with rasterio.open(output_file_path, 'w', **kwargs) as dst:
-                    for i in range(1, src.count + 1):
-                        reproject(source=rasterio.band(src, i), destination=rasterio.band(dst, i), src_transform=src.transform, src_crs=src.crs, dst_transform=transform, dst_crs=src.crs, resampling=Resampling.nearest)
-        
-        # copy input file as output file
-        else:
-            output_file_name = row['file_name']
-            output_file_path = output_path + output_file_name
-            shutil.copy(input_file_path, output_file_path)
-
-        # add file info to excel
-        processed_files.append({
-            'file_name': output_file_name,
-            'source_resolution(m)': row['source_resolution(m)'],
-            'target_resolution(m)': row['target_resolution(m)'],
-            'source_CRS': row['source_CRS'],
-            'target_CRS': row['target_CRS'],
-            'AOI': row['AOI'],
-            'exclusion': None,
-            'proximity': None
-        })
+    # Process files, keeping track of processed files for the Excel output
+    processed_files = process_files(df_input_excel, input_path, output_path, max_workers, aoi_grid_margin)
 
     # Create a DataFrame from the processed_files list
     df_processed = pd.DataFrame(processed_files)
@@ -9,30 +9,63 @@ import os
 import pandas as pd
 from osgeo import gdal
 import shutil  # library for copying files
-
-def calculate_proximity(input_raster_path, output_raster_path, max_distance):
+from parallel import process_rows, get_max_workers
+from build_cache import run_cached
+from encoding import get_stage_profile, gdal_creation_options, get_vector_format, VECTOR_FORMATS
+from proximity import compute_proximity_edt, compute_proximity_gdal_window, compute_proximity_vector, PROXIMITY_NO_DATA
+from grid import get_raster_grid, get_union_grid, get_grid_geo_transform, get_grid_bounds, get_raster_window
+from tracing import traced
+from tuning import apply_tuning
+
+# max distance (m) when the 'max_distance(m)' field of a proximity layer is empty
+DEFAULT_MAX_DISTANCE = 50000
+
+# proximity engines: 'gdal' runs gdal.ComputeProximity over the whole raster in one thread,
+# 'edt' computes an exact Euclidean distance transform tile by tile in parallel (see proximity.py),
+# 'vector' computes the distance from the AOI cell centres to the step3 vector features directly (rasters fall back to 'edt')
+PROXIMITY_ENGINES = ['gdal', 'edt', 'vector']
+
+# data types of the proximity rasters: 'float32' keeps the exact distance,
+# 'uint16' quantizes it to whole CRS units (metres), half the size and read back without decoding floats,
+# the range bounds of step7 stay in metres and the value beyond max_distance (PROXIMITY_NO_DATA, 65535) is kept
+PROXIMITY_DTYPES = {'float32': gdal.GDT_Float32, 'uint16': gdal.GDT_UInt16}
+
+# data type of a proximity raster, 'uint16' only when max_distance is below the value written beyond it
+def get_proximity_dtype(proximity_dtype, max_distance):
+    if proximity_dtype not in PROXIMITY_DTYPES:
+        raise ValueError(f"Unknown proximity data type '{proximity_dtype}', expected one of {list(PROXIMITY_DTYPES)}")
+    if proximity_dtype == 'uint16' and max_distance >= PROXIMITY_NO_DATA:
+        print(f"max distance {max_distance} does not fit in uint16, the proximity is written as float32")
+        return 'float32'
+    return proximity_dtype
+
+# window (x_off, y_off, x_size, y_size): the proximity is only computed and written for this part of the raster, None computes the whole raster
+# proximity_dtype: data type of the output (see PROXIMITY_DTYPES), GDAL rounds the distances to the nearest whole unit for 'uint16'
+@traced('calculate_proximity')
+def calculate_proximity(input_raster_path, output_raster_path, max_distance, proximity_engine='gdal', max_workers=1, window=None, proximity_dtype='float32'):
     # Open the source raster file
     src_ds = gdal.Open(input_raster_path, gdal.GA_ReadOnly)
     if src_ds is None:
         print(f"Unable to open {input_raster_path} for reading")
         return
 
-    # Define GDAL creation options for high compression
-    creation_options = [
-        'TILED=YES',
-        'COMPRESS=DEFLATE',  # Use DEFLATE compression
-        'PREDICTOR=1',       # Use predictor 1 (suitable for integer data)
-        'ZLEVEL=9'           # Set the compression level (1=fastest, 9=best compression)
-    ]
+    if window == (0, 0, src_ds.RasterXSize, src_ds.RasterYSize):
+        window = None
+    x_off, y_off, x_size, y_size = window if window is not None else (0, 0, src_ds.RasterXSize, src_ds.RasterYSize)
+
+    # GDAL creation options of the step5 encoding profile
+    creation_options = gdal_creation_options(get_stage_profile('step5'), proximity_dtype)
 
     # Create the output raster file with compression options
     driver = gdal.GetDriverByName('GTiff')
-    out_ds = driver.Create(output_raster_path, src_ds.RasterXSize, src_ds.RasterYSize,1, gdal.GDT_Float32, options=creation_options)
+    out_ds = driver.Create(output_raster_path, x_size, y_size, 1, PROXIMITY_DTYPES[proximity_dtype], options=creation_options)
     if out_ds is None:
         print(f"Unable to create {output_raster_path}")
         return
 
-    out_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    # upper left corner of the window
+    x_origin, pixel_width, x_rotation, y_origin, y_rotation, pixel_height = src_ds.GetGeoTransform()
+    out_ds.SetGeoTransform((x_origin + x_off * pixel_width, pixel_width, x_rotation, y_origin + y_off * pixel_height, y_rotation, pixel_height))
     out_ds.SetProjection(src_ds.GetProjectionRef())
 
     # Initialize band to 0 (or another suitable no data value)
@@ -40,70 +73,173 @@ def calculate_proximity(input_raster_path, output_raster_path, max_distance):
     out_band.Fill(0)  # or another no data value
 
     # Calculate proximity
-    options = ['MAXDIST={}'.format(max_distance), 'VALUES=1', 'DISTUNITS=GEO']
-    gdal.ComputeProximity(src_ds.GetRasterBand(1), out_band, options)
+    if proximity_engine == 'edt':
+        compute_proximity_edt(input_raster_path, out_band, max_distance, max_workers=max_workers, window=window)
+    elif window is not None:
+        compute_proximity_gdal_window(input_raster_path, out_band, max_distance, window)
+    else:
+        options = ['MAXDIST={}'.format(max_distance), 'VALUES=1', 'DISTUNITS=GEO']
+        gdal.ComputeProximity(src_ds.GetRasterBand(1), out_band, options)
 
     # Clean up
     src_ds = None
     out_ds = None
     print(f"Proximity calculation completed for {input_raster_path}")
 
-def main():
-    input_path = r'data\\step4\\'
-    output_path = r'data\\step5\\'
-    setting_excel_path = r'data\\setting_excel\\'
-    input_excel_path = setting_excel_path + r'step4_excel_template.xlsx'
-    output_excel_path = setting_excel_path + r'step5_excel_template.xlsx'
+# proximity of the AOI grid cells to the features of a vector layer, written on the AOI grid in one stage
+@traced('calculate_vector_proximity')
+def calculate_vector_proximity(input_vector_path, output_raster_path, aoi_grid, max_distance, max_workers=1, proximity_dtype='float32'):
+    # GDAL creation options of the step5 encoding profile
+    creation_options = gdal_creation_options(get_stage_profile('step5'), proximity_dtype)
 
-    # Read the input Excel file
-    df_input_excel = pd.read_excel(input_excel_path)
+    driver = gdal.GetDriverByName('GTiff')
+    out_ds = driver.Create(output_raster_path, aoi_grid['width'], aoi_grid['height'], 1, PROXIMITY_DTYPES[proximity_dtype], options=creation_options)
+    if out_ds is None:
+        print(f"Unable to create {output_raster_path}")
+        return
 
-    # Initialize a list to keep track of processed files for the Excel output
-    processed_files = []
+    out_ds.SetGeoTransform(get_grid_geo_transform(aoi_grid))
+    out_ds.SetProjection(aoi_grid['crs'])
 
-    tif_df = df_input_excel[df_input_excel['file_name'].str.lower().str.endswith('.tif')]
+    compute_proximity_vector(input_vector_path, out_ds.GetRasterBand(1), aoi_grid, max_distance, max_workers=max_workers)
 
-    # Process '.tif' files for proximity calculation
-    for idx, row in tif_df.iterrows():
-        input_file_path = input_path + row['file_name']
-    
-        if row['proximity'] == 1:
-            output_file_name = os.path.splitext(row['file_name'])[0] + '_proximity.tif'
-            output_file_path = output_path + output_file_name
-            calculate_proximity(input_file_path, output_file_path, 50000)  # 50 km in meters
-    
+    out_ds = None
+    print(f"Proximity calculation completed for {input_vector_path}")
+
+# step3 vector a step4 '_rasterized.tif' was made from, None for other rasters
+# vector_format: format step3 wrote the vectors in (see encoding.VECTOR_FORMATS), files of other formats left by earlier runs are ignored
+def get_source_vector_path(file_name, vector_input_path, vector_format='GPKG'):
+    stem = os.path.splitext(file_name)[0]
+    if vector_input_path is None or not stem.endswith('_rasterized'):
+        return None
+    vector_path = vector_input_path + stem[:-len('_rasterized')] + VECTOR_FORMATS[vector_format]
+    return vector_path if os.path.exists(vector_path) else None
+
+def get_max_distance(row):
+    max_distance = pd.to_numeric(row.get('max_distance(m)'), errors='coerce')
+    return DEFAULT_MAX_DISTANCE if pd.isnull(max_distance) else float(max_distance)
+
+# max_workers: processes for the tiles/blocks of the 'edt' and 'vector' engines
+# vector_input_path: step3 directory with the source vectors of the 'vector' engine
+# aoi_grid: grid of the AOI raster, the proximity is only computed within the AOI (None computes the whole raster)
+# proximity_dtype: 'float32' or 'uint16' (see PROXIMITY_DTYPES), vector_format: format of the step3 vectors
+def proximity_row(row, input_path, output_path, proximity_engine='gdal', max_workers=1, vector_input_path=None, aoi_grid=None, proximity_dtype='float32',
+                  vector_format='GPKG'):
+    processed_files = []
+    input_file_path = input_path + row['file_name']
+
+    if row['proximity'] == 1:
+        output_file_name = os.path.splitext(row['file_name'])[0] + '_proximity.tif'
+        output_file_path = output_path + output_file_name
+        max_distance = get_max_distance(row)  # from the settings row, 50 km by default
+        input_vector_path = get_source_vector_path(row['file_name'], vector_input_path, vector_format) if proximity_engine == 'vector' else None
+        output_dtype = get_proximity_dtype(proximity_dtype, max_distance)
+
+        # distance to the vector features, skipped when the vector, AOI grid and max distance are unchanged since the last run
+        if input_vector_path is not None:
+            run_cached(lambda: calculate_vector_proximity(input_vector_path, output_file_path, aoi_grid, max_distance, max_workers, output_dtype),
+                       output_file_path, [input_vector_path],
+                       {'max_distance': max_distance, 'proximity_engine': proximity_engine, 'aoi_grid': aoi_grid, 'proximity_dtype': output_dtype,
+                        'encoding': get_stage_profile('step5')}, __file__)
+
+        # skipped when the raster, max distance and engine are unchanged since the last run
         else:
-            output_file_name = row['file_name']
-            output_file_path = output_path + output_file_name
-            shutil.copy(input_file_path, output_file_path)
-
-        # add file info to excel
+            raster_engine = 'edt' if proximity_engine == 'vector' else proximity_engine
+            # pixels of the raster that cover the AOI, the rest of the raster only matters within max_distance of them (the halo)
+            window = get_raster_window(input_file_path, get_grid_bounds(aoi_grid)) if aoi_grid is not None else None
+            run_cached(lambda: calculate_proximity(input_file_path, output_file_path, max_distance, raster_engine, max_workers, window, output_dtype),
+                       output_file_path, [input_file_path],
+                       {'max_distance': max_distance, 'proximity_engine': raster_engine, 'window': window, 'proximity_dtype': output_dtype,
+                        'encoding': get_stage_profile('step5')}, __file__)
+
+    else:
+        output_file_name = row['file_name']
+        output_file_path = output_path + output_file_name
+        run_cached(lambda: shutil.copy(input_file_path, output_file_path), output_file_path, [input_file_path], {}, __file__)
+
+    # add file info to excel
+    processed_files.append({
+        'file_name': output_file_name,
+        'source_resolution(m)': row['source_resolution(m)'],
+        'target_resolution(m)': row['target_resolution(m)'],
+        'source_CRS': row['source_CRS'],
+        'target_CRS': row['target_CRS'],
+        'AOI': row['AOI'],
+        'exclusion': None
+    })
+
+    # Check for exclusion
+    if row.get('exclusion') == 1:
+        exclusion_output_file_name = os.path.splitext(row['file_name'])[0] + '_exclusion.tif'
+        exclusion_output_file_path = output_path + exclusion_output_file_name
+        run_cached(lambda: shutil.copy(input_file_path, exclusion_output_file_path), exclusion_output_file_path, [input_file_path], {}, __file__)
+
+        # Add exclusion file info to processed files
         processed_files.append({
-            'file_name': output_file_name,
+            'file_name': exclusion_output_file_name,
             'source_resolution(m)': row['source_resolution(m)'],
             'target_resolution(m)': row['target_resolution(m)'],
             'source_CRS': row['source_CRS'],
             'target_CRS': row['target_CRS'],
             'AOI': row['AOI'],
-            'exclusion': None
+            'exclusion': row['exclusion']
         })
 
-        # Check for exclusion
-        if row.get('exclusion') == 1:
-            exclusion_output_file_name = os.path.splitext(row['file_name'])[0] + '_exclusion.tif'
-            exclusion_output_file_path = output_path + exclusion_output_file_name
-            shutil.copy(input_file_path, exclusion_output_file_path)
-
-            # Add exclusion file info to processed files
-            processed_files.append({
-                'file_name': exclusion_output_file_name,
-                'source_resolution(m)': row['source_resolution(m)'],
-                'target_resolution(m)': row['target_resolution(m)'],
-                'source_CRS': row['source_CRS'],
-                'target_CRS': row['target_CRS'],
-                'AOI': row['AOI'],
-                'exclusion': row['exclusion']
-            })
+    return processed_files
+
+# vector_input_path: step3 directory with the vectors for the 'vector' engine, by default the 'step3' directory next to input_path
+# proximity_dtype: data type of the proximity rasters, 'float32' or 'uint16' (see PROXIMITY_DTYPES)
+def process_files(df_input_excel, input_path, output_path, max_workers=1, proximity_engine='gdal', vector_input_path=None, proximity_dtype='float32',
+                  vector_format='GPKG'):
+    if proximity_engine not in PROXIMITY_ENGINES:
+        raise ValueError(f"Unknown proximity engine '{proximity_engine}', expected one of {PROXIMITY_ENGINES}")
+    # GDAL threads and block cache of each of the max_workers processes (see tuning.py)
+    apply_tuning('step5', max_workers)
+    if proximity_dtype not in PROXIMITY_DTYPES:
+        raise ValueError(f"Unknown proximity data type '{proximity_dtype}', expected one of {list(PROXIMITY_DTYPES)}")
+
+    tif_df = df_input_excel[df_input_excel['file_name'].str.lower().str.endswith('.tif')]
+
+    if vector_input_path is None:
+        vector_input_path = os.path.join(os.path.dirname(os.path.dirname(input_path)), 'step3', '')
+
+    # proximity is computed within the AOI only (step6 clips the rest away), the 'vector' engine writes it on the AOI grid
+    aoi_df = tif_df[pd.to_numeric(tif_df['AOI'], errors='coerce') == 1]
+    # (the union of every AOI when several are flagged)
+    aoi_grid = get_union_grid([get_raster_grid(input_path + file_name) for file_name in aoi_df['file_name']]) if len(aoi_df) else None
+    if proximity_engine == 'vector' and aoi_grid is None:
+        raise ValueError("The 'vector' proximity engine needs an AOI raster")
+
+    # Process '.tif' files for proximity calculation
+    # the 'edt' and 'vector' engines run the files one after another and spread the tiles of each file over the workers instead
+    if proximity_engine in ('edt', 'vector'):
+        return process_rows(proximity_row, tif_df.to_dict('records'), (input_path, output_path, proximity_engine, max_workers, vector_input_path, aoi_grid, proximity_dtype, vector_format), 1)
+    return process_rows(proximity_row, tif_df.to_dict('records'), (input_path, output_path, proximity_engine, 1, vector_input_path, aoi_grid, proximity_dtype, vector_format), max_workers)
+
+def main():
+    input_path = os.path.join('data', 'step4', '')
+    output_path = os.path.join('data', 'step5', '')
+    setting_excel_path = os.path.join('data', 'setting_excel', '')
+    input_excel_path = os.path.join(setting_excel_path, 'step4_excel_template.xlsx')
+    output_excel_path = os.path.join(setting_excel_path, 'step5_excel_template.xlsx')
+
+    # Read the input Excel file
+    df_input_excel = pd.read_excel(input_excel_path)
+
+    # number of parallel worker processes (MCA_MAX_WORKERS, 1 runs the files one after another)
+    max_workers = get_max_workers()
+
+    # proximity engine (MCA_PROXIMITY_ENGINE): 'gdal', 'edt' or 'vector'
+    proximity_engine = os.environ.get('MCA_PROXIMITY_ENGINE', 'gdal')
+
+    # data type of the proximity rasters (MCA_PROXIMITY_DTYPE): 'float32' or 'uint16'
+    proximity_dtype = os.environ.get('MCA_PROXIMITY_DTYPE', 'float32')
+
+    # Process files, keeping track of processed files for the Excel output
+    # format of the step3 vectors (MCA_VECTOR_FORMAT), read by the 'vector' engine
+    vector_format = get_vector_format()
+
+    processed_files = process_files(df_input_excel, input_path, output_path, max_workers, proximity_engine, None, proximity_dtype, vector_format)
 
     # Create a DataFrame from the processed_files list
     df_processed = pd.DataFrame(processed_files)
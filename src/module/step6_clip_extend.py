@@ -9,6 +9,13 @@ import os
 import pandas as pd
 from osgeo import gdal
 import shutil  # library for copying files
+from parallel import process_rows, get_max_workers
+from build_cache import run_cached
+from encoding import get_stage_profile, gdal_creation_options
+from grid import get_raster_grid, is_on_grid, get_grid_offset, crop_to_grid, get_grid_data_type, COMPACT_DATA_TYPES
+from tracing import traced
+from tuning import apply_tuning, gdal_warp_options
+from raster_stats import get_valid_range
 
 # find AOI extent
 def get_aoi_extent(aoi_raster_path):
@@ -25,36 +32,82 @@ def get_aoi_extent(aoi_raster_path):
 
     return min_x, min_y, max_x, max_y
 
+# GDAL creation options of the step6 encoding profile for a data type (see grid.get_grid_data_type)
+def get_clip_creation_options(data_type, nbits=None):
+    creation_options = gdal_creation_options(get_stage_profile('step6'), COMPACT_DATA_TYPES[data_type], nbits)
+    creation_options.append('BIGTIFF=YES')  # Optional, for handling large files
+    return creation_options
+
+# the layer keeps its data type when it is compact (uint8 scores and masks, uint16 distances, int16, float32), see grid.get_grid_data_type
+@traced('clip_extend')
 def clip_extend(input_raster_path, output_raster_path, aoi_extent):
     # AOI extent is passed directly
     min_x, min_y, max_x, max_y = aoi_extent
 
-
-    # Define GDAL creation options for high compression
-    creation_options = [
-        'TILED=YES',
-        'COMPRESS=DEFLATE',  # Use DEFLATE compression
-        'PREDICTOR=1',       # Use predictor 1 (suitable for integer data)
-        'ZLEVEL=9',           # Set the compression level (1=fastest, 9=best compression)
-        'BIGTIFF=YES',  # Optional, for handling large files
-    ]
+    data_type, nbits = get_grid_data_type(input_raster_path)
+    creation_options = get_clip_creation_options(data_type, nbits)
 
     # Clip the input raster with this extent
-    warp_options = gdal.WarpOptions(format='GTiff', outputType=gdal.GDT_Float32, outputBounds=[min_x, min_y, max_x, max_y], dstNodata=0, creationOptions=creation_options)
+    warp_options = gdal.WarpOptions(format='GTiff', outputType=data_type, outputBounds=[min_x, min_y, max_x, max_y], dstNodata=0, creationOptions=creation_options,
+                                   **gdal_warp_options('step6'))
     gdal.Warp(output_raster_path, input_raster_path, options=warp_options)
 
-def main():
-    input_path = r'data\\step5\\'
-    output_path = r'data\\step6\\'
-    setting_excel_path = r'data\\setting_excel\\'
-    input_excel_path = setting_excel_path + r'step5_excel_template.xlsx'
-    output_excel_path = setting_excel_path + r'step6_excel_template.xlsx'
+def clip_row(row, input_path, output_path, aoi_extent, aoi_grid):
+    input_file_path = input_path + row['file_name']
 
-    # Read the input Excel file
-    df_input_excel = pd.read_excel(input_excel_path)
+    if row['AOI'] == 1:
+        output_file_name = row['file_name']
+        output_file_path = output_path + output_file_name
+        run_cached(lambda: shutil.copy(input_file_path, output_file_path), output_file_path, [input_file_path], {}, __file__)
 
-    # Initialize a list to keep track of processed files for the Excel output
-    processed_files = []
+    else:
+        # Define paths for AOI and output raster
+        output_file_name = os.path.splitext(row['file_name'])[0] + '_clip.tif'
+        output_file_path = output_path + output_file_name
+        grid_offset = get_grid_offset(input_file_path, aoi_grid)
+
+        data_type, nbits = get_grid_data_type(input_file_path)
+
+        # already on the AOI grid in the data type the clip would write (e.g. fused warp in step3), the clip would not change it
+        if is_on_grid(input_file_path, aoi_grid, data_type):
+            run_cached(lambda: shutil.copy(input_file_path, output_file_path), output_file_path, [input_file_path], {}, __file__)
+
+        # pixel-aligned with the AOI grid (rasterized onto the AOI grid in step4), the AOI window is cut out without resampling
+        elif grid_offset is not None:
+            creation_options = get_clip_creation_options(data_type, nbits)
+            run_cached(lambda: crop_to_grid(input_file_path, output_file_path, aoi_grid, grid_offset, creation_options, data_type),
+                       output_file_path, [input_file_path], {'aoi_grid': aoi_grid, 'encoding': get_stage_profile('step6')}, __file__)
+
+        else:
+            # Perform clipping
+            # skipped when the raster and AOI extent are unchanged since the last run
+            run_cached(lambda: clip_extend(input_file_path, output_file_path, aoi_extent),  # Use the aoi_extent for clipping
+                       output_file_path, [input_file_path], {'aoi_extent': aoi_extent, 'encoding': get_stage_profile('step6')}, __file__)
+
+    # range of the valid values of the clipped layer, from its stored statistics or one GDAL pass (see raster_stats.get_valid_range)
+    value_min, value_max = get_valid_range(output_file_path)
+
+    # Add file info to excel
+    return [{
+        'file_name': output_file_name,
+        'source_resolution(m)': row['source_resolution(m)'],
+        'target_resolution(m)': row['target_resolution(m)'],
+        'source_CRS': row['source_CRS'],
+        'target_CRS': row['target_CRS'],
+        'AOI': row['AOI'],
+        'exclusion': row['exclusion'],
+        'value_min': value_min,
+        'value_max': value_max,
+        'most_suitable': None,
+        'suitable': None,
+        'least_suitable': None,
+        'exclusive_range': None,
+        'layer_weight': None
+    }]
+
+def process_files(df_input_excel, input_path, output_path, max_workers=1):
+    # GDAL threads, warp memory and block cache of each of the max_workers processes (see tuning.py)
+    apply_tuning('step6', max_workers)
 
     tif_df = df_input_excel[df_input_excel['file_name'].str.lower().str.endswith('.tif')]
 
@@ -62,40 +115,26 @@ def main():
     aoi_file_name = AOI_df.iloc[0]['file_name']  # Assuming first row contains the AOI raster
     aoi_file_path = input_path + aoi_file_name
     aoi_extent = get_aoi_extent(aoi_file_path)
+    aoi_grid = get_raster_grid(aoi_file_path)
 
     # Process '.tif' files for clipping extent
-    for idx, row in tif_df.iterrows():
-        input_file_path = input_path + row['file_name']
+    return process_rows(clip_row, tif_df.to_dict('records'), (input_path, output_path, aoi_extent, aoi_grid), max_workers)
 
-        if row['AOI'] == 1:
-            output_file_name = row['file_name']
-            output_file_path = output_path + output_file_name
-            shutil.copy(input_file_path, output_file_path)
+def main():
+    input_path = os.path.join('data', 'step5', '')
+    output_path = os.path.join('data', 'step6', '')
+    setting_excel_path = os.path.join('data', 'setting_excel', '')
+    input_excel_path = os.path.join(setting_excel_path, 'step5_excel_template.xlsx')
+    output_excel_path = os.path.join(setting_excel_path, 'step6_excel_template.xlsx')
 
-        else:
-            # Define paths for AOI and output raster
-            output_file_name = os.path.splitext(row['file_name'])[0] + '_clip.tif'
-            output_file_path = output_path + output_file_name
-            aoi_raster_path = input_file_path  # Assuming AOI raster is the same as input
+    # Read the input Excel file
+    df_input_excel = pd.read_excel(input_excel_path)
 
-            # Perform clipping
-            clip_extend(input_file_path, output_file_path, aoi_extent)  # Use the aoi_extent for clipping
-
-        # Add file info to excel
-        processed_files.append({
-            'file_name': output_file_name,
-            'source_resolution(m)': row['source_resolution(m)'],
-            'target_resolution(m)': row['target_resolution(m)'],
-            'source_CRS': row['source_CRS'],
-            'target_CRS': row['target_CRS'],
-            'AOI': row['AOI'],
-            'exclusion': row['exclusion'],
-            'most_suitable': None,
-            'suitable': None,
-            'least_suitable': None,
-            'exclusive_range': None,
-            'layer_weight': None
-        })
+    # number of parallel worker processes (MCA_MAX_WORKERS, 1 runs the files one after another)
+    max_workers = get_max_workers()
+
+    # Process files, keeping track of processed files for the Excel output
+    processed_files = process_files(df_input_excel, input_path, output_path, max_workers)
 
     # Create a DataFrame from the processed_files list
     df_processed = pd.DataFrame(processed_files)
@@ -7,11 +7,20 @@ Description: Calculate Range
 
 import os
 import pandas as pd
-from osgeo import gdal
+from osgeo import gdal, gdal_array
 import shutil  # library for copying files
 import numpy as np
 import re
 import rasterio
+from concurrent.futures import ProcessPoolExecutor
+from build_cache import run_cached, check_cache, save_cache
+from parallel import map_ordered, get_max_workers
+from grid import iter_tiles
+from layer_cube import write_layer_cube, get_cube_paths
+from encoding import get_stage_profile, gdal_creation_options, rasterio_creation_options, get_cog_options
+from tracing import traced
+from tuning import apply_tuning
+from raster_stats import read_raster_stats, get_value_range
 
 # Function to process range strings
 def process_range_str(range_str, raster_min_val, raster_max_val):
@@ -32,10 +41,12 @@ def process_range_str(range_str, raster_min_val, raster_max_val):
             return {'values': numbers}
 
 # This function takes a range string as input and returns a dictionary containing the range type and actual values.
-def parse_range(layer_name, row_data, raster_data):
+# raster_min/raster_max: minimum/maximum of the raster when they are already known (see get_raster_min_max), raster_data is then not needed
+def parse_range(layer_name, row_data, raster_data, raster_min=None, raster_max=None):
     # extract minimum/maximum values from raster data
-    raster_min = np.min(raster_data)
-    raster_max = np.max(raster_data)
+    if raster_min is None or raster_max is None:
+        raster_min = np.min(raster_data)
+        raster_max = np.max(raster_data)
 
     # Initialize dictionaries
     exclusive_info = {}
@@ -60,10 +71,10 @@ def parse_range(layer_name, row_data, raster_data):
     return range_dictionary
 
 
-def reclassify_by_range(layer_name, raster, raster_data, raster_output_path, ranges, exclusive_yn):
-    # create new raster to save reclassed data
-    reclassified_data = np.zeros_like(raster_data)
-    
+# This function flattens the range dictionary into (min, max, score) intervals in the order they are applied (later intervals overwrite earlier ones).
+def range_intervals(layer_name, ranges, exclusive_yn):
+    intervals = []
+
     for score, value_range in ranges.items():
          # For cases where the score is 0 and the exclusivity is true
         if score == 0 and exclusive_yn == 'Y':
@@ -75,45 +86,198 @@ def reclassify_by_range(layer_name, raster, raster_data, raster_output_path, ran
             max_val = int(max_val_raw) if max_val_raw is not None else None
 
             if min_val is not None and max_val is not None:
-                condition = (raster_data >= min_val) & (raster_data <= max_val)
-                reclassified_data[condition] = 1
+                intervals.append((min_val, max_val, 1))
             break
         else:
             # land cover
-            if 'land_cover' in layer_name and 'values' in value_range: 
+            if 'land_cover' in layer_name and 'values' in value_range:
                 for val in value_range['values']:
-                    condition = (raster_data == val)
-                    reclassified_data[condition] = score
+                    intervals.append((val, val, score))
             # min-max ranges
             elif value_range != {}:
                 min_val_raw = value_range.get('min', None)
                 max_val_raw = value_range.get('max', None)
-                
+
                 min_val = int(min_val_raw) if min_val_raw is not None else None
                 max_val = int(max_val_raw) if max_val_raw is not None else None
-                
+
                 if min_val is not None and max_val is not None:
-                    condition = (raster_data >= min_val) & (raster_data <= max_val)
-                    reclassified_data[condition] = score
+                    intervals.append((min_val, max_val, score))
+
+    return intervals
+
+# This function compiles the intervals into a reclassification kernel for the given raster data type.
+# 8/16 bit integer rasters get a direct lookup table over every representable value,
+# other rasters get sorted breakpoints with the score of each breakpoint and of each gap between breakpoints.
+def compile_reclassification(intervals, dtype):
+    dtype = np.dtype(dtype)
+
+    if np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2:
+        index_dtype = np.dtype('u{}'.format(dtype.itemsize))
+        # table index -> raster value (signed values are looked up through their unsigned bit pattern)
+        table_values = np.arange(2 ** (8 * dtype.itemsize), dtype=index_dtype).view(dtype).astype(np.int64)
+        lookup_table = np.zeros(table_values.shape, dtype=dtype)
+        for min_val, max_val, score in intervals:
+            lookup_table[(table_values >= min_val) & (table_values <= max_val)] = score
+        return {'lookup_table': lookup_table, 'index_dtype': index_dtype}
+
+    # integer bounds are clipped to the data type, ranges outside of it can never match
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        intervals = [(max(min_val, info.min), min(max_val, info.max), score) for min_val, max_val, score in intervals if min_val <= info.max and max_val >= info.min]
+
+    # bounds are compared in the raster data type, the same as comparing the raster array with the bounds
+    min_values = np.array([interval[0] for interval in intervals]).astype(dtype)
+    max_values = np.array([interval[1] for interval in intervals]).astype(dtype)
+    breakpoints = np.unique(np.concatenate([min_values, max_values]))
+
+    point_scores = np.zeros(breakpoints.shape, dtype=dtype)
+    gap_scores = np.zeros(breakpoints.size + 1, dtype=dtype)  # gap i lies between breakpoints i-1 and i, the outer gaps stay 0
+    for min_val, max_val, (_, _, score) in zip(min_values, max_values, intervals):
+        point_scores[(breakpoints >= min_val) & (breakpoints <= max_val)] = score
+        gap_scores[1:-1][(breakpoints[:-1] >= min_val) & (breakpoints[1:] <= max_val)] = score
+
+    return {'breakpoints': breakpoints, 'point_scores': point_scores, 'gap_scores': gap_scores}
+
+# This function scores the raster data in a single pass with a compiled kernel.
+def apply_reclassification(kernel, raster_data):
+    if 'lookup_table' in kernel:
+        return kernel['lookup_table'][raster_data.view(kernel['index_dtype'])]
+
+    breakpoints = kernel['breakpoints']
+    if breakpoints.size == 0:
+        return np.zeros_like(raster_data)
+
+    index = np.searchsorted(breakpoints, raster_data, side='left')
+    on_breakpoint = np.take(breakpoints, index, mode='clip') == raster_data
+    return np.where(on_breakpoint, np.take(kernel['point_scores'], index, mode='clip'), kernel['gap_scores'][index])
+
+# minimum and maximum of one tile (x_off, y_off, x_size, y_size) of a raster, for get_raster_min_max
+def min_max_tile(input_raster_path, tile):
+    raster_data = gdal.Open(input_raster_path).GetRasterBand(1).ReadAsArray(*tile)
+    return np.min(raster_data), np.max(raster_data)
+
+# scores of one tile of a raster, for reclassify_by_range
+def reclassify_tile(input_raster_path, tile, kernel):
+    raster_data = gdal.Open(input_raster_path).GetRasterBand(1).ReadAsArray(*tile)
+    return apply_reclassification(kernel, raster_data)
+
+# minimum and maximum of every cell of a raster (NoData cells included, as np.min/np.max of the whole array)
+# taken from the statistics stored with the layer (MCA_STATISTICS=1, see raster_stats.py), otherwise the tiles are scanned once on the executor
+@traced('get_raster_min_max', 0, None)
+def get_raster_min_max(input_raster_path, executor, tile_size=1024, max_pending=None):
+    stats = read_raster_stats(input_raster_path)
+    if stats is not None:
+        return get_value_range(stats)
+
+    raster = gdal.Open(input_raster_path)
+    tiles = list(iter_tiles(raster.RasterXSize, raster.RasterYSize, tile_size))
+    raster = None
 
-    driver = gdal.GetDriverByName('GTiff')
-    new_raster = driver.Create(raster_output_path, raster.RasterXSize, raster.RasterYSize, 1, gdal.GDT_Float32)
+    tile_min_max = list(map_ordered(executor, min_max_tile, [(input_raster_path, tile) for tile in tiles], max_pending or len(tiles)))
+    return np.min([tile_min for tile_min, tile_max in tile_min_max]), np.max([tile_max for tile_min, tile_max in tile_min_max])
+
+# scores (0-3) are written as uint8, exclusion masks (0/1, exclusive_yn 'Y') as bit-packed uint8 (NBITS=1)
+# cog_options: COG creation options (see encoding.get_cog_options), None writes a GeoTIFF with the step7 encoding profile
+# executor: process pool that scores the raster in tile_size x tile_size tiles (raster_data is then not needed), this process writes them in tile order
+@traced('reclassify_by_range', 0, 3)
+def reclassify_by_range(layer_name, raster, raster_data, raster_output_path, ranges, exclusive_yn, cog_options=None, executor=None, tile_size=1024, max_pending=2):
+    # compile the ranges once and score every cell in one pass
+    dtype = raster_data.dtype if raster_data is not None else gdal_array.GDALTypeCodeToNumericTypeCode(raster.GetRasterBand(1).DataType)
+    kernel = compile_reclassification(range_intervals(layer_name, ranges, exclusive_yn), dtype)
+
+    # the COG driver only copies complete datasets, the scores are built in memory first
+    if cog_options:
+        driver = gdal.GetDriverByName('MEM')
+        new_raster = driver.Create('', raster.RasterXSize, raster.RasterYSize, 1, gdal.GDT_Byte)
+    else:
+        driver = gdal.GetDriverByName('GTiff')
+        nbits = 1 if exclusive_yn == 'Y' else None
+        new_raster = driver.Create(raster_output_path, raster.RasterXSize, raster.RasterYSize, 1, gdal.GDT_Byte, options=gdal_creation_options(get_stage_profile('step7'), 'uint8', nbits))
     new_band = new_raster.GetRasterBand(1)
-    new_band.WriteArray(reclassified_data)
+    if executor is None:
+        new_band.WriteArray(apply_reclassification(kernel, raster_data))
+    else:
+        tiles = list(iter_tiles(raster.RasterXSize, raster.RasterYSize, tile_size))
+        tile_args = [(raster.GetDescription(), tile, kernel) for tile in tiles]
+        for tile, reclassified_data in zip(tiles, map_ordered(executor, reclassify_tile, tile_args, max_pending)):
+            new_band.WriteArray(reclassified_data, tile[0], tile[1])
     new_raster.SetProjection(raster.GetProjection())
     new_raster.SetGeoTransform(raster.GetGeoTransform())
     new_band.FlushCache()
+
+    if cog_options:
+        gdal.GetDriverByName('COG').CreateCopy(raster_output_path, new_raster, options=['{}={}'.format(key, value) for key, value in cog_options.items()])
+
     raster = None
     new_raster = None
 
 
-def process_range_calculation(input_path, output_path, input_excel_path, output_excel_path):
-    # Read the input Excel file
-    df_input_excel = pd.read_excel(input_excel_path)
+# FPV treats GLOBathy waterbodies as AOI, PV treats the cells other than GLOBathy waterbodies as AOI
+def globathy_mask(raster_data, is_fpv):
+    # FPV
+    if is_fpv:
+        # Assigning 1 to all cells that are not 'no data'
+        # Here, for example, we assume 'no data' values to be 0.
+        # Actual 'no data' values should be determined based on the metadata of the raster data.
+        return raster_data != 0  # Creating a mask for all non-zero values
+
+    # PV
+    # Assigning 1 to all cells with 'no data' or a value of 0
+    # Here, we also assume 'no data' values to be 0.
+    # Actual 'no data' values should be determined based on the metadata of the raster data.
+    return (raster_data == 0)  # Creating a mask for cells with a value of 0
+
+
+# step7 fields of a layer kept in the layer cube header
+LAYER_CUBE_FIELDS = ['AOI', 'exclusion', 'layer_weight']
+
+# every output layer of step7 in one memory-mapped cube (see layer_cube.py), skipped when the layers are unchanged since the last run
+def build_layer_cube(processed_files, output_path, tile_size=1024):
+    cube_path = output_path + 'layer_cube'
+    data_path, header_path = get_cube_paths(cube_path)
+    layer_paths = [output_path + processed_file['file_name'] for processed_file in processed_files]
+    layer_fields = [{field: (None if pd.isnull(processed_file[field]) else processed_file[field]) for field in LAYER_CUBE_FIELDS} for processed_file in processed_files]
+
+    up_to_date, cache_entry = check_cache(data_path, layer_paths, {'layer_fields': layer_fields, 'tile_size': tile_size}, __file__)
+    if up_to_date and os.path.exists(header_path):
+        return
+
+    write_layer_cube(cube_path, layer_paths, layer_fields, tile_size)
+    save_cache(data_path, cache_entry)
+
+# layer_cube: also write the layers as one memory-mapped layer cube for step8, in cube_tile_size tiles (the step8 block size,
+# so every step8 window is one tile and is read from the mapped file without copying)
+# max_workers: processes that score each layer in tile_size x tile_size tiles, 1 scores whole layers in this process
+def process_files(df_input_excel, input_path, output_path, layer_cube=False, max_workers=1, tile_size=1024, cube_tile_size=1024):
+    # GDAL threads and block cache of each of the max_workers processes (see tuning.py)
+    apply_tuning('step7', max_workers)
 
     # Initialize a list to keep track of processed files for the Excel output
     processed_files = []
 
+    # one process pool for the tiles of every layer, the tiles are written by this process in tile order
+    executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+    try:
+        process_layers(df_input_excel, input_path, output_path, processed_files, executor, tile_size, 2 * max_workers)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if layer_cube:
+        build_layer_cube(processed_files, output_path, cube_tile_size)
+
+    return processed_files
+
+# step7 outputs of every row, appended to processed_files
+def process_layers(df_input_excel, input_path, output_path, processed_files, executor=None, tile_size=1024, max_pending=2):
+    # scored layers as Cloud-Optimized GeoTIFFs (MCA_COG=step7), scores are classes so the overviews take the nearest value
+    cog_options = get_cog_options('step7', 'uint8', 'NEAREST')
+
+    # GLOBathy layers processed so far, their FPV/PV masks accumulate in array_calculation
+    globathy_layers = []
+    applied_globathy_layers = 0
+
     # Process '.tif' files for range calculation
     for idx, row in df_input_excel.iterrows():
         input_file_path = input_path + row['file_name']
@@ -124,7 +288,7 @@ def process_range_calculation(input_path, output_path, input_excel_path, output_
             output_file_path = output_path + output_file_name
             
             # no processing, just copying
-            shutil.copy(input_file_path, output_file_path)
+            run_cached(lambda: shutil.copy(input_file_path, output_file_path), output_file_path, [input_file_path], {}, __file__)
 
             # Add file info to excel
             processed_files.append({
@@ -140,27 +304,69 @@ def process_range_calculation(input_path, output_path, input_excel_path, output_
 
             # Creating a base frame using the AOI file
             if 'AOI' in row['file_name']:
-                # create base raster array for raster calculation, should be 0 value
+                # create base raster array for raster calculation, should be 0 value (a 0/1 mask, one byte per cell)
+                AOI_file_path = input_file_path
                 with rasterio.open(input_file_path) as AOI_dataset:
-                    array_calculation = np.zeros_like(AOI_dataset.read(1).astype(float))
+                    array_calculation = np.zeros((AOI_dataset.height, AOI_dataset.width), dtype=np.uint8)
 
         # none AOI/exclusion
         else:
+            base_file_name = os.path.splitext(row['file_name'])[0]
+            has_suitability = pd.notnull(row['most_suitable'])
+            has_exclusive_range = pd.notnull(row['exclusive_range'])
+            is_globathy = 'GLOBathy' in row['file_name']
+
+            # outputs built from the same layer and range settings in a previous run are skipped
+            # (layer_weight is only used in step8, so changing a weight does not rebuild any step7 output)
+            rebuild_scored = rebuild_exclusion = rebuild_globathy = False
+            if has_suitability:
+                scored_file_name = base_file_name + '_scored.tif'
+                suitability_params = {'most_suitable': row['most_suitable'], 'suitable': row['suitable'], 'least_suitable': row['least_suitable'],
+                                      'encoding': get_stage_profile('step7')}
+                if cog_options:
+                    suitability_params['cog'] = cog_options
+                scored_up_to_date, scored_cache = check_cache(output_path + scored_file_name, [input_file_path], suitability_params, __file__)
+                rebuild_scored = not scored_up_to_date
+
+            if has_exclusive_range:
+                exclusion_file_name = base_file_name + '_exclusion.tif'
+                exclusion_up_to_date, exclusion_cache = check_cache(output_path + exclusion_file_name, [input_file_path], {'exclusive_range': row['exclusive_range'], 'encoding': get_stage_profile('step7')}, __file__)
+                rebuild_exclusion = not exclusion_up_to_date
+
+            if is_globathy:
+                globathy_layers.append((input_file_path, row['AOI'] == 1))
+                globathy_file_name = base_file_name + ('_FPV.tif' if row['AOI'] == 1 else '_PV.tif')
+                globathy_up_to_date, globathy_cache = check_cache(output_path + globathy_file_name, [AOI_file_path] + [path for path, is_fpv in globathy_layers],
+                                                                  {'FPV': [is_fpv for path, is_fpv in globathy_layers], 'encoding': get_stage_profile('step7')}, __file__)
+                rebuild_globathy = not globathy_up_to_date
+
+            # read and decode the layer once, the scored, exclusion and FPV/PV outputs are all produced from this buffer
+            # (with a process pool, only the FPV/PV masks need the whole layer, the scores are computed tile by tile)
+            raster_data = None
+            if rebuild_scored or rebuild_exclusion or rebuild_globathy:
+                raster = gdal.Open(input_file_path)
+                band = raster.GetRasterBand(1)
+                if executor is None or rebuild_globathy:
+                    raster_data = band.ReadAsArray()
+
+            # raster minimum/maximum (NoData cells included) for both the suitability and the exclusive ranges:
+            # from the buffer when the layer is in memory, otherwise from its stored statistics or one tiled scan
+            if rebuild_scored or rebuild_exclusion:
+                if raster_data is None:
+                    raster_min, raster_max = get_raster_min_max(input_file_path, executor, tile_size, max_pending)
+                    range_dict = parse_range(base_file_name, row, None, raster_min, raster_max)
+                else:
+                    range_dict = parse_range(base_file_name, row, raster_data)
+
             # calculate range of suitability
-            if pd.notnull(row['most_suitable']):
-                base_file_name = os.path.splitext(row['file_name'])[0]
-                output_file_name = base_file_name + '_scored.tif'
+            if has_suitability:
+                output_file_name = scored_file_name
                 output_file_path = output_path + output_file_name
 
-                suitability_raster = gdal.Open(input_file_path)
-                band = suitability_raster.GetRasterBand(1)
-                raster_data = band.ReadAsArray()
-
-                # Updated to pass raster_data directly
-                range_dict = parse_range(base_file_name, row, raster_data)
-
-                # reclassify_by_range updated to remove the unnecessary 'raster' parameter
-                reclassify_by_range(base_file_name, suitability_raster, raster_data, output_file_path, range_dict, 'N')
+                if rebuild_scored:
+                    reclassify_by_range(base_file_name, raster, raster_data, output_file_path, range_dict, 'N', cog_options,
+                                        executor if raster_data is None else None, tile_size, max_pending)
+                    save_cache(output_file_path, scored_cache)
 
                 # Add file info to excel
                 processed_files.append({
@@ -175,20 +381,14 @@ def process_range_calculation(input_path, output_path, input_excel_path, output_
                 })
 
             # calculate exclusive range -> Create new file with "_exclusion" to Exclusive_range + add 1 to exclusion column
-            if pd.notnull(row['exclusive_range']):
-                base_file_name = os.path.splitext(row['file_name'])[0]
-                output_file_name = base_file_name + '_exclusion.tif'
+            if has_exclusive_range:
+                output_file_name = exclusion_file_name
                 output_file_path = output_path + output_file_name
 
-                raster = gdal.Open(input_file_path)
-                band = raster.GetRasterBand(1)
-                raster_data = band.ReadAsArray()
-
-                # Updated to pass raster_data directly
-                range_dict = parse_range(base_file_name, row, raster_data)
-
-                # reclassify_by_range updated to remove the unnecessary 'raster' parameter
-                reclassify_by_range(base_file_name, raster, raster_data, output_file_path, range_dict, 'Y')
+                if rebuild_exclusion:
+                    reclassify_by_range(base_file_name, raster, raster_data, output_file_path, range_dict, 'Y', None,
+                                        executor if raster_data is None else None, tile_size, max_pending)
+                    save_cache(output_file_path, exclusion_cache)
 
                 # Add file info to excel
                 processed_files.append({
@@ -201,94 +401,57 @@ def process_range_calculation(input_path, output_path, input_excel_path, output_
                     'exclusive_range': row['exclusive_range'],
                     'layer_weight': None
                 })
-            
+
 
             # add AOI filter for Floating Photovoltaic(FPV)/Ground-mounted Solar Photovoltaic(PV)
-            if 'GLOBathy' in row['file_name']:
-                # FPV
-                if row['AOI'] == 1:
-                    # Open GLOBathy file
-                    with rasterio.open(input_path + row['file_name']) as globathy_dataset:
-                        # read GLOBathy data
-                        globathy_data = globathy_dataset.read(1).astype(float)
-                        
-                        # Assigning 1 to all cells that are not 'no data'
-                        # Here, for example, we assume 'no data' values to be 0.
-                        # Actual 'no data' values should be determined based on the metadata of the raster data.
-                        mask = globathy_data != 0  # Creating a mask for all non-zero values
-                        array_calculation[mask] = 1  # Assigning 1 to masked locations
-
-                        base_file_name = os.path.splitext(row['file_name'])[0]
-                        output_file_name = base_file_name + '_FPV.tif'
-                        output_file_path = output_path + output_file_name
-
-                        # Logic for saving the converted raster data to a file
-                        new_dataset = rasterio.open(
-                            output_file_path, 'w',
-                            driver='GTiff',
-                            height=array_calculation.shape[0],
-                            width=array_calculation.shape[1],
-                            count=1,
-                            dtype=array_calculation.dtype,
-                            crs=AOI_dataset.crs,
-                            transform=AOI_dataset.transform,
-                        )
-                        new_dataset.write(array_calculation, 1)
-                        new_dataset.close()
-
-                        # Adding processed file information from GLOBathy to the processed_files list
-                        processed_files.append({
-                            'file_name': output_file_name,
-                            'AOI': 1,
-                            'exclusion': None,
-                            'most_suitable': None,
-                            'suitable': None,
-                            'least_suitable': None,
-                            'exclusive_range': None,
-                            'layer_weight': None
-                        })
-                # PV
-                else:
-                    # read PV file
-                    with rasterio.open(input_path + row['file_name']) as pv_dataset:
-                        # read PV data
-                        pv_data = pv_dataset.read(1).astype(float)
-                        
-                        # Assigning 1 to all cells with 'no data' or a value of 0
-                        # Here, we also assume 'no data' values to be 0.
-                        # Actual 'no data' values should be determined based on the metadata of the raster data.
-                        mask = (pv_data == 0)  # Creating a mask for cells with a value of 0
-                        array_calculation[mask] = 1  # Assigning 1 to masked locations
-
-                        base_file_name = os.path.splitext(row['file_name'])[0]
-                        output_file_name = base_file_name + '_PV.tif'
-                        output_file_path = output_path + output_file_name
-
-                        # Logic for saving the converted raster data to a file
-                        new_dataset = rasterio.open(
-                            output_file_path, 'w',
-                            driver='GTiff',
-                            height=array_calculation.shape[0],
-                            width=array_calculation.shape[1],
-                            count=1,
-                            dtype=array_calculation.dtype,
-                            crs=AOI_dataset.crs,
-                            transform=AOI_dataset.transform,
-                        )
-                        new_dataset.write(array_calculation, 1)
-                        new_dataset.close()
-
-                        # Adding processed file information from GLOBathy to the processed_files list
-                        processed_files.append({
-                            'file_name': output_file_name,
-                            'AOI': 1,
-                            'exclusion': None,
-                            'most_suitable': None,
-                            'suitable': None,
-                            'least_suitable': None,
-                            'exclusive_range': None,
-                            'layer_weight': None
-                        })
+            if is_globathy:
+                output_file_name = globathy_file_name
+                output_file_path = output_path + output_file_name
+
+                if rebuild_globathy:
+                    # masks of earlier GLOBathy layers whose outputs were up to date are applied first
+                    for globathy_file_path, is_fpv in globathy_layers[applied_globathy_layers:-1]:
+                        array_calculation[globathy_mask(gdal.Open(globathy_file_path).GetRasterBand(1).ReadAsArray(), is_fpv)] = 1
+
+                    array_calculation[globathy_mask(raster_data, row['AOI'] == 1)] = 1  # Assigning 1 to masked locations
+                    applied_globathy_layers = len(globathy_layers)
+
+                    # Logic for saving the converted raster data to a file, bit-packed (NBITS=1)
+                    new_dataset = rasterio.open(
+                        output_file_path, 'w',
+                        driver='GTiff',
+                        height=array_calculation.shape[0],
+                        width=array_calculation.shape[1],
+                        count=1,
+                        dtype=array_calculation.dtype,
+                        crs=AOI_dataset.crs,
+                        transform=AOI_dataset.transform,
+                        **rasterio_creation_options(get_stage_profile('step7'), array_calculation.dtype, 1)
+                    )
+                    new_dataset.write(array_calculation, 1)
+                    new_dataset.close()
+                    save_cache(output_file_path, globathy_cache)
+
+                # Adding processed file information from GLOBathy to the processed_files list
+                processed_files.append({
+                    'file_name': output_file_name,
+                    'AOI': 1,
+                    'exclusion': None,
+                    'most_suitable': None,
+                    'suitable': None,
+                    'least_suitable': None,
+                    'exclusive_range': None,
+                    'layer_weight': None
+                })
+
+            raster = None
+
+
+def process_range_calculation(input_path, output_path, input_excel_path, output_excel_path, layer_cube=False, max_workers=1):
+    # Read the input Excel file
+    df_input_excel = pd.read_excel(input_excel_path)
+
+    processed_files = process_files(df_input_excel, input_path, output_path, layer_cube, max_workers)
 
     # Create a DataFrame from the processed_files list
     df_processed = pd.DataFrame(processed_files)
@@ -297,12 +460,17 @@ def process_range_calculation(input_path, output_path, input_excel_path, output_
     df_processed.to_excel(output_excel_path, index=False)
 
 def main():
-    input_path = r'data\\step6\\'
-    output_path = r'data\\step7\\'
-    setting_excel_path = r'data\\setting_excel\\'
-    input_excel_path = setting_excel_path + r'step6_excel_template.xlsx'
-    output_excel_path = setting_excel_path + r'step7_excel_template.xlsx'
-    process_range_calculation(input_path, output_path, input_excel_path, output_excel_path)
+    input_path = os.path.join('data', 'step6', '')
+    output_path = os.path.join('data', 'step7', '')
+    setting_excel_path = os.path.join('data', 'setting_excel', '')
+    input_excel_path = os.path.join(setting_excel_path, 'step6_excel_template.xlsx')
+    output_excel_path = os.path.join(setting_excel_path, 'step7_excel_template.xlsx')
+    # write the layers as one memory-mapped layer cube for step8 (MCA_LAYER_CUBE=1)
+    layer_cube = os.environ.get('MCA_LAYER_CUBE') == '1'
+    # number of parallel worker processes scoring the tiles of each layer (MCA_MAX_WORKERS, 1 scores whole layers)
+    max_workers = get_max_workers()
+
+    process_range_calculation(input_path, output_path, input_excel_path, output_excel_path, layer_cube, max_workers)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
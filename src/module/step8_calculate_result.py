@@ -5,14 +5,110 @@ March 2024
 Description: Calculate MCA Result
 """
 
+import os
 import pandas as pd
 import rasterio
+import rasterio.shutil
+from rasterio.windows import Window
 import numpy as np
-import copy
+from build_cache import check_cache, save_cache
+from encoding import get_stage_profile, rasterio_creation_options, get_cog_options
+from concurrent.futures import ProcessPoolExecutor
+from layer_cube import LayerCube, get_cube_paths
+from parallel import map_ordered, get_max_workers
+from map_algebra import WindowLayers, compile_expression, get_expression, get_product_dtype, zero_nodata, DEFAULT_EXPRESSION
+from tracing import traced
+from tuning import apply_tuning
 
-def process_result_calculation(input_path, output_path, input_excel_path):
-    # create panda data frame for each purpose
-    df_input_excel = pd.read_excel(input_excel_path)
+# iterate over the raster grid window by window (row by row, left to right)
+def iter_windows(width, height, block_size=None):
+    # without block size, the whole raster is one window
+    if not block_size:
+        yield Window(0, 0, width, height)
+        return
+
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield Window(col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off))
+
+# 1 - mask in the narrowest signed type that holds it (int16 for uint8 masks), unsigned masks would wrap around
+def invert_mask(mask):
+    return np.subtract(1, mask, dtype=np.promote_types(mask.dtype, np.int8))
+
+# the layers of a window for a map algebra kernel (see map_algebra.py), named by their file names
+# the AOI layer and the non-scored layers with 'AOI' 1 make up the AOI mask, the ones with 'exclusion' 1 the exclusion mask
+def get_window_layers(window, AOI_dataset, scored_datasets, nonscored_datasets, no_data_value=0):
+    AOI_file_name = os.path.basename(AOI_dataset.name)
+    aoi_layers = [(AOI_file_name, AOI_dataset)]
+    exclusion_layers = []
+    for dataset, include_AOI, exclude in nonscored_datasets:
+        file_name = os.path.basename(dataset.name)
+        if include_AOI == 1:
+            if file_name != AOI_file_name:
+                aoi_layers.append((file_name, dataset))
+        elif exclude == 1:
+            exclusion_layers.append((file_name, dataset))
+
+    return WindowLayers(window, [(os.path.basename(dataset.name), dataset) for dataset in scored_datasets], aoi_layers, exclusion_layers, no_data_value)
+
+# kernel: compiled map algebra expression (see map_algebra.compile_expression), None evaluates DEFAULT_EXPRESSION
+# the whole expression is evaluated on the window, every temporary array is the size of the window
+def calculate_window(window, AOI_dataset, scored_datasets, nonscored_datasets, no_data_value=0, kernel=None):
+    layers = get_window_layers(window, AOI_dataset, [dataset for dataset, layer_weight_rate in scored_datasets], nonscored_datasets, no_data_value)
+    kernel = kernel or compile_expression(DEFAULT_EXPRESSION)
+    return kernel(layers, [layer_weight_rate for dataset, layer_weight_rate in scored_datasets])
+
+# a layer opened from the layer cube when the cube holds it, otherwise from its GeoTIFF
+def open_layer(input_path, file_name, layer_cube=None):
+    if layer_cube is not None and file_name in layer_cube.layer_names:
+        return layer_cube.layer(file_name)
+    return rasterio.open(input_path + file_name)
+
+# layers and expression kernel of a worker process, opened once by init_window_worker
+_window_worker = None
+
+# scored_layers: [(file_name, layer_weight_rate)], nonscored_layers: [(file_name, AOI, exclusion)], kernel: None for the batched scenario formula
+def init_window_worker(input_path, AOI_file_name, scored_layers, nonscored_layers, layer_cube_path, expression, scenarios):
+    global _window_worker
+    layer_cube = LayerCube(layer_cube_path) if layer_cube_path else None
+    _window_worker = {
+        'AOI_dataset': open_layer(input_path, AOI_file_name, layer_cube),
+        'scored_datasets': [(open_layer(input_path, file_name, layer_cube), layer_weight_rate) for file_name, layer_weight_rate in scored_layers],
+        'nonscored_datasets': [(open_layer(input_path, file_name, layer_cube), include_AOI, exclude) for file_name, include_AOI, exclude in nonscored_layers],
+        'kernel': None if scenarios and expression == DEFAULT_EXPRESSION else compile_expression(expression),
+    }
+
+# result of one window in a worker process: calculate_window, or calculate_scenario_window when rate_matrix is given
+def calculate_window_worker(window, no_data_value, rate_matrix=None):
+    worker = _window_worker
+    if rate_matrix is None:
+        array_calculation = calculate_window(window, worker['AOI_dataset'], worker['scored_datasets'], worker['nonscored_datasets'], no_data_value, worker['kernel'])
+    else:
+        array_calculation = calculate_scenario_window(window, worker['AOI_dataset'], [dataset for dataset, layer_weight_rate in worker['scored_datasets']],
+                                                      worker['nonscored_datasets'], rate_matrix, no_data_value, worker['kernel'])
+    return array_calculation.astype(np.float32)
+
+# results of the windows in window order, computed in max_workers processes that each open the layers once (see init_window_worker)
+# every window is computed exactly as in this process, and the caller writes them in order, so the output does not depend on scheduling
+def map_windows(windows, max_workers, worker_args, no_data_value, rate_matrix=None):
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_window_worker, initargs=worker_args) as executor:
+        yield from map_ordered(executor, calculate_window_worker, [(window, no_data_value, rate_matrix) for window in windows], 2 * max_workers)
+
+# files the layers are read from, for the rebuild cache
+def get_input_file_paths(input_path, file_names, layer_cube_path=None, layer_cube=None):
+    if layer_cube is None:
+        return [input_path + file_name for file_name in file_names]
+    return list(get_cube_paths(layer_cube_path)) + [input_path + file_name for file_name in file_names if file_name not in layer_cube.layer_names]
+
+# block_size: None reads every layer whole, otherwise the AOI grid is streamed in block_size x block_size windows
+# layer_cube_path: layer cube written by step7 (see layer_cube.py), the layers it holds are mapped from it instead of decoding their GeoTIFFs
+# expression: aggregation of the layers (see map_algebra.py), compiled once and evaluated window by window
+# max_workers: processes the windows are computed in (see map_windows), this process writes them in window order
+@traced('calculate_result', None, None)
+def calculate_result(df_input_excel, input_path, output_path, block_size=None, layer_cube_path=None, expression=DEFAULT_EXPRESSION, max_workers=1):
+    # GDAL threads and block cache of each of the max_workers processes (see tuning.py)
+    apply_tuning('step8', max_workers)
+    df_input_excel = df_input_excel.copy()
 
     # Filter rows where are AOI, exclusion
     scored_df = df_input_excel[(df_input_excel['AOI'] != 1) | (df_input_excel['exclusion'] != 1)]
@@ -23,83 +119,294 @@ def process_result_calculation(input_path, output_path, input_excel_path):
     # Modifying file_name to include "AOI"
     # AOI data frame
     df_AOI = df_input_excel[df_input_excel['AOI'] == 1]
-    AOI_file_path = input_path + df_AOI.iloc[0]['file_name']
-
-    # create base raster array for raster calculation, should be 0 value / using for raster cell calculation
-    with rasterio.open(AOI_file_path) as AOI_dataset:
-        array_calculation = np.array(copy.deepcopy(AOI_dataset.read(1).astype(float)))-1
+    AOI_file_name = df_AOI.iloc[0]['file_name']
+    layer_cube = LayerCube(layer_cube_path) if layer_cube_path else None
 
     # filtering scored layers: layer_weight is not null
     df_scored_layers = df_input_excel[df_input_excel['layer_weight_rate'].notna()]
-    
+
     # filtering non-scored layers: layer_weight is null (AOI, exclusion)
     df_nonscored_layers = df_input_excel[df_input_excel['layer_weight_rate'].isna()]
 
-    # calculate layer weight
-    for index, row in df_scored_layers.iterrows():
-        file_path = input_path + row['file_name']
-       
-        try:
-            with rasterio.open(file_path) as dataset:
-                dataset_raster_value = dataset.read(1)
-                # Checking for NoData values and setting them to 0
-                if dataset.nodata is not None:
-                    dataset_raster_value[dataset_raster_value == dataset.nodata] = 0
+    # skipped when the layers, weights and AOI/exclusion flags are unchanged since the last run
+    result_file_path = output_path + r'MCA_result.tif'
+    input_file_paths = get_input_file_paths(input_path, [AOI_file_name] + df_input_excel['file_name'].tolist(), layer_cube_path, layer_cube)
+    params = {
+        'layer_weight_rate': df_scored_layers[['file_name', 'layer_weight_rate']].values.tolist(),
+        'nonscored_layers': df_nonscored_layers[['file_name', 'AOI', 'exclusion']].values.tolist(),
+        'block_size': block_size,
+        'encoding': get_stage_profile('step8')
+    }
 
-                # Verifying if the raster data type matches the expected type
-                if not np.issubdtype(dataset_raster_value.dtype, np.number):
-                    print(f"Error: Raster data type is not numeric at path {file_path}")
-                    continue
+    # Cloud-Optimized GeoTIFF with overviews (MCA_COG=step8), averaged overviews of the scores
+    cog_options = get_cog_options('step8', rasterio.float32, 'AVERAGE')
+    if cog_options:
+        params['cog'] = cog_options
+    if expression != DEFAULT_EXPRESSION:
+        params['expression'] = expression
+    up_to_date, cache_entry = check_cache(result_file_path, input_file_paths, params, __file__)
+    if up_to_date:
+        return
 
-                # Performing array operations
-                array_calculation += dataset_raster_value * row['layer_weight_rate']
+    # an invalid expression is reported before any layer is opened
+    kernel = compile_expression(expression)
 
+    # open every layer once, each window is read from the opened datasets
+    scored_datasets = []
+    scored_layers = []  # file names and rates of the readable layers, opened again by the worker processes
+    for index, row in df_scored_layers.iterrows():
+        file_path = input_path + row['file_name']
+
+        try:
+            dataset = open_layer(input_path, row['file_name'], layer_cube)
         except rasterio.errors.RasterioIOError as e:
             print(f"Error reading raster file at path {file_path}: {e}")
+            continue
 
-    # calculate AOI, Exclusion
+        # Verifying if the raster data type matches the expected type
+        if not np.issubdtype(np.dtype(dataset.dtypes[0]), np.number):
+            print(f"Error: Raster data type is not numeric at path {file_path}")
+            dataset.close()
+            continue
+
+        scored_datasets.append((dataset, row['layer_weight_rate']))
+        scored_layers.append((row['file_name'], row['layer_weight_rate']))
+
+    nonscored_datasets = []
+    nonscored_layers = []
     for index, row in df_nonscored_layers.iterrows():
-        # Access values in each row
-        file_path = input_path + row['file_name']
-        include_AOI = row['AOI']
-        exclude = row['exclusion']
+        if row['AOI'] == 1 or row['exclusion'] == 1:
+            nonscored_datasets.append((open_layer(input_path, row['file_name'], layer_cube), row['AOI'], row['exclusion']))
+            nonscored_layers.append((row['file_name'], row['AOI'], row['exclusion']))
+
+    no_data_value = 0
+
+    try:
+        with open_layer(input_path, AOI_file_name, layer_cube) as AOI_dataset:
+            profile = AOI_dataset.profile
+            profile.update(dtype=rasterio.float32, nodata=no_data_value)
+            # block layout of the AOI file is not carried over, the output uses the encoding profile's tiling
+            profile.pop('blockxsize', None)
+            profile.pop('blockysize', None)
+            # a COG cannot be written window by window, the windows go to an uncompressed GeoTIFF that is then copied as a COG
+            write_file_path = os.path.splitext(result_file_path)[0] + '_tmp.tif' if cog_options else result_file_path
+            profile.update(rasterio_creation_options('uncompressed' if cog_options else get_stage_profile('step8'), rasterio.float32))
+
+            # one output tile per window, so every window is encoded exactly once
+            if block_size:
+                profile.update(tiled=True, blockxsize=block_size, blockysize=block_size)
+
+            windows = list(iter_windows(AOI_dataset.width, AOI_dataset.height, block_size))
+            if max_workers > 1 and len(windows) > 1:
+                worker_args = (input_path, AOI_file_name, scored_layers, nonscored_layers, layer_cube_path, expression, False)
+                results = map_windows(windows, max_workers, worker_args, no_data_value)
+            else:
+                results = (calculate_window(window, AOI_dataset, scored_datasets, nonscored_datasets, no_data_value, kernel) for window in windows)
+
+            with rasterio.open(write_file_path, 'w', **profile) as dst:
+                for window, array_calculation in zip(windows, results):
+                    dst.write(array_calculation.astype(profile['dtype']), 1, window=window)
+
+        if cog_options:
+            rasterio.shutil.copy(write_file_path, result_file_path, driver='COG', **cog_options)
+            os.remove(write_file_path)
+    finally:
+        for dataset, layer_weight_rate in scored_datasets:
+            dataset.close()
+        for dataset, include_AOI, exclude in nonscored_datasets:
+            dataset.close()
+
+    save_cache(result_file_path, cache_entry)
+
+# weight column of the scenario table for a layer: the layer's file name, or the longest column the file name starts with ('roads' for 'roads_CRS_..._scored.tif')
+def get_scenario_column(file_name, scenario_columns):
+    file_stem = os.path.splitext(file_name)[0]
+    matches = [column for column in scenario_columns if str(column) in (file_name, file_stem) or file_stem.startswith(str(column) + '_')]
+    return max(matches, key=lambda column: len(str(column))) if matches else None
+
+# layer_weight_rate of every scored layer in every scenario: (scenario names, N x k matrix), rounded as in calculate_result
+# df_scenarios has a 'scenario' column and one weight column per scored layer, layers without a column keep their layer_weight
+def get_scenario_rates(df_scored_layers, df_scenarios):
+    scenario_columns = [column for column in df_scenarios.columns if column != 'scenario']
+    layer_columns = [get_scenario_column(file_name, scenario_columns) for file_name in df_scored_layers['file_name']]
 
+    scenario_names = []
+    rate_matrix = np.zeros((len(df_scenarios), len(df_scored_layers)))
+    for i, (idx, scenario) in enumerate(df_scenarios.iterrows()):
+        weights = np.array([scenario[column] if column is not None else layer_weight for column, layer_weight in zip(layer_columns, df_scored_layers['layer_weight'])], dtype=float)
+        weights[np.isnan(weights)] = 0
+        scenario_name = str(scenario['scenario']) if 'scenario' in df_scenarios.columns else str(i + 1)
+        # all-zero weights would give NaN rates and a band without any score
+        if weights.sum() <= 0:
+            raise ValueError(f"Scenario '{scenario_name}' has no positive layer weight")
+        rate_matrix[i] = (weights / weights.sum()).round(3)
+        scenario_names.append(scenario_name)
+
+    return scenario_names, rate_matrix
+
+# every scenario of one window: AOI - 1 + rate_matrix @ layers, masked by the AOI/exclusion layers, values below 1 are NoData
+# each layer and mask is read once for all scenarios, and the products and sums are computed as in the weighted_sum() of calculate_window,
+# so every band equals the result of calculate_window (DEFAULT_EXPRESSION, 0/1 masks) with that scenario's rates; returns an N x height x width array
+# kernel: compiled expression other than DEFAULT_EXPRESSION, evaluated once per scenario on the layers read once
+def calculate_scenario_window(window, AOI_dataset, scored_datasets, nonscored_datasets, rate_matrix, no_data_value=0, kernel=None):
+    if kernel is not None:
+        layers = get_window_layers(window, AOI_dataset, scored_datasets, nonscored_datasets, no_data_value)
+        return np.stack([kernel(layers, list(rates)) for rates in rate_matrix])
+
+    base = AOI_dataset.read(1, window=window).astype(float) - 1
+    array_calculation = np.repeat(base[np.newaxis], rate_matrix.shape[0], axis=0)
+
+    # weighted sums of all scenarios, one batched multiply-add (N rates x layer) per layer
+    for i, dataset in enumerate(scored_datasets):
+        # Checking for NoData values and setting them to 0
+        dataset_raster_value = zero_nodata(dataset.read(1, window=window), dataset.nodata)
+        # rates in the type of the product in calculate_window
+        rates = rate_matrix[:, i].astype(get_product_dtype(dataset_raster_value.dtype))
+        array_calculation += dataset_raster_value[np.newaxis] * rates[:, np.newaxis, np.newaxis]
+
+    # AOI and exclusion masks are read once and applied to every scenario
+    for dataset, include_AOI, exclude in nonscored_datasets:
         if include_AOI == 1:  # multiply
-            with rasterio.open(file_path) as dataset:
-                dataset_raster_value = dataset.read(1)
-                array_calculation *= dataset_raster_value
+            array_calculation *= dataset.read(1, window=window)
 
         elif exclude == 1:  # 0,1 inverted multiply
-            with rasterio.open(file_path) as dataset:
-                dataset_raster_value = dataset.read(1) # read raster data
-                no_data_value = dataset.nodata # Check NoData value
+            dataset_raster_value = zero_nodata(dataset.read(1, window=window), dataset.nodata)
+            array_calculation *= invert_mask(dataset_raster_value)
 
-                # Setting cells with NoData to 0
-                if no_data_value is not None:
-                    dataset_raster_value[dataset_raster_value == no_data_value] = 0
+    # smaller than 1 means NoData
+    array_calculation[array_calculation < 1] = no_data_value
 
-                inverted_dataset_raster_value = 1 - dataset_raster_value
-                array_calculation *= inverted_dataset_raster_value
+    return array_calculation
 
-    # smaller than 1 means NoData
+# evaluate every weight set of df_scenarios in one pass over the layers (see get_scenario_rates for the table)
+# scenario_output: 'bands' writes MCA_scenarios.tif with one band per scenario, 'files' writes MCA_result_<scenario>.tif per scenario
+# memory per window is about N x block_size^2 x 8 bytes
+# layer_cube_path, expression, max_workers: as in calculate_result
+@traced('calculate_scenarios', None, None)
+def calculate_scenarios(df_input_excel, df_scenarios, input_path, output_path, block_size=256, scenario_output='bands', layer_cube_path=None,
+                        expression=DEFAULT_EXPRESSION, max_workers=1):
+    apply_tuning('step8', max_workers)
+    df_input_excel = df_input_excel.copy()
+
+    # AOI, scored and non-scored layers as in calculate_result
+    scored_df = df_input_excel[(df_input_excel['AOI'] != 1) | (df_input_excel['exclusion'] != 1)]
+    df_input_excel['layer_weight_rate'] = (df_input_excel['layer_weight'] / scored_df['layer_weight'].sum()).round(3)
+    AOI_file_name = df_input_excel[df_input_excel['AOI'] == 1].iloc[0]['file_name']
+    layer_cube = LayerCube(layer_cube_path) if layer_cube_path else None
+    df_scored_layers = df_input_excel[df_input_excel['layer_weight_rate'].notna()]
+    df_nonscored_layers = df_input_excel[df_input_excel['layer_weight_rate'].isna()]
+
+    scenario_names, rate_matrix = get_scenario_rates(df_scored_layers, df_scenarios)
+    if scenario_output == 'bands':
+        output_file_paths = [output_path + 'MCA_scenarios.tif']
+    else:
+        output_file_paths = [output_path + 'MCA_result_{}.tif'.format(scenario_name) for scenario_name in scenario_names]
+
+    # skipped when the layers, flags and every scenario's rates are unchanged since the last run
+    input_file_paths = get_input_file_paths(input_path, [AOI_file_name] + df_input_excel['file_name'].tolist(), layer_cube_path, layer_cube)
+    params = {
+        'scored_layers': df_scored_layers['file_name'].tolist(),
+        'nonscored_layers': df_nonscored_layers[['file_name', 'AOI', 'exclusion']].values.tolist(),
+        'scenarios': dict(zip(scenario_names, rate_matrix.tolist())),
+        'block_size': block_size,
+        'encoding': get_stage_profile('step8')
+    }
+    if expression != DEFAULT_EXPRESSION:
+        params['expression'] = expression
+    cache_checks = [check_cache(output_file_path, input_file_paths, params, __file__) for output_file_path in output_file_paths]
+    if all(up_to_date for up_to_date, cache_entry in cache_checks):
+        return
+
+    # the default expression is evaluated for all scenarios at once (see calculate_scenario_window)
+    kernel = compile_expression(expression) if expression != DEFAULT_EXPRESSION else None
+
+    scored_layers = df_scored_layers[['file_name', 'layer_weight_rate']].values.tolist()
+    nonscored_layers = [(row['file_name'], row['AOI'], row['exclusion']) for index, row in df_nonscored_layers.iterrows() if row['AOI'] == 1 or row['exclusion'] == 1]
+    scored_datasets = [open_layer(input_path, file_name, layer_cube) for file_name, layer_weight_rate in scored_layers]
+    nonscored_datasets = [(open_layer(input_path, file_name, layer_cube), include_AOI, exclude) for file_name, include_AOI, exclude in nonscored_layers]
     no_data_value = 0
-    array_calculation[array_calculation < 1] = no_data_value
+    output_datasets = []
 
-    with rasterio.open(AOI_file_path) as AOI_dataset:
-        profile = AOI_dataset.profile
-        profile.update(dtype=rasterio.float32, nodata=no_data_value, compress='DEFLATE')
-    
-    with rasterio.open(output_path + r'MCA_result.tif', 'w', **profile) as dst:
-        dst.write(array_calculation.astype(profile['dtype']), 1)
+    try:
+        with open_layer(input_path, AOI_file_name, layer_cube) as AOI_dataset:
+            profile = AOI_dataset.profile
+            profile.update(dtype=rasterio.float32, nodata=no_data_value, count=len(scenario_names) if scenario_output == 'bands' else 1)
+            profile.pop('blockxsize', None)
+            profile.pop('blockysize', None)
+            profile.update(rasterio_creation_options(get_stage_profile('step8'), rasterio.float32))
+            profile.update(tiled=True, blockxsize=block_size, blockysize=block_size)
+
+            output_datasets = [rasterio.open(output_file_path, 'w', **profile) for output_file_path in output_file_paths]
+            if scenario_output == 'bands':
+                output_datasets[0].descriptions = tuple(scenario_names)
+
+            windows = list(iter_windows(AOI_dataset.width, AOI_dataset.height, block_size))
+            if max_workers > 1 and len(windows) > 1:
+                worker_args = (input_path, AOI_file_name, scored_layers, nonscored_layers, layer_cube_path, expression, True)
+                results = map_windows(windows, max_workers, worker_args, no_data_value, rate_matrix)
+            else:
+                results = (calculate_scenario_window(window, AOI_dataset, scored_datasets, nonscored_datasets, rate_matrix, no_data_value, kernel) for window in windows)
+
+            for window, array_calculation in zip(windows, results):
+                array_calculation = array_calculation.astype(profile['dtype'])
+                if scenario_output == 'bands':
+                    output_datasets[0].write(array_calculation, window=window)
+                else:
+                    for dst, scenario_array in zip(output_datasets, array_calculation):
+                        dst.write(scenario_array, 1, window=window)
+    finally:
+        for dataset in output_datasets:
+            dataset.close()
+        for dataset in scored_datasets:
+            dataset.close()
+        for dataset, include_AOI, exclude in nonscored_datasets:
+            dataset.close()
+
+    for output_file_path, (up_to_date, cache_entry) in zip(output_file_paths, cache_checks):
+        save_cache(output_file_path, cache_entry)
+
+def read_table(table_path):
+    return pd.read_csv(table_path) if table_path.lower().endswith('.csv') else pd.read_excel(table_path)
+
+def process_scenario_calculation(input_path, output_path, input_excel_path, scenario_path, block_size=256, scenario_output='bands', layer_cube_path=None,
+                                 expression=DEFAULT_EXPRESSION, max_workers=1):
+    df_input_excel = pd.read_excel(input_excel_path)
+    df_scenarios = read_table(scenario_path)
+
+    calculate_scenarios(df_input_excel, df_scenarios, input_path, output_path, block_size, scenario_output, layer_cube_path, expression, max_workers)
+
+def process_result_calculation(input_path, output_path, input_excel_path, block_size=None, layer_cube_path=None, expression=DEFAULT_EXPRESSION, max_workers=1):
+    # create panda data frame for each purpose
+    df_input_excel = pd.read_excel(input_excel_path)
+
+    calculate_result(df_input_excel, input_path, output_path, block_size, layer_cube_path, expression, max_workers)
 
 
 def main():
     # set input file path
-    input_path = r'data\\step7\\'
-    output_path = r'data\\step8\\'
-    setting_excel_path = r'data\\setting_excel\\'
-    input_excel_path = setting_excel_path + r'step7_excel_template.xlsx'
-    process_result_calculation(input_path, output_path, input_excel_path)
+    input_path = os.path.join('data', 'step7', '')
+    output_path = os.path.join('data', 'step8', '')
+    setting_excel_path = os.path.join('data', 'setting_excel', '')
+    input_excel_path = os.path.join(setting_excel_path, 'step7_excel_template.xlsx')
+
+    # window size (pixels) for memory-bounded calculation, must be a multiple of 16 / None reads whole layers
+    block_size = 1024
+
+    # layers mapped from the layer cube written by step7 (MCA_LAYER_CUBE=1)
+    layer_cube_path = os.path.join(input_path, 'layer_cube') if os.environ.get('MCA_LAYER_CUBE') == '1' else None
+
+    # aggregation expression (MCA_EXPRESSION, see map_algebra.py), the weighted sum by default
+    expression = get_expression()
+
+    # number of parallel worker processes computing the windows (MCA_MAX_WORKERS, 1 computes them in this process)
+    max_workers = get_max_workers()
+
+    process_result_calculation(input_path, output_path, input_excel_path, block_size, layer_cube_path, expression, max_workers)
+
+    # weight scenarios (MCA_SCENARIOS: Excel/CSV table with a 'scenario' column and one weight column per scored layer)
+    if os.environ.get('MCA_SCENARIOS'):
+        process_scenario_calculation(input_path, output_path, input_excel_path, os.environ['MCA_SCENARIOS'], block_size, os.environ.get('MCA_SCENARIO_OUTPUT', 'bands'),
+                                     layer_cube_path, expression, max_workers)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
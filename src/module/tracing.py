@@ -0,0 +1,226 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: Per-Stage Performance Tracing and Run Reports
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import argparse
+import functools
+import threading
+from contextlib import contextmanager, nullcontext
+
+# directory the trace records are written to, set with the MCA_TRACE environment variable (unset: tracing is off)
+# the variable is read once per process, worker processes inherit it from the process that starts them
+TRACE_PATH = os.environ.get('MCA_TRACE') or None
+
+# stages open in this thread, their peak memory takes in the peaks of the stages nested in them
+_local = threading.local()
+
+def tracing_enabled():
+    return TRACE_PATH is not None
+
+# turn tracing on for this process and the worker processes it starts, the records of a previous run in trace_path are removed
+def enable_tracing(trace_path):
+    global TRACE_PATH
+    TRACE_PATH = trace_path
+    os.environ['MCA_TRACE'] = trace_path
+    os.makedirs(trace_path, exist_ok=True)
+    for record_path in glob.glob(os.path.join(trace_path, 'trace_*.jsonl')):
+        os.remove(record_path)
+
+# bytes read and written by this process (all reads and writes, including the ones served by the page cache), None where /proc is not available
+def read_io_counters():
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+# peak resident memory (bytes) since the last reset_peak_rss, the peak of the whole process where it cannot be reset
+# resource is Unix-only, on Windows the peak working set comes from psutil when it is installed, otherwise the peak is not recorded (None)
+def read_peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    except ImportError:
+        pass
+
+    try:
+        import psutil
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, 'peak_wset', memory_info.rss)
+    except ImportError:
+        return None
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+# GDAL block cache in use and its limit, only when GDAL is already loaded by the step
+def read_gdal_cache():
+    gdal = sys.modules.get('osgeo.gdal')
+    if gdal is None:
+        return {}
+    return {'gdal_cache_used_MB': round(gdal.GetCacheUsed() / 1e6, 1), 'gdal_cache_max_MB': round(gdal.GetCacheMax() / 1e6, 1)}
+
+# width, height, bands and data type of a raster written by the stage (header only)
+def read_raster_info(raster_path):
+    import rasterio
+    try:
+        with rasterio.open(raster_path) as dataset:
+            return {'width': dataset.width, 'height': dataset.height, 'bands': dataset.count, 'dtype': dataset.dtypes[0]}
+    except Exception:
+        return {}
+
+def write_record(record):
+    record_path = os.path.join(TRACE_PATH, 'trace_{}.jsonl'.format(os.getpid()))
+    with open(record_path, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+@contextmanager
+def _trace_stage(stage, file_name=None, output_path=None):
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+
+    # the enclosing stage keeps the peak reached so far, then the peak is reset for this stage
+    if stack:
+        stack[-1]['peak_rss'] = max(stack[-1]['peak_rss'], read_peak_rss() or 0)
+    reset_peak_rss()
+    entry = {'peak_rss': 0}
+    stack.append(entry)
+
+    io_start = read_io_counters()
+    cpu_start = time.process_time()
+    start_us = time.time_ns() // 1000
+    wall_start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        io_end = read_io_counters()
+        stack.pop()
+        peak_rss = max(entry['peak_rss'], read_peak_rss() or 0)
+        if stack:
+            stack[-1]['peak_rss'] = max(stack[-1]['peak_rss'], peak_rss)
+
+        record = {
+            'stage': stage,
+            'file': os.path.basename(str(file_name)) if file_name is not None else None,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'start_us': start_us,
+            'wall_s': round(wall_time, 4),
+            'cpu_s': round(cpu_time, 4),
+            'peak_rss_MB': round(peak_rss / 1e6, 1) if peak_rss else None,
+        }
+        if io_start and io_end:
+            record['read_MB'] = round((io_end[0] - io_start[0]) / 1e6, 2)
+            record['written_MB'] = round((io_end[1] - io_start[1]) / 1e6, 2)
+        record.update(read_gdal_cache())
+        if output_path is not None and str(output_path).lower().endswith('.tif') and os.path.exists(output_path):
+            record['output_MB'] = round(os.path.getsize(output_path) / 1e6, 2)
+            record.update(read_raster_info(output_path))
+        if error:
+            record['error'] = error
+        write_record(record)
+
+# context manager recording one stage (wall and CPU time, peak RSS, bytes read and written, GDAL cache, output raster size)
+# file_name: the file the stage processes, output_path: the raster it writes
+# when tracing is off this is a shared no-op context manager
+def trace_stage(stage, file_name=None, output_path=None):
+    if TRACE_PATH is None:
+        return nullcontext()
+    return _trace_stage(stage, file_name, output_path)
+
+# decorator recording every call of a function as a stage, file_arg / output_arg: positions of the input and output path arguments (None: not recorded)
+# when tracing is off the function is called directly
+def traced(stage, file_arg=0, output_arg=1):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if TRACE_PATH is None:
+                return function(*args, **kwargs)
+            file_name = args[file_arg] if file_arg is not None and len(args) > file_arg else None
+            output_path = args[output_arg] if output_arg is not None and len(args) > output_arg else None
+            with _trace_stage(stage, file_name, output_path):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def read_records(trace_path):
+    records = []
+    for record_path in sorted(glob.glob(os.path.join(trace_path, 'trace_*.jsonl'))):
+        with open(record_path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return sorted(records, key=lambda record: record['start_us'])
+
+# totals per stage: calls, wall and CPU time, largest peak RSS, bytes read and written
+def summarize_stages(records):
+    stages = {}
+    for record in records:
+        summary = stages.setdefault(record['stage'], {'calls': 0, 'wall_s': 0, 'cpu_s': 0, 'peak_rss_MB': 0, 'read_MB': 0, 'written_MB': 0})
+        summary['calls'] += 1
+        summary['peak_rss_MB'] = max(summary['peak_rss_MB'], record['peak_rss_MB'] or 0)
+        for field in ['wall_s', 'cpu_s', 'read_MB', 'written_MB']:
+            summary[field] = round(summary[field] + record.get(field, 0), 4)
+    return stages
+
+# Chrome trace event format ('X' complete events), opened in chrome://tracing or https://ui.perfetto.dev
+def to_trace_events(records):
+    events = []
+    for record in records:
+        name = record['stage'] if record['file'] is None else '{} {}'.format(record['stage'], record['file'])
+        args = {key: value for key, value in record.items() if key not in ['stage', 'pid', 'tid', 'start_us']}
+        events.append({'name': name, 'cat': record['stage'], 'ph': 'X', 'ts': record['start_us'], 'dur': int(record['wall_s'] * 1e6),
+                       'pid': record['pid'], 'tid': record['tid'], 'args': args})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+# run_report.json (every record and the totals per stage) and trace.json (Chrome trace) from the records in trace_path
+def write_run_report(trace_path=None):
+    trace_path = trace_path or TRACE_PATH
+    records = read_records(trace_path)
+
+    report = {'stages': summarize_stages(records), 'records': records}
+    with open(os.path.join(trace_path, 'run_report.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+    with open(os.path.join(trace_path, 'trace.json'), 'w') as f:
+        json.dump(to_trace_events(records), f)
+
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Write run_report.json and trace.json from the trace records of a run')
+    parser.add_argument('trace_path', nargs='?', default=TRACE_PATH, help='directory of the trace records (default: MCA_TRACE)')
+    args = parser.parse_args()
+
+    report = write_run_report(args.trace_path)
+    for stage, summary in sorted(report['stages'].items(), key=lambda item: -item[1]['wall_s']):
+        print(f"{stage}: {summary}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Created by Chungkang Choi
+May 2024
+
+Description: Hardware-Aware GDAL Tuning Profile
+"""
+
+import os
+import sys
+import ctypes
+
+# settings of the tuning profile:
+# warp_threads    threads of each warp (gdal.Warp and rasterio reproject)
+# warp_memory_mb  memory of each warp operation (MB), larger chunks mean fewer passes over the source
+# cache_mb        GDAL block cache of each process (GDAL_CACHEMAX, MB)
+# num_threads     threads of GeoTIFF compression and decompression (GDAL_NUM_THREADS)
+TUNING_KEYS = ['warp_threads', 'warp_memory_mb', 'cache_mb', 'num_threads']
+
+# cores this process may run on
+def get_machine_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# physical memory in bytes
+def get_machine_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        pass
+
+    # Windows
+    class MemoryStatus(ctypes.Structure):
+        _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong), ('ullTotalPhys', ctypes.c_ulonglong),
+                    ('ullAvailPhys', ctypes.c_ulonglong), ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                    ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong), ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+    try:
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+        return status.ullTotalPhys
+    except (AttributeError, OSError):
+        return 8 * 1024 ** 3
+
+# 'warp_threads=8,cache_mb=2048' -> {'warp_threads': 8, 'cache_mb': 2048}
+def parse_tuning(tuning_str):
+    tuning = {}
+    for item in filter(None, [item.strip() for item in tuning_str.split(',')]):
+        key, value = [part.strip() for part in item.split('=')]
+        if key not in TUNING_KEYS:
+            raise ValueError(f"Unknown tuning setting '{key}', expected one of {TUNING_KEYS}")
+        tuning[key] = max(int(value), 1)
+    return tuning
+
+# tuning profile of a stage ('step3' ... 'step8') when processes worker processes share the machine
+# every process gets an equal share of the cores and of the memory: threads = cores / processes,
+# block cache 10% and warp memory 5% of the memory / processes (the warp memory between 64 MB and 4 GB)
+# overridden for every stage with MCA_TUNING and for one stage with MCA_TUNING_STEPN, e.g. MCA_TUNING_STEP6='warp_threads=16,cache_mb=4096'
+# processes: None takes the number set by apply_tuning for this process and the workers it starts
+def get_tuning(stage, processes=None):
+    processes = processes or int(os.environ.get('MCA_TUNING_PROCESSES', 1))
+    threads = max(get_machine_cores() // processes, 1)
+    memory_mb = get_machine_memory() // 1024 ** 2 // processes
+
+    tuning = {
+        'warp_threads': threads,
+        'warp_memory_mb': min(max(memory_mb // 20, 64), 4096),
+        'cache_mb': max(memory_mb // 10, 64),
+        'num_threads': threads,
+    }
+    tuning.update(parse_tuning(os.environ.get('MCA_TUNING', '')))
+    tuning.update(parse_tuning(os.environ.get('MCA_TUNING_' + stage.upper(), '')))
+    return tuning
+
+# apply the tuning profile of a stage to this process and to the worker processes it starts (they inherit the environment)
+# called by each step before its files are processed, processes: worker processes of the step
+# MCA_TUNING_JOBS: jobs running steps side by side in separate processes (the sites of batch mode, see sites.py), each gets its share
+def apply_tuning(stage, processes=1):
+    processes = processes * int(os.environ.get('MCA_TUNING_JOBS', 1))
+    os.environ['MCA_TUNING_PROCESSES'] = str(processes)
+    tuning = get_tuning(stage, processes)
+
+    # read by GDAL when its cache starts and by every GeoTIFF read and write
+    os.environ['GDAL_CACHEMAX'] = str(tuning['cache_mb'])
+    os.environ['GDAL_NUM_THREADS'] = str(tuning['num_threads'])
+
+    # GDAL is already running in this process
+    gdal = sys.modules.get('osgeo.gdal')
+    if gdal is not None:
+        gdal.SetCacheMax(tuning['cache_mb'] * 1024 ** 2)
+        gdal.SetConfigOption('GDAL_NUM_THREADS', str(tuning['num_threads']))
+
+    return tuning
+
+# keyword arguments of gdal.WarpOptions for a stage
+def gdal_warp_options(stage):
+    tuning = get_tuning(stage)
+    return {
+        'multithread': tuning['warp_threads'] > 1,
+        'warpMemoryLimit': tuning['warp_memory_mb'] * 1024 ** 2,
+        'warpOptions': ['NUM_THREADS={}'.format(tuning['warp_threads'])],
+    }
+
+# keyword arguments of rasterio.warp.reproject for a stage
+def rasterio_warp_options(stage):
+    tuning = get_tuning(stage)
+    return {'num_threads': tuning['warp_threads'], 'warp_mem_limit': tuning['warp_memory_mb']}